@@ -9,6 +9,7 @@ import datetime
 import yaml
 import time
 import logging
+from array import array
 import octoprint.util as util
 import octoprint.util.gcodeInterpreter as gcodeInterpreter
 from octoprint.settings import settings
@@ -28,6 +29,8 @@ class GcodeManager:
 		self._metadataFile = os.path.join(self._uploadFolder, "metadata.yaml")
 		self._metadataFileAccessMutex = threading.Lock()
 
+		self._analysisPausedBy = set()
+		self._analysisPauseMutex = threading.Lock()
 		self._metadataAnalyzer = MetadataAnalyzer(getPathCallback=self.getAbsolutePath, loadedCallback=self._onMetadataAnalysisFinished)
 
 		self._loadMetadata()
@@ -41,7 +44,7 @@ class GcodeManager:
 				continue
 
 			fileData = self.getFileData(filename)
-			if fileData is not None and "gcodeAnalysis" in fileData.keys():
+			if fileData is not None and "gcodeAnalysis" in fileData.keys() and os.path.exists(self._getTimeIndexPath(filename)):
 				continue
 
 			self._metadataAnalyzer.addFileToBacklog(filename)
@@ -56,6 +59,10 @@ class GcodeManager:
 		if absolutePath is None:
 			return
 
+		if len(gcode.timeIndex) > 1:
+			with open(self._getTimeIndexPath(basename), "wb") as f:
+				gcode.timeIndex.tofile(f)
+
 		analysisResult = {}
 		dirty = False
 		if gcode.totalMoveTimeMinute:
@@ -91,6 +98,14 @@ class GcodeManager:
 		self._loadMetadata()
 		self._sendUpdateTrigger("gcodeFiles")
 
+	def _getTimeIndexPath(self, filename):
+		return self.getAbsolutePath(filename, mustExist=False) + ".timeindex"
+
+	def _removeTimeIndex(self, filename):
+		timeIndexPath = self._getTimeIndexPath(filename)
+		if os.path.exists(timeIndexPath):
+			os.remove(timeIndexPath)
+
 	def _getBasicFilename(self, filename):
 		if filename.startswith(self._uploadFolder):
 			return filename[len(self._uploadFolder + os.path.sep):]
@@ -122,6 +137,10 @@ class GcodeManager:
 					del self._metadata[file.filename]
 					self._metadataDirty = True
 					self._saveMetadata()
+				self._removeTimeIndex(file.filename)
+				if os.path.exists(absolutePath):
+					# replace instead of overwrite, the old file might still be memory mapped by a print job
+					os.remove(absolutePath)
 				file.save(absolutePath)
 				self._metadataAnalyzer.addFileToQueue(os.path.basename(absolutePath))
 				return self._getBasicFilename(absolutePath)
@@ -132,6 +151,7 @@ class GcodeManager:
 		absolutePath = self.getAbsolutePath(filename)
 		if absolutePath is not None:
 			os.remove(absolutePath)
+			self._removeTimeIndex(filename)
 			if filename in self._metadata.keys():
 				del self._metadata[filename]
 				self._metadataDirty = True
@@ -219,6 +239,23 @@ class GcodeManager:
 				}
 			}
 
+	def getPrintTimeIndex(self, filename):
+		"""
+		 Returns the print time index the analysis of the given file produced, see gcodeInterpreter.gcode.timeIndex, or
+		 None if the file hasn't been analyzed yet.
+		"""
+		if self.getAbsolutePath(filename) is None:
+			return None
+
+		timeIndexPath = self._getTimeIndexPath(filename)
+		if not os.path.exists(timeIndexPath):
+			return None
+
+		timeIndex = array("f")
+		with open(timeIndexPath, "rb") as f:
+			timeIndex.fromfile(f, os.stat(timeIndexPath).st_size / timeIndex.itemsize)
+		return timeIndex
+
 	def setFileMetadata(self, filename, metadata):
 		filename = self._getBasicFilename(filename)
 		self._metadata[filename] = metadata
@@ -284,11 +321,20 @@ class GcodeManager:
 
 	#~~ analysis control
 
-	def pauseAnalysis(self):
-		self._metadataAnalyzer.pause()
-
-	def resumeAnalysis(self):
-		self._metadataAnalyzer.resume()
+	def pauseAnalysis(self, requester=None):
+		"""
+		 Pauses the analysis until every requester that paused it resumed it again, so that one printer finishing its job
+		 doesn't resume the analysis while others are still printing.
+		"""
+		with self._analysisPauseMutex:
+			self._analysisPausedBy.add(requester)
+			self._metadataAnalyzer.pause()
+
+	def resumeAnalysis(self, requester=None):
+		with self._analysisPauseMutex:
+			self._analysisPausedBy.discard(requester)
+			if len(self._analysisPausedBy) == 0:
+				self._metadataAnalyzer.resume()
 
 class MetadataAnalyzer:
 	def __init__(self, getPathCallback, loadedCallback):
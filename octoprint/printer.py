@@ -7,32 +7,113 @@ import datetime
 import threading
 import copy
 import os
+import re
+import collections
+import logging
 
 import octoprint.util.comm as comm
 import octoprint.util as util
 
+from octoprint.util.printJob import PrintJob, FilePrintJob, MemoryPrintJob
+
 from octoprint.settings import settings
 
-def getConnectionOptions():
+DEFAULT_PRINTER = "default"
+
+def getConnectionOptions(printer=None):
 	"""
 	 Retrieves the available ports, baudrates, prefered port and baudrate for connecting to the printer.
 	"""
+	portPreference = settings().get(["serial", "port"])
+	baudratePreference = settings().getInt(["serial", "baudrate"])
+	if printer is not None:
+		(port, baudrate) = printer.getConnectionPreference()
+		if port is not None:
+			portPreference = port
+		if baudrate is not None:
+			baudratePreference = baudrate
+
 	return {
 		"ports": comm.serialList(),
 		"baudrates": comm.baudrateList(),
-		"portPreference": settings().get(["serial", "port"]),
-		"baudratePreference": settings().getInt(["serial", "baudrate"])
+		"portPreference": portPreference,
+		"baudratePreference": baudratePreference
 	}
 
-class Printer():
+class PrinterRegistry():
+	"""
+	 All printers driven by this server, addressed by their ids. The default printer connects as configured in the
+	 serial settings, further printers are configured as entries of the printers settings, each with an id and
+	 optionally a name, port and baudrate. All printers share the gcode manager.
+	"""
+
 	def __init__(self, gcodeManager):
+		self._logger = logging.getLogger(__name__)
+		self._printers = collections.OrderedDict()
+		self._printers[DEFAULT_PRINTER] = Printer(gcodeManager)
+
+		for config in settings().get(["printers"]):
+			# ids are compared as the str they get stored under, 1 and "1" are the same printer
+			if not "id" in config.keys() or str(config["id"]) in self._printers.keys():
+				self._logger.warn("Ignoring printer without id or with duplicate id: %r" % config)
+				continue
+			id = str(config["id"])
+			name = config["name"] if "name" in config.keys() else None
+			port = config["port"] if "port" in config.keys() else None
+			baudrate = config["baudrate"] if "baudrate" in config.keys() else None
+			self._printers[id] = Printer(gcodeManager, id=id, name=name, port=port, baudrate=baudrate)
+
+	def get(self, id=None):
+		"""
+		 Returns the printer with the given id, the default printer if id is None and None if there is no such printer.
+		"""
+		if id is None:
+			id = DEFAULT_PRINTER
+		if id in self._printers.keys():
+			return self._printers[id]
+		return None
+
+	def getAll(self):
+		return self._printers.values()
+
+	def saveConnectionPreference(self, printer, port, baudrate):
+		"""
+		 Makes port and baudrate the ones the given printer connects with by default and saves them to the settings.
+		"""
+		if baudrate is not None:
+			baudrate = int(baudrate)
+
+		if printer.getId() == DEFAULT_PRINTER:
+			settings().set(["serial", "port"], port)
+			settings().setInt(["serial", "baudrate"], baudrate)
+		else:
+			configs = copy.deepcopy(settings().get(["printers"]))
+			for config in configs:
+				if "id" in config.keys() and str(config["id"]) == printer.getId():
+					# the first entry with the id is the printer, any further ones got ignored
+					config["port"] = port
+					config["baudrate"] = baudrate
+					break
+			settings().set(["printers"], configs)
+		settings().save()
+
+		printer.setConnectionPreference(port, baudrate)
+
+class Printer():
+	def __init__(self, gcodeManager, id=DEFAULT_PRINTER, name=None, port=None, baudrate=None):
 		self._gcodeManager = gcodeManager
 
+		self._id = id
+		self._name = name
+		self._port = port
+		self._baudrate = baudrate
+
 		# state
 		self._temp = None
 		self._bedTemp = None
 		self._targetTemp = None
 		self._targetBedTemp = None
+		self._temperatures = {}
 		self._temps = {
 			"actual": [],
 			"target": [],
@@ -46,7 +127,7 @@ class Printer():
 		self._messageBacklog = []
 
 		self._latestLog = None
-		self._log = []
+		self._log = collections.deque(maxlen=300)
 		self._logBacklog = []
 
 		self._state = None
@@ -91,8 +172,8 @@ class Printer():
 			state={"state": None, "stateString": self.getStateString(), "flags": self._getStateFlags()},
 			jobData={"filename": None, "lines": None, "estimatedPrintTime": None, "filament": None},
 			gcodeData={"filename": None, "progress": None},
-			sdUploadData={"filename": None, "progress": None},
-			progress={"progress": None, "printTime": None, "printTimeLeft": None},
+			sdUploadData={"filename": None, "progress": None, "bytesPerSecond": None},
+			progress={"progress": None, "printTime": None, "printTimeLeft": None, "layer": None},
 			currentZ=None
 		)
 
@@ -135,9 +216,13 @@ class Printer():
 
 	def connect(self, port=None, baudrate=None):
 		"""
-		 Connects to the printer. If port and/or baudrate is provided, uses these settings, otherwise autodetection
-		 will be attempted.
+		 Connects to the printer. If port and/or baudrate is provided, uses these settings, otherwise the ones configured
+		 for the printer, otherwise autodetection will be attempted.
 		"""
+		if port is None:
+			port = self._port
+		if baudrate is None:
+			baudrate = self._baudrate
 		if self._comm is not None:
 			self._comm.close()
 		self._comm = comm.MachineCom(port, baudrate, callbackObject=self)
@@ -207,8 +292,11 @@ class Printer():
 			self._sdPrinting = True
 			self._comm.printSdFile()
 		else:
-			# we are working in local mode
-			self._comm.printGCode(self._gcodeList)
+			# we are working in local mode, the analysis of the file might have finished since it was loaded
+			printTimeIndex = None
+			if self._filename is not None:
+				printTimeIndex = self._gcodeManager.getPrintTimeIndex(self._filename)
+			self._comm.printGCode(self._gcodeList, printTimeIndex)
 
 	def togglePausePrint(self):
 		"""
@@ -265,7 +353,6 @@ class Printer():
 
 	def _addLog(self, log):
 		self._log.append(log)
-		self._log = self._log[-300:]
 		self._stateMonitor.addLog(log)
 
 	def _addMessage(self, message):
@@ -273,7 +360,7 @@ class Printer():
 		self._messages = self._messages[-300:]
 		self._stateMonitor.addMessage(message)
 
-	def _setProgressData(self, progress, currentLine, printTime, printTimeLeft):
+	def _setProgressData(self, progress, currentLine, printTime, printTimeLeft, layer=None):
 		self._progress = progress
 		self._printTime = printTime
 		self._printTimeLeft = printTimeLeft
@@ -286,11 +373,14 @@ class Printer():
 		if (self._printTimeLeft):
 			formattedPrintTimeLeft = util.getFormattedTimeDelta(datetime.timedelta(minutes=self._printTimeLeft))
 
-		self._stateMonitor.setProgress({"progress": self._progress, "currentLine": currentLine, "printTime": formattedPrintTime, "printTimeLeft": formattedPrintTimeLeft})
+		self._stateMonitor.setProgress({"progress": self._progress, "currentLine": currentLine, "printTime": formattedPrintTime, "printTimeLeft": formattedPrintTimeLeft, "layer": layer})
 
-	def _addTemperatureData(self, temp, bedTemp, targetTemp, bedTargetTemp):
+	def _addTemperatureData(self, temperatures):
 		currentTimeUtc = int(time.time() * 1000)
 
+		(temp, targetTemp, power) = temperatures.get("T", temperatures.get("T0", (self._temp, self._targetTemp, None)))
+		(bedTemp, bedTargetTemp, power) = temperatures.get("B", (self._bedTemp, self._targetBedTemp, None))
+
 		self._temps["actual"].append((currentTimeUtc, temp))
 		self._temps["actual"] = self._temps["actual"][-300:]
 
@@ -307,6 +397,7 @@ class Printer():
 		self._bedTemp = bedTemp
 		self._targetTemp = targetTemp
 		self._targetBedTemp = bedTargetTemp
+		self._temperatures = temperatures
 
 		self._stateMonitor.addTemperature({"currentTime": currentTimeUtc, "temp": self._temp, "bedTemp": self._bedTemp, "targetTemp": self._targetTemp, "targetBedTemp": self._targetBedTemp})
 
@@ -338,7 +429,7 @@ class Printer():
 			data = self._stateMonitor.getCurrentData()
 			data.update({
 				"temperatureHistory": self._temps,
-				"logHistory": self._log,
+				"logHistory": list(self._log),
 				"messageHistory": self._messages
 			})
 			callback.sendHistoryData(data)
@@ -372,8 +463,8 @@ class Printer():
 		"""
 		self._addLog(message)
 
-	def mcTempUpdate(self, temp, bedTemp, targetTemp, bedTargetTemp):
-		self._addTemperatureData(temp, bedTemp, targetTemp, bedTargetTemp)
+	def mcTempUpdate(self, temperatures):
+		self._addTemperatureData(temperatures)
 
 	def mcStateChange(self, state):
 		"""
@@ -394,9 +485,9 @@ class Printer():
 				self._gcodeManager.printSucceeded(self._filename)
 			elif state == self._comm.STATE_CLOSED or state == self._comm.STATE_ERROR or state == self._comm.STATE_CLOSED_WITH_ERROR:
 				self._gcodeManager.printFailed(self._filename)
-			self._gcodeManager.resumeAnalysis() # printing done, put those cpu cycles to good use
+			self._gcodeManager.resumeAnalysis(self._id) # printing done, put those cpu cycles to good use
 		elif self._comm is not None and state == self._comm.STATE_PRINTING:
-			self._gcodeManager.pauseAnalysis() # do not analyse gcode while printing
+			self._gcodeManager.pauseAnalysis(self._id) # do not analyse gcode while printing
 
 		self._setState(state)
 
@@ -414,6 +505,7 @@ class Printer():
 		"""
 		oldProgress = self._progress
 
+		layer = None
 		if self._sdPrinting:
 			newLine = None
 			(filePos, fileSize) = self._comm.getSdProgress()
@@ -425,10 +517,14 @@ class Printer():
 			newLine = self._comm.getPrintPos()
 			if self._gcodeList is not None:
 				newProgress = float(newLine) / float(len(self._gcodeList))
+				if isinstance(self._gcodeList, PrintJob) and newLine > 0:
+					# the layer of the line that was sent last, looked up in the layer index of the job
+					(current, height, layerProgress) = self._gcodeList.getLayer(newLine - 1)
+					layer = {"current": current, "total": self._gcodeList.getLayerCount(), "progress": layerProgress}
 			else:
 				newProgress = 0.0
 
-		self._setProgressData(newProgress, newLine, self._comm.getPrintTime(), self._comm.getPrintTimeRemainingEstimate())
+		self._setProgressData(newProgress, newLine, self._comm.getPrintTime(), self._comm.getPrintTimeRemainingEstimate(), layer)
 
 	def mcZChange(self, newZ):
 		"""
@@ -506,15 +602,15 @@ class Printer():
 
 	#~~ callbacks triggered by sdFileStreamer
 
-	def _onSdFileStreamProgress(self, filename, progress):
-		self._stateMonitor.setSdUploadData({"filename": filename, "progress": progress})
+	def _onSdFileStreamProgress(self, filename, progress, bytesPerSecond):
+		self._stateMonitor.setSdUploadData({"filename": filename, "progress": progress, "bytesPerSecond": bytesPerSecond})
 
 	def _onSdFileStreamFinish(self, filename):
 		self._setCurrentZ(None)
 		self._setProgressData(None, None, None, None)
 		self._sdStreamer = None
 
-		self._stateMonitor.setSdUploadData({"filename": None, "progress": None})
+		self._stateMonitor.setSdUploadData({"filename": None, "progress": None, "bytesPerSecond": None})
 		self._stateMonitor.setState({"state": self._state, "stateString": self.getStateString(), "flags": self._getStateFlags()})
 
 	#~~ callbacks triggered by gcodeLoader
@@ -554,6 +650,24 @@ class Printer():
 		else:
 			return None
 
+	def getId(self):
+		return self._id
+
+	def getName(self):
+		if self._name is None:
+			return self._id
+		return self._name
+
+	def getConnectionPreference(self):
+		"""
+		 Returns the port and baudrate configured for the printer, None for either if there is none.
+		"""
+		return (self._port, self._baudrate)
+
+	def setConnectionPreference(self, port, baudrate):
+		self._port = port
+		self._baudrate = baudrate
+
 	def getStateString(self):
 		"""
 		 Returns a human readable string corresponding to the current communication state.
@@ -566,8 +680,21 @@ class Printer():
 	def getCurrentData(self):
 		return self._stateMonitor.getCurrentData()
 
-	def getCurrentTemperatures(self):
+	def getSerialStatistics(self):
+		if self._comm is None:
+			return None
 		return {
+			"sendQueue": self._comm.getSendQueueStatistics(),
+			"commandQueue": self._comm.getCommandQueueStatistics()
+		}
+
+	def getLatencyStatistics(self):
+		if self._comm is None:
+			return None
+		return self._comm.getLatencyStatistics()
+
+	def getCurrentTemperatures(self):
+		result = {
 			"extruder": {
 				"current": self._temp,
 				"target": self._targetTemp
@@ -578,6 +705,22 @@ class Printer():
 			}
 		}
 
+		# all heaters reported individually by the firmware, e.g. the tools of a multi extruder machine or the chamber
+		temperatures = self._temperatures
+		for (heater, (actual, target, power)) in temperatures.items():
+			if heater.startswith("T") and len(heater) > 1:
+				key = "tool" + heater[1:]
+			elif heater == "C":
+				key = "chamber"
+			else:
+				continue
+			result[key] = {
+				"current": actual,
+				"target": target,
+				"power": power
+			}
+		return result
+
 	def isClosedOrError(self):
 		return self._comm is None or self._comm.isClosedOrError()
 
@@ -616,26 +759,10 @@ class GcodeLoader(threading.Thread):
 		self._gcodeList = None
 
 	def run(self):
-		#Send an initial M110 to reset the line counter to zero.
-		prevLineType = lineType = "CUSTOM"
-		gcodeList = ["M110 N0"]
-		filesize = os.stat(self._filename).st_size
-		with open(self._filename, "r") as file:
-			for line in file:
-				if line.startswith(";TYPE:"):
-					lineType = line[6:].strip()
-				if ";" in line:
-					line = line[0:line.find(";")]
-				line = line.strip()
-				if len(line) > 0:
-					if prevLineType != lineType:
-						gcodeList.append((line, lineType, ))
-					else:
-						gcodeList.append(line)
-					prevLineType = lineType
-				self._onLoadingProgress(float(file.tell()) / float(filesize))
-
-		self._gcodeList = gcodeList
+		if settings().getBoolean(["feature", "memoryMappedPrintJobs"]):
+			self._gcodeList = FilePrintJob(self._filename, progressCallback=self._onLoadingProgress)
+		else:
+			self._gcodeList = MemoryPrintJob(self._filename, progressCallback=self._onLoadingProgress)
 		self._loadedCallback(self._filename, self._gcodeList)
 
 	def _onLoadingProgress(self, progress):
@@ -645,6 +772,17 @@ class GcodeLoader(threading.Thread):
 		self._progressCallback(self._filename, progress, "parsing")
 
 class SdFileStreamer(threading.Thread):
+	"""
+	 Uploads a file to the printer's SD card. The file is read and stripped of comments and empty lines in big chunks,
+	 the lines are then pulled by the comm layer as fast as the firmware acknowledges them. Progress is reported at most
+	 every progressInterval seconds.
+	"""
+
+	chunkSize = 64 * 1024
+	progressInterval = 0.5
+
+	_commentPattern = re.compile(";[^\n]*")
+
 	def __init__(self, comm, filename, file, progressCallback, finishCallback):
 		threading.Thread.__init__(self)
 
@@ -654,6 +792,8 @@ class SdFileStreamer(threading.Thread):
 		self._progressCallback = progressCallback
 		self._finishCallback = finishCallback
 
+		self._bytesRead = 0
+
 	def run(self):
 		if self._comm.isBusy():
 			return
@@ -663,19 +803,46 @@ class SdFileStreamer(threading.Thread):
 		try:
 			size = os.stat(self._file).st_size
 			with open(self._file, "r") as f:
-				self._comm.startSdFileTransfer(sdFilename)
-				for line in f:
-					if ";" in line:
-						line = line[0:line.find(";")]
-					line = line.strip()
-					if len(line) > 0:
-						self._comm.sendCommand(line)
-						time.sleep(0.001) # do not send too fast
-					self._progressCallback(sdFilename, float(f.tell()) / float(size))
+				startTime = time.time()
+				if not self._comm.startSdFileTransfer(sdFilename, self._readLines(f)):
+					return
+				while True:
+					done = self._comm.waitForSdFileTransfer(self.progressInterval)
+					elapsed = time.time() - startTime
+					if size > 0:
+						progress = float(self._bytesRead) / float(size)
+					else:
+						progress = 1.0
+					if elapsed > 0:
+						bytesPerSecond = self._bytesRead / elapsed
+					else:
+						bytesPerSecond = 0.0
+					self._progressCallback(sdFilename, progress, bytesPerSecond)
+					if done:
+						break
 		finally:
-			self._comm.endSdFileTransfer(sdFilename)
 			self._finishCallback(sdFilename)
 
+	def _readLines(self, f):
+		"""
+		 Yields the commands to write to the file on the SD card. Comments are stripped from a whole chunk at once, which
+		 is a lot cheaper than doing it line by line.
+		"""
+		while True:
+			chunk = f.read(self.chunkSize)
+			if not chunk:
+				break
+			if not chunk.endswith("\n"):
+				# don't cut a line in half
+				chunk += f.readline()
+
+			lines = self._commentPattern.sub("", chunk).split("\n")
+			for line in lines:
+				line = line.strip()
+				if line:
+					yield line
+			self._bytesRead += len(chunk)
+
 class StateMonitor(object):
 	def __init__(self, ratelimit, updateCallback, addTemperatureCallback, addLogCallback, addMessageCallback):
 		self._ratelimit = ratelimit
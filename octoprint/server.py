@@ -12,12 +12,14 @@ import os
 import threading
 import logging, logging.config
 import subprocess
+import atexit
 
-from octoprint.printer import Printer, getConnectionOptions
+from octoprint.printer import PrinterRegistry, getConnectionOptions
 from octoprint.settings import settings, valid_boolean_trues
 import octoprint.timelapse as timelapse
 import octoprint.gcodefiles as gcodefiles
 import octoprint.util as util
+from octoprint.util.asyncLogging import logListener
 import octoprint.users as users
 
 SUCCESS = {}
@@ -26,7 +28,7 @@ BASEURL = "/ajax/"
 app = Flask("octoprint")
 # Only instantiated by the Server().run() method
 # In order that threads don't start too early when running as a Daemon
-printer = None 
+printerRegistry = None
 gcodeManager = None
 userManager = None
 
@@ -37,7 +39,7 @@ user_permission = Permission(RoleNeed("user"))
 #~~ Printer state
 
 class PrinterStateConnection(tornadio2.SocketConnection):
-	def __init__(self, printer, gcodeManager, userManager, session, endpoint=None):
+	def __init__(self, printerRegistry, gcodeManager, userManager, session, endpoint=None):
 		tornadio2.SocketConnection.__init__(self, session, endpoint)
 
 		self._logger = logging.getLogger(__name__)
@@ -49,21 +51,28 @@ class PrinterStateConnection(tornadio2.SocketConnection):
 		self._messageBacklog = []
 		self._messageBacklogMutex = threading.Lock()
 
-		self._printer = printer
+		self._printerRegistry = printerRegistry
+		self._printer = None
 		self._gcodeManager = gcodeManager
 		self._userManager = userManager
 
 	def on_open(self, info):
-		self._logger.info("New connection from client")
-		# Use of global here is smelly
-		printer.registerCallback(self)
-		gcodeManager.registerCallback(self)
+		# clients pick the printer they want to follow with the printer argument, by default it's the default printer
+		printerId = info.get_argument("printer")
+		self._printer = self._printerRegistry.get(printerId)
+		if self._printer is None:
+			self._logger.info("New connection from client for unknown printer %s, closing it" % printerId)
+			return False
+
+		self._logger.info("New connection from client for printer %s" % self._printer.getId())
+		self._printer.registerCallback(self)
+		self._gcodeManager.registerCallback(self)
 
 	def on_close(self):
 		self._logger.info("Closed client connection")
-		# Use of global here is smelly
-		printer.unregisterCallback(self)
-		gcodeManager.unregisterCallback(self)
+		if self._printer is not None:
+			self._printer.unregisterCallback(self)
+		self._gcodeManager.unregisterCallback(self)
 
 	def on_message(self, message):
 		pass
@@ -114,6 +123,7 @@ def index():
 	return render_template(
 		"index.jinja2",
 		ajaxBaseUrl=BASEURL,
+		printerId=_getPrinter().getId(),
 		webcamStream=settings().get(["webcam", "stream"]),
 		enableTimelapse=(settings().get(["webcam", "snapshot"]) is not None and settings().get(["webcam", "ffmpeg"]) is not None),
 		enableGCodeVisualizer=settings().get(["feature", "gCodeVisualizer"]),
@@ -124,13 +134,35 @@ def index():
 
 #~~ Printer control
 
+def _getPrinter():
+	"""
+	 Returns the printer the current request is addressed to by its "printer" parameter, the default printer if there
+	 is none. Aborts the request if there is no such printer.
+	"""
+	printer = printerRegistry.get(request.values.get("printer", None))
+	if printer is None:
+		abort(404)
+	return printer
+
+@app.route(BASEURL + "printers", methods=["GET"])
+def getPrinters():
+	printers = []
+	for printer in printerRegistry.getAll():
+		printers.append({
+			"id": printer.getId(),
+			"name": printer.getName(),
+			"state": printer.getStateString()
+		})
+	return jsonify(printers=printers)
+
 @app.route(BASEURL + "control/connection/options", methods=["GET"])
 def connectionOptions():
-	return jsonify(getConnectionOptions())
+	return jsonify(getConnectionOptions(_getPrinter()))
 
 @app.route(BASEURL + "control/connection", methods=["POST"])
 @login_required
 def connect():
+	printer = _getPrinter()
 	if "command" in request.values.keys() and request.values["command"] == "connect":
 		port = None
 		baudrate = None
@@ -139,9 +171,7 @@ def connect():
 		if "baudrate" in request.values.keys():
 			baudrate = request.values["baudrate"]
 		if "save" in request.values.keys():
-			settings().set(["serial", "port"], port)
-			settings().setInt(["serial", "baudrate"], baudrate)
-			settings().save()
+			printerRegistry.saveConnectionPreference(printer, port, baudrate)
 		printer.connect(port=port, baudrate=baudrate)
 	elif "command" in request.values.keys() and request.values["command"] == "disconnect":
 		printer.disconnect()
@@ -151,6 +181,7 @@ def connect():
 @app.route(BASEURL + "control/command", methods=["POST"])
 @login_required
 def printerCommand():
+	printer = _getPrinter()
 	if "application/json" in request.headers["Content-Type"]:
 		data = request.json
 
@@ -175,6 +206,7 @@ def printerCommand():
 @app.route(BASEURL + "control/job", methods=["POST"])
 @login_required
 def printJobControl():
+	printer = _getPrinter()
 	if "command" in request.values.keys():
 		if request.values["command"] == "start":
 			printer.startPrint()
@@ -187,6 +219,7 @@ def printJobControl():
 @app.route(BASEURL + "control/temperature", methods=["POST"])
 @login_required
 def setTargetTemperature():
+	printer = _getPrinter()
 	if "temp" in request.values.keys():
 		# set target temperature
 		temp = request.values["temp"]
@@ -202,6 +235,7 @@ def setTargetTemperature():
 @app.route(BASEURL + "control/jog", methods=["POST"])
 @login_required
 def jog():
+	printer = _getPrinter()
 	if not printer.isOperational() or printer.isPrinting():
 		# do not jog when a print job is running or we don't have a connection
 		return jsonify(SUCCESS)
@@ -234,11 +268,13 @@ def jog():
 
 @app.route(BASEURL + "control/speed", methods=["GET"])
 def getSpeedValues():
+	printer = _getPrinter()
 	return jsonify(feedrate=printer.feedrateState())
 
 @app.route(BASEURL + "control/speed", methods=["POST"])
 @login_required
 def speed():
+	printer = _getPrinter()
 	if not printer.isOperational():
 		return jsonify(SUCCESS)
 
@@ -257,6 +293,7 @@ def getCustomControls():
 @app.route(BASEURL + "control/sd", methods=["POST"])
 @login_required
 def sdCommand():
+	printer = _getPrinter()
 	if not settings().getBoolean(["feature", "sdSupport"]) or not printer.isOperational() or printer.isPrinting():
 		return jsonify(SUCCESS)
 
@@ -276,16 +313,36 @@ def sdCommand():
 @app.route(BASEURL + "state", methods=["GET"])
 @login_required
 def getPrinterState():
+	printer = _getPrinter()
 	currentData = printer.getCurrentData()
 	currentData.update({
 		"temperatures": printer.getCurrentTemperatures()
 	})
 	return jsonify(currentData)
 
+@app.route(BASEURL + "state/serial", methods=["GET"])
+@login_required
+def getSerialStatistics():
+	printer = _getPrinter()
+	statistics = printer.getSerialStatistics()
+	if statistics is None:
+		return jsonify(SUCCESS)
+	return jsonify(statistics)
+
+@app.route(BASEURL + "state/serial/latency", methods=["GET"])
+@login_required
+def getLatencyStatistics():
+	printer = _getPrinter()
+	statistics = printer.getLatencyStatistics()
+	if statistics is None:
+		return jsonify(SUCCESS)
+	return jsonify(statistics)
+
 #~~ GCODE file handling
 
 @app.route(BASEURL + "gcodefiles", methods=["GET"])
 def readGcodeFiles():
+	printer = _getPrinter()
 	files = gcodeManager.getAllFileData()
 
 	sdFileList = printer.getSdFiles()
@@ -307,6 +364,7 @@ def readGcodeFile(filename):
 @app.route(BASEURL + "gcodefiles/upload", methods=["POST"])
 @login_required
 def uploadGcodeFile():
+	printer = _getPrinter()
 	filename = None
 	if "gcode_file" in request.files.keys():
 		file = request.files["gcode_file"]
@@ -318,6 +376,7 @@ def uploadGcodeFile():
 @app.route(BASEURL + "gcodefiles/load", methods=["POST"])
 @login_required
 def loadGcodeFile():
+	printer = _getPrinter()
 	if "filename" in request.values.keys():
 		printAfterLoading = False
 		if "print" in request.values.keys() and request.values["print"] in valid_boolean_trues:
@@ -335,6 +394,7 @@ def loadGcodeFile():
 @app.route(BASEURL + "gcodefiles/delete", methods=["POST"])
 @login_required
 def deleteGcodeFile():
+	printer = _getPrinter()
 	if "filename" in request.values.keys():
 		filename = request.values["filename"]
 		if "target" in request.values.keys() and request.values["target"] == "sd":
@@ -345,6 +405,7 @@ def deleteGcodeFile():
 
 @app.route(BASEURL + "gcodefiles/refresh", methods=["POST"])
 def refreshFiles():
+	printer = _getPrinter()
 	printer.updateSdFiles()
 	return jsonify(SUCCESS)
 
@@ -352,6 +413,7 @@ def refreshFiles():
 
 @app.route(BASEURL + "timelapse", methods=["GET"])
 def getTimelapseData():
+	printer = _getPrinter()
 	lapse = printer.getTimelapse()
 
 	type = "off"
@@ -391,6 +453,7 @@ def deleteTimelapse(filename):
 @app.route(BASEURL + "timelapse", methods=["POST"])
 @login_required
 def setTimelapseConfig():
+	printer = _getPrinter()
 	if request.values.has_key("type"):
 		type = request.values["type"]
 		lapse = None
@@ -695,10 +758,11 @@ class Server():
 		self._host = host
 		self._port = port
 		self._debug = debug
+		self._logListener = None
 
 	def run(self):
 		# Global as I can't work out a way to get it into PrinterStateConnection
-		global printer
+		global printerRegistry
 		global gcodeManager
 		global userManager
 
@@ -715,7 +779,7 @@ class Server():
 		logger = logging.getLogger(__name__)
 
 		gcodeManager = gcodefiles.GcodeManager()
-		printer = Printer(gcodeManager)
+		printerRegistry = PrinterRegistry(gcodeManager)
 
 		if settings().getBoolean(["accessControl", "enabled"]):
 			userManagerName = settings().get(["accessControl", "userManager"])
@@ -752,8 +816,8 @@ class Server():
 		IOLoop.instance().start()
 
 	def _createSocketConnection(self, session, endpoint=None):
-		global printer, gcodeManager, userManager
-		return PrinterStateConnection(printer, gcodeManager, userManager, session, endpoint)
+		global printerRegistry, gcodeManager, userManager
+		return PrinterStateConnection(printerRegistry, gcodeManager, userManager, session, endpoint)
 
 	def _initSettings(self, configfile, basedir):
 		s = settings(init=True, basedir=basedir, configfile=configfile)
@@ -806,6 +870,14 @@ class Server():
 
 		logging.config.dictConfig(config)
 
+		# formatting and writing of the log records is done in the background, so that logging doesn't stall the serial
+		# communication with disk I/O
+		self._logListener = logListener(init=True)
+		self._logListener.attach(logging.getLogger())
+		self._logListener.attach(logging.getLogger("SERIAL"))
+		self._logListener.start()
+		atexit.register(self._logListener.stop)
+
 if __name__ == "__main__":
 	octoprint = Server()
 	octoprint.run()
@@ -24,7 +24,57 @@ def settings(init=False, configfile=None, basedir=None):
 default_settings = {
 	"serial": {
 		"port": None,
-		"baudrate": None
+		"baudrate": None,
+		"sendQueueSize": 32,
+		"prepareLinesAhead": 100,
+		"resendHistorySize": 1000,
+		"autoreport": {
+			"enabled": True,
+			"temperatureInterval": 2,
+			"sdStatusInterval": 1
+		},
+		"temperaturePollInterval": {
+			"heating": 2,
+			"active": 5,
+			"idle": 10
+		},
+		"sdStatusPollInterval": 1,
+		"commandQueue": {
+			"maxWait": {
+				"interactive": 2.0,
+				"background": 10.0
+			}
+		},
+		"streaming": {
+			"enabled": False,
+			"windowLines": 4,
+			"rxBufferSize": 127
+		},
+		"detection": {
+			"bootTime": 2.5,
+			"handshakeTimeout": 0.5,
+			"remembered": {}
+		},
+		"simulation": {
+			"enabled": False,
+			"baudrate": 115200,
+			"rxBufferSize": 128,
+			"commandBufferSize": 4,
+			"plannerBufferSize": 16,
+			"responseLatency": 0.001,
+			"moveTimeScale": 1.0,
+			"errorRate": 0.0,
+			"seed": None
+		},
+		"recording": {
+			"enabled": False,
+			"maxSize": 10 * 1024 * 1024,
+			"backupCount": 5
+		},
+		"replay": {
+			"files": [],
+			"speed": 1.0
+		}
 	},
 	"server": {
 		"host": "0.0.0.0",
@@ -43,7 +93,8 @@ default_settings = {
 		"waitForWaitOnConnect": False,
 		"alwaysSendChecksum": False,
 		"resetLineNumbersWithPrefixedN": False,
-		"sdSupport": True
+		"sdSupport": True,
+		"memoryMappedPrintJobs": True
 	},
 	"folder": {
 		"uploads": None,
@@ -72,6 +123,7 @@ default_settings = {
 		"color": "default"
 	},
 	"controls": [],
+	"printers": [],
 	"system": {
 		"actions": []
 	},
@@ -183,6 +235,17 @@ class Settings(object):
 			self._logger.warn("Could not convert %r to a valid integer when getting option %r" % (value, path))
 			return None
 
+	def getFloat(self, path):
+		value = self.get(path)
+		if value is None:
+			return None
+
+		try:
+			return float(value)
+		except ValueError:
+			self._logger.warn("Could not convert %r to a valid float when getting option %r" % (value, path))
+			return None
+
 	def getBoolean(self, path):
 		value = self.get(path)
 		if value is None:
@@ -224,6 +224,9 @@ function PrinterStateViewModel(loginStateViewModel) {
     self.currentLine = ko.observable(undefined);
     self.totalLines = ko.observable(undefined);
     self.currentHeight = ko.observable(undefined);
+    self.currentLayer = ko.observable(undefined);
+    self.totalLayers = ko.observable(undefined);
+    self.layerProgress = ko.observable(undefined);
 
     self.lineString = ko.computed(function() {
         if (!self.totalLines())
@@ -236,6 +239,13 @@ function PrinterStateViewModel(loginStateViewModel) {
             return "-";
         return self.currentHeight();
     })
+    self.layerString = ko.computed(function() {
+        if (!self.totalLayers())
+            return "-";
+        var currentLayer = self.currentLayer() ? self.currentLayer() : "-";
+        var layerProgress = self.layerProgress() !== undefined ? " (" + self.layerProgress() + "%)" : "";
+        return currentLayer + " / " + self.totalLayers() + layerProgress;
+    });
     self.progressString = ko.computed(function() {
         if (!self.progress())
             return 0;
@@ -298,7 +308,11 @@ function PrinterStateViewModel(loginStateViewModel) {
     self._processSdUploadData = function(data) {
         if (self.isLoading()) {
             var progress = Math.round(data.progress * 100);
-            self.filename("Streaming... (" + progress + "%)");
+            if (data.bytesPerSecond) {
+                self.filename("Streaming... (" + progress + "%, " + Math.round(data.bytesPerSecond / 1024) + " KB/s)");
+            } else {
+                self.filename("Streaming... (" + progress + "%)");
+            }
         }
     }
 
@@ -311,6 +325,15 @@ function PrinterStateViewModel(loginStateViewModel) {
         self.currentLine(data.currentLine);
         self.printTime(data.printTime);
         self.printTimeLeft(data.printTimeLeft);
+        if (data.layer) {
+            self.currentLayer(data.layer.current);
+            self.totalLayers(data.layer.total);
+            self.layerProgress(data.layer.current ? Math.round(data.layer.progress * 100) : undefined);
+        } else {
+            self.currentLayer(undefined);
+            self.totalLayers(undefined);
+            self.layerProgress(undefined);
+        }
     }
 
     self._processZData = function(data) {
@@ -1495,7 +1518,7 @@ function DataUpdater(loginStateViewModel, connectionViewModel, printerStateViewM
     self.timelapseViewModel = timelapseViewModel;
     self.gcodeViewModel = gcodeViewModel;
 
-    self._socket = io.connect();
+    self._socket = io.connect(undefined, PRINTER_ID ? {query: "printer=" + encodeURIComponent(PRINTER_ID)} : undefined);
     self._socket.on("connect", function() {
         if ($("#offline_overlay").is(":visible")) {
             $("#offline_overlay").hide();
@@ -1824,6 +1847,17 @@ function AppearanceViewModel(settingsViewModel) {
 
 $(function() {
 
+        //~~ Printer selection
+
+        // a page opened for a printer other than the default one addresses all its requests to that printer
+        if (PRINTER_ID) {
+            $.ajaxPrefilter(function(options) {
+                if (options.url.indexOf(AJAX_BASEURL) == 0) {
+                    options.url += (options.url.indexOf("?") < 0 ? "?" : "&") + "printer=" + encodeURIComponent(PRINTER_ID);
+                }
+            });
+        }
+
         //~~ View models
         var loginStateViewModel = new LoginStateViewModel(loginStateViewModel);
         var usersViewModel = new UsersViewModel(loginStateViewModel);
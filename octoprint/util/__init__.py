@@ -3,6 +3,7 @@ __author__ = "Gina Häußge <osd@foosel.net>"
 __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
 
 import re
+import string
 
 def getFormattedSize(num):
 	"""
@@ -43,4 +44,190 @@ def getClass(name):
 	return m
 
 def matchesGcode(line, gcode):
-	return re.search("^\s*%s\D" % gcode, line, re.I)
\ No newline at end of file
+	"""
+	 Returns whether line, a str or a GcodeLine, is the G-code command gcode, e.g. "M110".
+	"""
+	if not isinstance(line, GcodeLine):
+		line = parseGcode(line)
+	return line.matches(gcode)
+
+#~~ G-code parsing
+
+_gcodeHeadPattern = re.compile("\s*(?:[Nn](-?\d+)\s*)?(?:([A-Za-z]\d+)(?:\.(\d+))?)?")
+_gcodeParameterPattern = re.compile("([A-Za-z])\s*([^A-Za-z\s]*)")
+_gcodeLetterPatterns = dict((letter, re.compile(letter + "\s*([^A-Z\s]*)")) for letter in string.ascii_uppercase)
+_gcodeCommands = {}
+
+def stripGcodeComment(line):
+	"""
+	 Returns line without its comment and surrounding whitespace, like parseGcode leaves it.
+	"""
+	if ";" in line:
+		line = line[:line.find(";")]
+	return line.strip()
+
+def parseGcode(line):
+	"""
+	 Parses a line of G-code into a GcodeLine. Only the line number, the command, the checksum and the comment are
+	 split off right away, the parameters are parsed once they are asked for, see GcodeLine.parameters.
+	"""
+	comment = None
+	if ";" in line:
+		position = line.find(";")
+		comment = line[position + 1:].strip()
+		line = line[:position]
+
+	checksum = None
+	if "*" in line:
+		position = line.rfind("*")
+		value = line[position + 1:].strip()
+		if value.isdigit():
+			checksum = int(value)
+			line = line[:position]
+
+	match = _gcodeHeadPattern.match(line)
+	(lineNumber, code, subcode) = match.groups()
+	if lineNumber is not None:
+		lineNumber = int(lineNumber)
+	if code is not None:
+		if code[0] >= "a":
+			code = code.upper()
+		if code[1] == "0" and len(code) > 2:
+			# G01 is G1
+			code = code[0] + str(int(code[1:]))
+	return GcodeLine(lineNumber, code, subcode, line, match.end(), comment, checksum)
+
+class GcodeLine(object):
+	"""
+	 A line of G-code as parsed by parseGcode:
+
+	 <ul>
+	   <li>lineNumber: the N the line is prefixed with, None if there is none</li>
+	   <li>command: the command, normalized like "G1" for "g01", with the subcode of commands like "G29.1". None if
+	       the line holds no command. Its parts are available as letter, number and subcode</li>
+	   <li>arguments: everything after the command up to the checksum or comment, stripped</li>
+	   <li>parameters: the parameter letters in the arguments mapped to their values as str, "" for a letter without
+	       value. Only the first one counts if a letter occurs more than once</li>
+	   <li>comment: the comment after the ";" stripped, None if there is none</li>
+	   <li>checksum: the checksum after the "*", None if there is none</li>
+	 </ul>
+	"""
+
+	__slots__ = ("lineNumber", "command", "comment", "checksum", "_code", "_subcode", "_line", "_arguments", "_parameters")
+
+	def __init__(self, lineNumber, code, subcode, line, arguments, comment, checksum):
+		self.lineNumber = lineNumber
+		if subcode is None:
+			self.command = code
+		else:
+			self.command = "%s.%s" % (code, subcode)
+		self.comment = comment
+		self.checksum = checksum
+		self._code = code
+		self._subcode = subcode
+		# the arguments start at that position of line, cut out only once they're needed
+		self._line = line
+		self._arguments = arguments
+		self._parameters = None
+
+	@property
+	def arguments(self):
+		return self._line[self._arguments:].strip()
+
+	@property
+	def letter(self):
+		if self._code is None:
+			return None
+		return self._code[0]
+
+	@property
+	def number(self):
+		if self._code is None:
+			return None
+		return int(self._code[1:])
+
+	@property
+	def subcode(self):
+		if self._subcode is None:
+			return None
+		return int(self._subcode)
+
+	@property
+	def parameters(self):
+		if self._parameters is None:
+			parameters = _gcodeParameterPattern.findall(self._line.upper(), self._arguments)
+			self._parameters = dict(parameters)
+			if len(self._parameters) < len(parameters):
+				# a letter occurs more than once, the first one has to win
+				self._parameters = dict(reversed(parameters))
+		return self._parameters
+
+	def matches(self, gcode):
+		"""
+		 Returns whether the line is the command gcode, e.g. "M110". A command without subcode matches all of its
+		 subcodes, so "G29" matches "G29.1" too.
+		"""
+		target = _gcodeCommands.get(gcode)
+		if target is None:
+			parsed = parseGcode(gcode)
+			target = (parsed._code, parsed._subcode)
+			_gcodeCommands[gcode] = target
+		return self._code == target[0] and self._code is not None and (target[1] is None or self._subcode == target[1])
+
+	def getValue(self, letter):
+		"""
+		 Returns the value of the parameter letter as str, the number of the command if letter is the command's letter,
+		 None if there is neither.
+		"""
+		parameters = self._parameters
+		if parameters is None:
+			parameters = self.parameters
+		value = parameters.get(letter)
+		if value is None and self._code is not None and self._code[0] == letter:
+			value = self.command[1:]
+		return value
+
+	def getFloat(self, letter, default=None):
+		parameters = self._parameters
+		if parameters is None:
+			parameters = self.parameters
+		value = parameters.get(letter)
+		if value is None:
+			if self._code is None or self._code[0] != letter:
+				return default
+			value = self.command[1:]
+		try:
+			return float(value)
+		except ValueError:
+			return default
+
+	def getFloats(self, *letters):
+		"""
+		 Returns the values of all the parameters letters like getFloat does, with None for the missing ones. Saves the
+		 calls for every single one when a lot of lines need several of them, like moves do.
+		"""
+		if self._parameters is not None or (self._code is not None and self._code[0] in letters):
+			return [self.getFloat(letter) for letter in letters]
+
+		# every letter starts a parameter, so the first match of the letter is what parameters would hold for it, and
+		# that's a lot cheaper to find than all of them when only a few are needed
+		line = self._line.upper()
+		start = self._arguments
+		try:
+			matches = [_gcodeLetterPatterns[letter].search(line, start) for letter in letters]
+			return [float(match.group(1)) if match is not None else None for match in matches]
+		except (KeyError, ValueError):
+			# not a parameter letter or not a number, rare enough to not bother with doing it faster
+			return [self.getFloat(letter) for letter in letters]
+
+	def getInt(self, letter, default=None):
+		value = self.getValue(letter)
+		if value is None:
+			return default
+		try:
+			return int(value)
+		except ValueError:
+			return default
+
+	def __repr__(self):
+		return "GcodeLine(%r, %r, %r, %r, %r)" % (self.lineNumber, self.command, self.arguments, self.comment, self.checksum)
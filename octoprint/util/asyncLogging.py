@@ -0,0 +1,132 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import logging
+import threading
+import Queue
+
+instance = None
+
+def logListener(init=False):
+	"""
+	 Returns the LogListener of the server, creating it if init is set. Returns None if there is none, everything
+	 meant to be deferred to it has to be done right away then.
+	"""
+	global instance
+	if instance is None and init:
+		instance = LogListener()
+	return instance
+
+class QueueHandler(logging.Handler):
+	"""
+	 Logging handler that doesn't emit anything itself but only hands the unformatted log records over to a queue,
+	 together with the handlers that are supposed to actually output them. That is as cheap as it gets for the logging
+	 thread, formatting and I/O are done by a LogListener in the background.
+	"""
+
+	def __init__(self, queue, targets):
+		logging.Handler.__init__(self)
+		self._queue = queue
+		self._targets = targets
+
+		# no need to queue anything that none of the targets would output anyway
+		if len(targets) > 0:
+			self.setLevel(min(map(lambda x: x.level, targets)))
+
+	def prepare(self, record):
+		"""
+		 Merges message and arguments of the record and turns exception info into text, so that arguments changing
+		 before the listener gets to the record don't change what is logged. Formatting is still left to the targets.
+		"""
+		record.msg = record.getMessage()
+		record.args = None
+		if record.exc_info:
+			if not record.exc_text:
+				record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+		return record
+
+	def emit(self, record):
+		try:
+			self._queue.put((self._output, (self._targets, self.prepare(record))))
+		except Exception:
+			self.handleError(record)
+
+	@staticmethod
+	def _output(targets, record):
+		for handler in targets:
+			if record.levelno >= handler.level:
+				handler.handle(record)
+
+class LogListener(object):
+	"""
+	 Takes over the handlers of loggers, replacing them with a QueueHandler, and outputs the queued records through the
+	 original handlers on a background thread. Records are processed in batches of everything that got queued since
+	 the last wakeup.
+
+	 Output that doesn't go through a logger, like the serial log shown in the UI, can be deferred to the same thread
+	 with defer, in order with the log records.
+	"""
+
+	def __init__(self):
+		self._queue = Queue.Queue()
+		self._thread = None
+
+	def attach(self, logger):
+		targets = list(logger.handlers)
+		if len(targets) == 0:
+			return
+
+		for handler in targets:
+			logger.removeHandler(handler)
+		logger.addHandler(QueueHandler(self._queue, targets))
+
+	def defer(self, function, *args):
+		"""
+		 Calls function with args on the background thread, right away if that isn't running.
+		"""
+		if self._thread is None:
+			function(*args)
+		else:
+			self._queue.put((function, args))
+
+	def start(self):
+		if self._thread is not None:
+			return
+		self._thread = threading.Thread(target=self._work)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		"""
+		 Outputs everything still queued and stops the background thread.
+		"""
+		if self._thread is None:
+			return
+		self._queue.put(None)
+		self._thread.join()
+		self._thread = None
+
+	def _work(self):
+		while True:
+			batch = [self._queue.get()]
+			try:
+				while True:
+					batch.append(self._queue.get_nowait())
+			except Queue.Empty:
+				pass
+
+			stopped = False
+			for item in batch:
+				if item is None:
+					stopped = True
+					continue
+				(function, args) = item
+				try:
+					function(*args)
+				except Exception:
+					logging.getLogger(__name__).exception("Error while outputting in the background")
+
+			if stopped:
+				return
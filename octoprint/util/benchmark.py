@@ -0,0 +1,98 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+# Micro benchmarks for the hot paths of the printer communication.
+#
+# Usage: python -m octoprint.util.benchmark [iterations]
+
+import sys
+import timeit
+
+from octoprint.util.comm import ResponseClassifier, TemperatureParser, LineReader
+
+# a representative mix of what a Marlin based printer sends back during a print, with acknowledgements dominating
+responseSamples = [
+	"ok\n",
+	"ok\n",
+	"ok\n",
+	"ok\n",
+	"ok\n",
+	"ok\n",
+	"ok T:210.3 /210.0 B:60.1 /60.0 @:64\n",
+	"T:180.2 E:0 W:?\n",
+	"Resend: 123\n",
+	"Error:checksum mismatch, Last Line: 122\n",
+	"echo:SD card ok\n",
+	"SD printing byte 1234/56789\n",
+	"echo:Unknown command:\"\"\n",
+	"Marlin: 1.0.0\n",
+	"\n"
+]
+
+temperatureSamples = [
+	"ok T:210.3 /210.0 B:60.1 /60.0 @:64\n",
+	"ok T:210.3 /210.0 B:60.1 /60.0 T0:210.3 /210.0 T1:180.5 /185.0 T2:20.1 /0.0 @:64 B@:127\n",
+	"ok T:210.3 /210.0 B:60.1 /60.0 T0:210.3 /210.0 T1:180.5 /185.0 C:35.2 /40.0 @:64 B@:127 @0:64 @1:32\n",
+	"T:180.2 E:0 W:?\n"
+]
+
+def benchmarkResponseClassifier(iterations):
+	classifier = ResponseClassifier()
+
+	results = []
+	for sample in responseSamples:
+		duration = timeit.timeit(lambda: classifier.classify(sample), number=iterations)
+		results.append((sample, classifier.classify(sample)[0], duration * 1000000000.0 / iterations))
+	return results
+
+def benchmarkTemperatureParser(iterations):
+	parser = TemperatureParser()
+
+	results = []
+	for sample in temperatureSamples:
+		duration = timeit.timeit(lambda: parser.parse(sample), number=iterations)
+		results.append((sample, len(parser.parse(sample)), duration * 1000000000.0 / iterations))
+	return results
+
+def benchmarkLineReader(iterations):
+	"""
+	 Feeds the response samples to a LineReader in chunks of different sizes, as they would arrive from the serial port
+	 under different loads, and returns tuples (chunk size, ns per line).
+	"""
+	data = "".join(responseSamples)
+
+	results = []
+	for chunkSize in (1, 16, 64, len(data)):
+		chunks = [data[i:i + chunkSize] for i in range(0, len(data), chunkSize)]
+		reader = LineReader()
+		def feedAll():
+			for chunk in chunks:
+				reader.feed(chunk)
+		duration = timeit.timeit(feedAll, number=iterations / 10)
+		results.append((chunkSize, duration * 1000000000.0 / (iterations / 10) / len(responseSamples)))
+	return results
+
+def main(args):
+	iterations = 100000
+	if len(args) > 0:
+		iterations = int(args[0])
+
+	print "Response classifier, %d iterations per line:" % iterations
+	results = benchmarkResponseClassifier(iterations)
+	for (sample, responseType, nsPerLine) in results:
+		print "  %-45s %-20s %8.0f ns/line" % (repr(sample), responseType, nsPerLine)
+	print "  %-66s %8.0f ns/line" % ("mean", sum(map(lambda x: x[2], results)) / len(results))
+
+	print "Line reader, %d iterations over all response samples:" % (iterations / 10)
+	for (chunkSize, nsPerLine) in benchmarkLineReader(iterations):
+		print "  chunks of %-4d bytes %8.0f ns/line" % (chunkSize, nsPerLine)
+
+	print "Temperature parser, %d iterations per report:" % iterations
+	for (sample, heaters, nsPerLine) in benchmarkTemperatureParser(iterations):
+		print "  %-45s %2d heaters %8.0f ns/line" % (repr(sample)[:45], heaters, nsPerLine)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -10,13 +10,18 @@ import traceback
 import threading
 import Queue as queue
 import logging
+import collections
+import select
+import heapq
+import random
+import bisect
 
 import serial
 
-from octoprint.util.avr_isp import stk500v2
-from octoprint.util.avr_isp import ispBase
-
-from octoprint.util import matchesGcode
+from octoprint.util import matchesGcode, parseGcode
+from octoprint.util.printJob import PrintJob, ListPrintJob, applyFeedrateModifier, LINE_OTHER, LINE_PAUSE, LINE_MOVE_Z, LINE_IRREGULAR
+from octoprint.util.serialRecording import SessionRecorder, RecordedPrinter
+from octoprint.util.asyncLogging import logListener
 
 from octoprint.settings import settings
 
@@ -25,6 +30,11 @@ try:
 except:
 	pass
 
+try:
+	import fcntl
+except:
+	pass
+
 def isDevVersion():
 	gitPath = os.path.abspath(os.path.join(os.path.split(os.path.abspath(__file__))[0], "../../.git"))
 	return os.path.exists(gitPath)
@@ -84,6 +94,21 @@ class VirtualPrinter():
 
 		self.currentLine = 0
 
+		self._temperatureAutoreportInterval = 0
+		self._temperatureAutoreporter = None
+
+		# signals the reading side that there's a new response
+		self._written = threading.Event()
+
+		# byte stream view on the responses for read, with a pipe to wake up select once there's something to read
+		self._readBuffer = ""
+		self._readMutex = threading.Lock()
+		if os.name == "nt":
+			self._notificationPipe = None
+		else:
+			self._notificationPipe = os.pipe()
+			fcntl.fcntl(self._notificationPipe[0], fcntl.F_SETFL, fcntl.fcntl(self._notificationPipe[0], fcntl.F_GETFL) | os.O_NONBLOCK)
+
 		waitThread = threading.Thread(target=self._sendWaitAfterTimeout)
 		waitThread.start()
 
@@ -91,99 +116,134 @@ class VirtualPrinter():
 		if self.readList is None:
 			return
 
-		# shortcut for writing to SD
-		if self._writingToSd and not self._selectedSdFile is None and not "M29" in data:
+		gcode = parseGcode(data)
+		command = gcode.command
+
+		# shortcut for writing to SD, like Marlin strip line number and checksum and acknowledge every line
+		if self._writingToSd and not self._selectedSdFile is None and command != "M29":
+			if data.startswith("N") and "*" in data:
+				data = data[data.index(" ") + 1:data.rindex("*")] + "\n"
 			with open(self._selectedSdFile, "a") as f:
 				f.write(data)
+			self._send("ok")
 			return
 
 		#print "Send: %s" % (data.rstrip())
-		if 'M104' in data or 'M109' in data:
-			try:
-				self.targetTemp = float(re.search('S([0-9]+)', data).group(1))
-			except:
-				pass
-		if 'M140' in data or 'M190' in data:
-			try:
-				self.bedTargetTemp = float(re.search('S([0-9]+)', data).group(1))
-			except:
-				pass
+		if command == "M104" or command == "M109":
+			self.targetTemp = gcode.getFloat("S", self.targetTemp)
+		if command == "M140" or command == "M190":
+			self.bedTargetTemp = gcode.getFloat("S", self.bedTargetTemp)
 
-		if 'M105' in data:
+		if command == "M105":
 			# send simulated temperature data
-			self.readList.append("ok T:%.2f /%.2f B:%.2f /%.2f @:64\n" % (self.temp, self.targetTemp, self.bedTemp, self.bedTargetTemp))
-		elif 'M20' in data:
+			self._send("ok " + self._temperatureReport())
+		elif command == "M115":
+			# report firmware info and capabilities like Marlin does
+			self._send("FIRMWARE_NAME:Virtual Marlin PROTOCOL_VERSION:1.0 MACHINE_TYPE:Virtual EXTRUDER_COUNT:1")
+			self._send("Cap:AUTOREPORT_TEMP:1")
+			self._send("Cap:AUTOREPORT_SD_STATUS:0")
+			self._send("ok")
+		elif command == "M155":
+			self._temperatureAutoreportInterval = gcode.getInt("S", self._temperatureAutoreportInterval)
+			if self._temperatureAutoreportInterval > 0 and self._temperatureAutoreporter is None:
+				self._temperatureAutoreporter = threading.Thread(target=self._temperatureAutoreportWorker)
+				self._temperatureAutoreporter.daemon = True
+				self._temperatureAutoreporter.start()
+			self._send("ok")
+		elif command == "M20":
 			if self._sdCardReady:
 				self._listSd()
-		elif 'M21' in data:
+		elif command == "M21":
 			self._sdCardReady = True
-			self.readList.append("SD card ok")
-		elif 'M22' in data:
+			self._send("SD card ok")
+			self._send("ok")
+		elif command == "M22":
 			self._sdCardReady = False
-		elif 'M23' in data:
+			self._send("ok")
+		elif command == "M23":
 			if self._sdCardReady:
-				filename = data.split(None, 1)[1].strip()
-				self._selectSdFile(filename)
-		elif 'M24' in data:
+				self._selectSdFile(gcode.arguments)
+		elif command == "M24":
 			if self._sdCardReady:
 				self._startSdPrint()
-		elif 'M25' in data:
+		elif command == "M25":
 			if self._sdCardReady:
 				self._pauseSdPrint()
-		elif 'M26' in data:
-			if self._sdCardReady:
-				pos = int(re.search("S([0-9]+)", data).group(1))
+		elif command == "M26":
+			pos = gcode.getInt("S")
+			if self._sdCardReady and pos is not None:
 				self._setSdPos(pos)
-		elif 'M27' in data:
+		elif command == "M27":
 			if self._sdCardReady:
 				self._reportSdStatus()
-		elif 'M28' in data:
+		elif command == "M28":
 			if self._sdCardReady:
-				filename = data.split(None, 1)[1].strip()
-				self._writeSdFile(filename)
-		elif 'M29' in data:
+				self._writeSdFile(gcode.arguments)
+		elif command == "M29":
 			if self._sdCardReady:
 				self._finishSdFile()
-		elif 'M30' in data:
+		elif command == "M30":
 			if self._sdCardReady:
-				filename = data.split(None, 1)[1].strip()
-				self._deleteSdFile(filename)
-		elif "M110" in data:
+				self._deleteSdFile(gcode.arguments)
+		elif command == "M110":
 			# reset current line
-			self.currentLine = int(re.search('N([0-9]+)', data).group(1))
-			self.readList.append("ok\n")
-		elif "M114" in data:
+			self.currentLine = gcode.getInt("N", 0)
+			self._send("ok\n")
+		elif command == "M114":
 			# send dummy position report
-			self.readList.append("ok C: X:10.00 Y:3.20 Z:5.20 E:1.24")
-		elif "M999" in data:
+			self._send("ok C: X:10.00 Y:3.20 Z:5.20 E:1.24")
+		elif command == "M999":
 			# mirror Marlin behaviour
-			self.readList.append("Resend: 1")
+			self._send("Resend: 1")
 		elif self.currentLine == 100:
-			# simulate a resend at line 100 of the last 5 lines
-			self.readList.append("Error: Line Number is not Last Line Number\n")
-			self.readList.append("rs %d\n" % (self.currentLine - 5))
+			# simulate a resend at line 100 of the last 5 lines, acknowledging the faulty line afterwards just like Marlin does
+			self._send("Error: Line Number is not Last Line Number\n")
+			self._send("rs %d\n" % (self.currentLine - 5))
+			self._send("ok\n")
 		elif len(data.strip()) > 0:
-			self.readList.append("ok\n")
+			self._send("ok\n")
 
-		if "*" in data:
+		if gcode.checksum is not None:
 			self.currentLine += 1
 
+	def _send(self, line):
+		if self.readList is None:
+			return
+		self.readList.append(line)
+		self._written.set()
+		if self._notificationPipe is not None:
+			try:
+				os.write(self._notificationPipe[1], "x")
+			except OSError:
+				# we got closed in the meantime
+				pass
+
+	def _temperatureReport(self):
+		return "T:%.2f /%.2f B:%.2f /%.2f @:64\n" % (self.temp, self.targetTemp, self.bedTemp, self.bedTargetTemp)
+
+	def _temperatureAutoreportWorker(self):
+		while self.readList is not None and self._temperatureAutoreportInterval > 0:
+			time.sleep(self._temperatureAutoreportInterval)
+			self._send(self._temperatureReport())
+		self._temperatureAutoreporter = None
+
 	def _listSd(self):
-		self.readList.append("Begin file list")
+		self._send("Begin file list")
 		for osFile in os.listdir(self._virtualSd):
-			self.readList.append(osFile.upper())
-		self.readList.append("End file list")
-		self.readList.append("ok")
+			self._send(osFile.upper())
+		self._send("End file list")
+		self._send("ok")
 
 	def _selectSdFile(self, filename):
-		file = os.path.join(self._virtualSd, filename).lower()
+		file = os.path.join(self._virtualSd, filename.lower())
 		if not os.path.exists(file) or not os.path.isfile(file):
-			self.readList.append("open failed, File: %s." % filename)
+			self._send("open failed, File: %s." % filename)
 		else:
 			self._selectedSdFile = file
 			self._selectedSdFileSize = os.stat(file).st_size
-			self.readList.append("File opened: %s  Size: %d" % (filename, self._selectedSdFileSize))
-			self.readList.append("File selected")
+			self._send("File opened: %s  Size: %d" % (filename, self._selectedSdFileSize))
+			self._send("File selected")
+		self._send("ok")
 
 	def _startSdPrint(self):
 		if self._selectedSdFile is not None:
@@ -191,37 +251,38 @@ class VirtualPrinter():
 				self._sdPrinter = threading.Thread(target=self._sdPrintingWorker)
 				self._sdPrinter.start()
 		self._sdPrintingSemaphore.set()
-		self.readList.append("ok")
+		self._send("ok")
 
 	def _pauseSdPrint(self):
 		self._sdPrintingSemaphore.clear()
-		self.readList.append("ok")
+		self._send("ok")
 
 	def _setSdPos(self, pos):
 		self._newSdFilePos = pos
 
 	def _reportSdStatus(self):
 		if self._sdPrinter is not None and self._sdPrintingSemaphore.is_set:
-			self.readList.append("SD printing byte %d/%d" % (self._selectedSdFilePos, self._selectedSdFileSize))
+			self._send("SD printing byte %d/%d" % (self._selectedSdFilePos, self._selectedSdFileSize))
 		else:
-			self.readList.append("Not SD printing")
+			self._send("Not SD printing")
+		self._send("ok")
 
 	def _writeSdFile(self, filename):
-		file = os.path.join(self._virtualSd, filename).lower()
+		file = os.path.join(self._virtualSd, filename.lower())
 		if os.path.exists(file):
 			if os.path.isfile(file):
 				os.remove(file)
 			else:
-				self.readList.append("error writing to file")
+				self._send("error writing to file")
 
 		self._writingToSd = True
 		self._selectedSdFile = file
-		self.readList.append("ok")
+		self._send("ok")
 
 	def _finishSdFile(self):
 		self._writingToSd = False
 		self._selectedSdFile = None
-		self.readList.append("ok")
+		self._send("Done saving file.")
 
 	def _sdPrintingWorker(self):
 		self._selectedSdFilePos = 0
@@ -239,34 +300,26 @@ class VirtualPrinter():
 				self._sdPrintingSemaphore.wait()
 
 				# set target temps
-				if 'M104' in line or 'M109' in line:
-					try:
-						self.targetTemp = float(re.search('S([0-9]+)', line).group(1))
-					except:
-						pass
-				if 'M140' in line or 'M190' in line:
-					try:
-						self.bedTargetTemp = float(re.search('S([0-9]+)', line).group(1))
-					except:
-						pass
+				gcode = parseGcode(line)
+				if gcode.command == "M104" or gcode.command == "M109":
+					self.targetTemp = gcode.getFloat("S", self.targetTemp)
+				if gcode.command == "M140" or gcode.command == "M190":
+					self.bedTargetTemp = gcode.getFloat("S", self.bedTargetTemp)
 
 				time.sleep(0.01)
 
 		self._sdPrintingSemaphore.clear()
 		self._selectedSdFilePos = 0
 		self._sdPrinter = None
-		self.readList.append("Done printing file")
+		self._send("Done printing file")
 
 	def _deleteSdFile(self, filename):
 		file = os.path.join(self._virtualSd, filename)
 		if os.path.exists(file) and os.path.isfile(file):
 			os.remove(file)
-		self.readList.append("ok")
+		self._send("ok")
 
-	def readline(self):
-		if self.readList is None:
-			return ''
-		n = 0
+	def _updateTemperatures(self):
 		timeDiff = self.lastTempAt - time.time()
 		self.lastTempAt = time.time()
 		if abs(self.temp - self.targetTemp) > 1:
@@ -277,28 +330,1490 @@ class VirtualPrinter():
 			self.bedTemp += math.copysign(timeDiff * 10, self.bedTargetTemp - self.bedTemp)
 			if self.bedTemp < 0:
 				self.bedTemp = 0
+
+	def fileno(self):
+		if self._notificationPipe is None:
+			raise IOError("No file descriptor available on this platform")
+		return self._notificationPipe[0]
+
+	def inWaiting(self):
+		with self._readMutex:
+			self._fillReadBuffer()
+			return len(self._readBuffer)
+
+	def read(self, size=1):
+		with self._readMutex:
+			self._fillReadBuffer()
+			data = self._readBuffer[:size]
+			self._readBuffer = self._readBuffer[size:]
+			return data
+
+	def _fillReadBuffer(self):
+		if self.readList is None:
+			return
+		self._updateTemperatures()
+
+		if self._notificationPipe is not None:
+			# drain the notifications, we are collecting everything that's there anyway
+			try:
+				while len(os.read(self._notificationPipe[0], 4096)) == 4096:
+					pass
+			except OSError:
+				pass
+
+		while len(self.readList) > 0:
+			line = self.readList.pop(0)
+			if not line.endswith("\n"):
+				line += "\n"
+			self._readBuffer += line
+
+	def readline(self):
+		if self.readList is None:
+			return ''
+		self._updateTemperatures()
+		timeout = time.time() + 2
 		while len(self.readList) < 1:
-			time.sleep(0.1)
-			n += 1
-			if n == 20:
+			# responses usually get triggered by writes, so wait for one of those instead of sleeping for a fixed time
+			self._written.wait(0.1)
+			self._written.clear()
+			if time.time() > timeout:
 				return ''
 			if self.readList is None:
 				return ''
-		time.sleep(0.001)
 		return self.readList.pop(0)
 	
 	def close(self):
 		self.readList = None
+		if self._notificationPipe is not None:
+			# closing the pipe wakes up anyone waiting for data, they'll see that we are closed now
+			for fd in self._notificationPipe:
+				os.close(fd)
+			self._notificationPipe = None
 
 	def _sendWaitAfterTimeout(self, timeout=5):
 		time.sleep(timeout)
-		self.readList.append("wait")
+		self._send("wait")
+
+def createVirtualPrinter():
+	"""
+	 Returns the printer behind the VIRTUAL port: a RecordedPrinter replaying the recordings in serial.replay.files if
+	 there are any, a SimulatedPrinter if the simulation is enabled in the settings, otherwise a plain VirtualPrinter.
+	"""
+	replayFiles = settings().get(["serial", "replay", "files"])
+	if replayFiles:
+		return RecordedPrinter(replayFiles, settings().getFloat(["serial", "replay", "speed"]))
+	if settings().getBoolean(["serial", "simulation", "enabled"]):
+		return SimulatedPrinter()
+	return VirtualPrinter()
+
+class SimulatedPrinter(VirtualPrinter):
+	"""
+	 A VirtualPrinter that behaves like a real printer running Marlin timing wise, for measuring what the host side
+	 manages to push through. Configured by the serial simulation settings, it simulates
+
+	 <ul>
+	   <li>the serial line: all data takes as long to transfer as it would at the configured baudrate, in both
+	       directions, and every response is delayed by responseLatency seconds</li>
+	   <li>the receive buffer of the firmware: received lines wait in it (rxBufferSize bytes) until there's room in the
+	       command buffer (commandBufferSize lines), lines that don't fit into it any more are lost</li>
+	   <li>line numbers and checksums: they are checked like Marlin does, errors are answered with an error message, a
+	       resend request and an ok, and any numbered line gets treated as corrupted with a probability of errorRate</li>
+	   <li>the planner: moves take as long as their distance and feedrate say (scaled by moveTimeScale, without
+	       accelerations), a move is only acknowledged once there's room for it in the planner (plannerBufferSize
+	       moves), M400 and G4 wait for all moves to finish</li>
+	   <li>heating up: M109 and M190 only get acknowledged once the target temperature is reached, reporting the
+	       temperature every second in the meantime</li>
+	 </ul>
+
+	 Everything happens at the time it's due on the simulator's own thread, driven by a heap of scheduled events.
+	"""
+
+	_lineNumber = re.compile("^N(-?\d+)\s*")
+
+	def __init__(self):
+		VirtualPrinter.__init__(self)
+
+		self._logger = logging.getLogger(__name__)
+
+		baudrate = settings().getInt(["serial", "simulation", "baudrate"])
+		if baudrate > 0:
+			# 8 data bits plus start and stop bit
+			self._bytesPerSecond = baudrate / 10.0
+		else:
+			self._bytesPerSecond = None
+		self._rxBufferSize = settings().getInt(["serial", "simulation", "rxBufferSize"])
+		self._commandBufferSize = settings().getInt(["serial", "simulation", "commandBufferSize"])
+		self._plannerBufferSize = settings().getInt(["serial", "simulation", "plannerBufferSize"])
+		self._responseLatency = settings().getFloat(["serial", "simulation", "responseLatency"])
+		self._moveTimeScale = settings().getFloat(["serial", "simulation", "moveTimeScale"])
+		self._errorRate = settings().getFloat(["serial", "simulation", "errorRate"])
+		self._random = random.Random(settings().get(["serial", "simulation", "seed"]))
+
+		# the serial line, the times until which each direction is busy transferring
+		self._rxFreeAt = 0
+		self._txFreeAt = 0
+
+		# the firmware, the lines in the receive buffer, the commands in the command buffer and the end times of the
+		# moves in the planner
+		self._rxLines = collections.deque()
+		self._rxBytes = 0
+		self._commands = collections.deque()
+		self._blockedUntil = None
+		self._dwellUntil = None
+		self._moveEnds = collections.deque()
+		self._lastLineNumber = 0
+
+		# the machine
+		self._position = [0.0, 0.0, 0.0, 0.0]
+		self._feedrate = 3000.0
+		self._relative = False
+
+		self._statistics = {"received": 0, "lost": 0, "errors": 0, "moves": 0}
+
+		self._events = []
+		self._eventSequence = 0
+		self._eventsMutex = threading.Lock()
+		self._wakeupEvent = threading.Event()
+		if os.name == "nt":
+			self._wakeupPipe = None
+		else:
+			self._wakeupPipe = os.pipe()
+			for fd in self._wakeupPipe:
+				fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+		self._scheduler = threading.Thread(target=self._runEvents)
+		self._scheduler.daemon = True
+		self._scheduler.start()
+
+	def getStatistics(self):
+		"""
+		 Returns how many lines were received, lost because they didn't fit into the receive buffer and answered with
+		 an error, and how many moves got executed.
+		"""
+		return dict(self._statistics)
+
+	def getLastLineNumber(self):
+		"""
+		 Returns the number of the last numbered line that got accepted.
+		"""
+		return self._lastLineNumber
+
+	def write(self, data):
+		if self.readList is None:
+			return
+
+		# every line arrives once the ones written before it and itself made it over the line
+		now = time.time()
+		arrival = max(now, self._rxFreeAt)
+		if self._bytesPerSecond is not None:
+			arrival += len(data) / self._bytesPerSecond
+		self._rxFreeAt = arrival
+		for line in data.splitlines(True):
+			self._schedule(arrival, self._onReceived, line)
+
+	def _send(self, line):
+		if not line.endswith("\n"):
+			line += "\n"
+		now = time.time()
+		departure = max(now, self._txFreeAt)
+		if self._bytesPerSecond is not None:
+			departure += len(line) / self._bytesPerSecond
+		self._txFreeAt = departure
+		self._schedule(departure + self._responseLatency, VirtualPrinter._send, self, line)
+
+	def close(self):
+		VirtualPrinter.close(self)
+		self._wakeup()
+
+	##~~ firmware
+
+	def _onReceived(self, line):
+		self._statistics["received"] += 1
+		if self._rxBytes + len(line) > self._rxBufferSize:
+			# buffer overrun, the line is lost
+			self._statistics["lost"] += 1
+			return
+		self._rxLines.append(line)
+		self._rxBytes += len(line)
+		self._process()
+
+	def _process(self):
+		now = time.time()
+		while True:
+			# move lines from the receive buffer to the command buffer as long as there is room
+			while len(self._rxLines) > 0 and len(self._commands) < self._commandBufferSize:
+				line = self._rxLines.popleft()
+				self._rxBytes -= len(line)
+				command = self._checkLine(line)
+				if command is not None:
+					self._commands.append(command)
+
+			if len(self._commands) == 0:
+				return
+			if self._blockedUntil is not None:
+				if now < self._blockedUntil:
+					# retried once the blocking command can continue
+					return
+				self._blockedUntil = None
+
+			retryAt = self._execute(self._commands[0], now)
+			if retryAt is not None:
+				self._blockedUntil = retryAt
+				self._schedule(retryAt, self._process)
+				return
+			self._commands.popleft()
+
+	def _checkLine(self, line):
+		"""
+		 Checks the line number and checksum of the line like Marlin does and returns the command in it, None if there's
+		 nothing to execute.
+		"""
+		line = line.strip()
+		if not line:
+			return None
+
+		match = self._lineNumber.match(line)
+		if match is None:
+			if "*" in line:
+				self._requestResend("No Line Number with checksum")
+				return None
+			return line
+
+		lineNumber = int(match.group(1))
+		if "*" in line:
+			(content, checksum) = line.rsplit("*", 1)
+			command = content[match.end():].strip()
+		else:
+			(content, checksum) = (line, None)
+			command = line[match.end():].strip()
+
+		if not matchesGcode(command, "M110") and lineNumber != self._lastLineNumber + 1:
+			self._requestResend("Line Number is not Last Line Number+1")
+			return None
+		if checksum is None:
+			self._requestResend("No Checksum with line number")
+			return None
+		try:
+			checksumOk = int(checksum) == reduce(lambda x, y: x ^ y, map(ord, content))
+		except ValueError:
+			checksumOk = False
+		if not checksumOk or (self._errorRate > 0 and self._random.random() < self._errorRate):
+			self._requestResend("checksum mismatch")
+			return None
+
+		self._lastLineNumber = lineNumber
+		return command
+
+	def _requestResend(self, error):
+		# Marlin throws away everything it received so far and asks for the line after the last good one
+		self._statistics["errors"] += 1
+		self._rxLines.clear()
+		self._rxBytes = 0
+		self._send("Error:%s, Last Line: %d" % (error, self._lastLineNumber))
+		self._send("Resend: %d" % (self._lastLineNumber + 1))
+		self._send("ok")
+
+	def _execute(self, command, now):
+		"""
+		 Executes the command and returns None, or returns the time to try again at if the firmware has to wait before it
+		 can do so.
+		"""
+		gcode = parseGcode(command)
+		code = gcode.command
+
+		if self._writingToSd and code != "M29":
+			# goes straight to the file
+			VirtualPrinter.write(self, command + "\n")
+		elif code in ("G0", "G1", "G28"):
+			while len(self._moveEnds) > 0 and self._moveEnds[0] <= now:
+				self._moveEnds.popleft()
+			if len(self._moveEnds) >= self._plannerBufferSize:
+				return self._moveEnds[0]
+
+			duration = self._move(gcode, code == "G28")
+			start = now
+			if len(self._moveEnds) > 0:
+				start = max(now, self._moveEnds[-1])
+			self._moveEnds.append(start + duration)
+			self._statistics["moves"] += 1
+			self._send("ok")
+		elif code in ("M400", "G4"):
+			if self._dwellUntil is None:
+				self._dwellUntil = now
+				if len(self._moveEnds) > 0:
+					self._dwellUntil = max(now, self._moveEnds[-1])
+				if code == "G4":
+					parameters = self._parameters(gcode)
+					if "S" in parameters:
+						self._dwellUntil += parameters["S"]
+					elif "P" in parameters:
+						self._dwellUntil += parameters["P"] / 1000.0
+			if now < self._dwellUntil:
+				return self._dwellUntil
+			self._dwellUntil = None
+			self._send("ok")
+		elif code in ("M109", "M190"):
+			parameters = self._parameters(gcode)
+			if "S" in parameters:
+				if code == "M109":
+					self.targetTemp = parameters["S"]
+				else:
+					self.bedTargetTemp = parameters["S"]
+			self._updateTemperatures()
+			if code == "M109":
+				remaining = abs(self.targetTemp - self.temp)
+			else:
+				remaining = abs(self.bedTargetTemp - self.bedTemp)
+			if remaining > 1:
+				# VirtualPrinter heats up by 10 degrees per second
+				self._send(self._temperatureReport())
+				return now + min(1.0, remaining / 10.0)
+			self._send("ok")
+		elif code == "G90":
+			self._relative = False
+			self._send("ok")
+		elif code == "G91":
+			self._relative = True
+			self._send("ok")
+		elif code == "G92":
+			parameters = self._parameters(gcode)
+			for (i, axis) in enumerate("XYZE"):
+				if axis in parameters:
+					self._position[i] = parameters[axis]
+			self._send("ok")
+		elif code == "M110":
+			self._lastLineNumber = gcode.getInt("N", self._lastLineNumber)
+			self._send("ok")
+		else:
+			VirtualPrinter.write(self, command + "\n")
+		return None
+
+	def _move(self, gcode, home):
+		"""
+		 Moves to the position the command sets and returns how long that takes in seconds.
+		"""
+		parameters = self._parameters(gcode)
+		if "F" in parameters and parameters["F"] > 0:
+			self._feedrate = parameters["F"]
+
+		target = list(self._position)
+		for (i, axis) in enumerate("XYZE"):
+			if home:
+				if axis in parameters or not any(map(lambda x: x in parameters, "XYZ")):
+					target[i] = 0.0
+			elif axis in parameters:
+				if self._relative:
+					target[i] += parameters[axis]
+				else:
+					target[i] = parameters[axis]
+
+		distance = math.sqrt(sum(map(lambda i: (target[i] - self._position[i]) ** 2, range(3))))
+		if distance == 0:
+			# extrusion only
+			distance = abs(target[3] - self._position[3])
+		self._position = target
+		return distance / (self._feedrate / 60.0) * self._moveTimeScale
+
+	def _parameters(self, gcode):
+		"""
+		 Returns the parameters of the command relevant to the simulation that have a numeric value, as floats.
+		"""
+		parameters = {}
+		for parameter in "XYZEFSP":
+			value = gcode.getFloat(parameter)
+			if value is not None:
+				parameters[parameter] = value
+		return parameters
+
+	##~~ event scheduling
+
+	def _schedule(self, at, callback, *args):
+		with self._eventsMutex:
+			self._eventSequence += 1
+			heapq.heappush(self._events, (at, self._eventSequence, callback, args))
+			earliest = self._events[0][1] == self._eventSequence
+		if earliest:
+			self._wakeup()
+
+	def _wakeup(self):
+		wakeupPipe = self._wakeupPipe
+		if wakeupPipe is None:
+			self._wakeupEvent.set()
+			return
+		try:
+			os.write(wakeupPipe[1], "x")
+		except OSError:
+			pass
+
+	def _runEvents(self):
+		while self.readList is not None:
+			now = time.time()
+			event = None
+			timeout = None
+			with self._eventsMutex:
+				if len(self._events) > 0:
+					if self._events[0][0] <= now:
+						event = heapq.heappop(self._events)
+					else:
+						timeout = self._events[0][0] - now
+
+			if event is not None:
+				(at, sequence, callback, args) = event
+				try:
+					callback(*args)
+				except:
+					self._logger.exception("Error in printer simulation")
+				continue
+
+			# sleep until the next event is due or a new one got scheduled
+			if self._wakeupPipe is None:
+				self._wakeupEvent.wait(timeout)
+				self._wakeupEvent.clear()
+			else:
+				try:
+					select.select([self._wakeupPipe[0]], [], [], timeout)
+					while len(os.read(self._wakeupPipe[0], 4096)) == 4096:
+						pass
+				except (select.error, OSError):
+					pass
+
+		wakeupPipe = self._wakeupPipe
+		self._wakeupPipe = None
+		if wakeupPipe is not None:
+			for fd in wakeupPipe:
+				os.close(fd)
+
+def checksummedLine(cmd, lineNumber):
+	"""
+	 Returns the given command prefixed with the line number and suffixed with the checksum, terminated by a newline
+	 and ready to be written to the printer.
+	"""
+	line = "N%d%s" % (lineNumber, cmd)
+	checksum = reduce(lambda x,y:x^y, map(ord, line))
+	return "%s*%d\n" % (line, checksum)
+
+class JobLinePreparer(object):
+	"""
+	 Prepares the lines of a print job ahead of time in a background thread, so that all that's left to do once the
+	 printer acknowledges a line is to hand the next ready-to-write line over to the writer.
+
+	 Lines are numbered optimistically. If a prepared line doesn't carry the line number the sending side expects (e.g.
+	 because a checksummed command got sent in between), the sending side prepares the line itself and restarts the
+	 preparation from there. Lines that need special treatment while sending (pauses, target temperatures, line number
+	 resets) are only marked and left to the sending side as well.
+	"""
+
+	def __init__(self, gcodeList, lookahead, feedRateModifier):
+		self._gcodeList = gcodeList
+		self._lookahead = lookahead
+		self._feedRateModifier = feedRateModifier
+
+		self._prepared = collections.deque()
+		self._condition = threading.Condition()
+		self._generation = 0
+		self._stopped = False
+
+		self._pos = None
+		self._lineNumber = None
+		self._printSection = None
+
+		self._worker = threading.Thread(target=self._work)
+		self._worker.daemon = True
+		self._worker.start()
+
+	def restart(self, gcodePos, lineNumber, printSection):
+		"""
+		 Discards everything prepared so far and continues with the line at gcodePos, numbered as lineNumber.
+		"""
+		with self._condition:
+			self._generation += 1
+			self._prepared.clear()
+			self._pos = gcodePos
+			self._lineNumber = lineNumber
+			self._printSection = printSection
+			self._condition.notify()
+
+	def invalidate(self):
+		"""
+		 Discards everything prepared so far and pauses the preparation until the next restart.
+		"""
+		with self._condition:
+			self._generation += 1
+			self._prepared.clear()
+			self._pos = None
+
+	def stop(self):
+		with self._condition:
+			self._stopped = True
+			self._prepared.clear()
+			self._condition.notify()
+
+	def next(self, gcodePos, lineNumber):
+		"""
+		 Returns the prepared line for gcodePos as a tuple (gcodePos, data, lineNumber, cmd, printSection, z, lineClass)
+		 if it is available and numbered as lineNumber, None otherwise. data and cmd are None if the line needs special
+		 treatment.
+		"""
+		with self._condition:
+			while len(self._prepared) > 0 and self._prepared[0][0] < gcodePos:
+				self._prepared.popleft()
+			if len(self._prepared) == 0 or self._prepared[0][0] != gcodePos or self._prepared[0][2] != lineNumber:
+				return None
+			entry = self._prepared.popleft()
+			self._condition.notify()
+			return entry
+
+	def _work(self):
+		while True:
+			with self._condition:
+				while not self._stopped and (self._pos is None or self._pos >= len(self._gcodeList) or len(self._prepared) >= self._lookahead):
+					self._condition.wait()
+				if self._stopped:
+					return
+				generation = self._generation
+				pos = self._pos
+				lineNumber = self._lineNumber
+				printSection = self._printSection
+
+			entry = self._prepareLine(pos, lineNumber, printSection)
+
+			with self._condition:
+				if generation != self._generation:
+					# somebody restarted or invalidated us while we were busy, this line is of no use anymore
+					continue
+				self._prepared.append(entry)
+				self._pos = pos + 1
+				self._lineNumber = lineNumber + 1
+				self._printSection = entry[4]
+
+	def _prepareLine(self, pos, lineNumber, printSection):
+		line = self._gcodeList[pos]
+		if type(line) is tuple:
+			printSection = line[1]
+			line = line[0]
+
+		(code, feedrate, z) = self._gcodeList.getTokens(pos)
+		if code != LINE_OTHER and code != LINE_MOVE_Z:
+			return (pos, None, lineNumber, None, printSection, None, None)
+
+		if feedrate and printSection in self._feedRateModifier:
+			line = applyFeedrateModifier(line, feedrate, self._feedRateModifier[printSection])
+
+		if code == LINE_MOVE_Z:
+			lineClass = LINE_CLASS_MOVE
+		else:
+			lineClass = classifyGcode(parseGcode(line))
+		return (pos, checksummedLine(line, lineNumber), lineNumber, line, printSection, z, lineClass)
+
+class LineHistory(object):
+	"""
+	 Fixed capacity ring buffer of the lines sent with line number and checksum, indexed by their absolute line number,
+	 so that lines requested by the printer for resending can be looked up in constant time and written again as they
+	 are.
+
+	 Only an uninterrupted range of line numbers is kept. Adding a line that doesn't directly follow the last one (e.g.
+	 after the line numbers got reset) discards everything before it.
+	"""
+
+	def __init__(self, capacity):
+		self._capacity = max(1, capacity)
+		self._lines = [None] * self._capacity
+		self._first = None
+		self._last = None
+
+	def add(self, lineNumber, data):
+		if self._last is None or lineNumber != self._last + 1:
+			self._first = lineNumber
+		self._last = lineNumber
+		self._lines[lineNumber % self._capacity] = data
+		if self._last - self._first >= self._capacity:
+			self._first = self._last - self._capacity + 1
+
+	def get(self, lineNumber):
+		if not lineNumber in self:
+			return None
+		return self._lines[lineNumber % self._capacity]
+
+	def clear(self):
+		self._first = None
+		self._last = None
+
+	def __contains__(self, lineNumber):
+		return self._first is not None and self._first <= lineNumber <= self._last
+
+	def __len__(self):
+		if self._first is None:
+			return 0
+		return self._last - self._first + 1
+
+class SendWindow(object):
+	"""
+	 Keeps track of the lines that have been sent to the printer but not yet been acknowledged with an "ok". Used for
+	 streaming more than one line at a time without overflowing the receive buffer of the firmware.
+
+	 A maxBytes of 0 or less disables the check against the size of the firmware's receive buffer, only the number of
+	 lines in flight will be limited then.
+	"""
+
+	def __init__(self, maxLines, maxBytes):
+		self._maxLines = max(1, maxLines)
+		self._maxBytes = maxBytes
+
+		self._lines = collections.deque()
+		self._bytes = 0
+		self._mutex = threading.Lock()
+
+	def add(self, size, lineNumber=None):
+		with self._mutex:
+			self._lines.append((size, lineNumber))
+			self._bytes += size
+
+	def acknowledge(self):
+		"""
+		 Frees up the room of the oldest line in flight and returns its line number, None if it was sent without one.
+		"""
+		with self._mutex:
+			if len(self._lines) == 0:
+				# unsolicited or duplicate ok, nothing we could free up
+				return None
+			(size, lineNumber) = self._lines.popleft()
+			self._bytes -= size
+			return lineNumber
+
+	def hasRoom(self, size):
+		with self._mutex:
+			if len(self._lines) == 0:
+				# always allow at least one line, even if it is bigger than the receive buffer
+				return True
+			if len(self._lines) >= self._maxLines:
+				return False
+			return self._maxBytes <= 0 or self._bytes + size <= self._maxBytes
+
+	def discardNumberedFrom(self, lineNumber):
+		"""
+		 Stops tracking the lines in flight which were sent with the given line number or a higher one, because the
+		 firmware asked to resend them. Returns the number of lines that got discarded.
+		"""
+		with self._mutex:
+			kept = collections.deque(filter(lambda x: x[1] is None or x[1] < lineNumber, self._lines))
+			discarded = len(self._lines) - len(kept)
+			self._lines = kept
+			self._bytes = sum(size for (size, _) in kept)
+			return discarded
+
+	def clear(self):
+		with self._mutex:
+			self._lines.clear()
+			self._bytes = 0
+
+	def __len__(self):
+		with self._mutex:
+			return len(self._lines)
+
+# the lanes of the CommandQueue, ordered by priority
+LANE_EMERGENCY = "emergency"
+LANE_INTERACTIVE = "interactive"
+LANE_BACKGROUND = "background"
+
+class CommandQueue(object):
+	"""
+	 The commands waiting for their turn while the printer is busy, in lanes ordered by priority: interactive commands
+	 (whatever a user sends) go before background ones (polling the state of the printer). A command that waited longer
+	 than the maximum wait of its lane goes first though, so a flood of interactive commands can't starve the polling.
+	 A background command that is already waiting doesn't get queued a second time.
+
+	 Emergency commands never wait in here, they are sent right away (see MachineCom.sendCommand), but they are
+	 accounted for in the statistics nonetheless: the number of commands queued and sent per lane, the current and
+	 maximum number waiting, the total and maximum time they waited and how many of them waited longer than allowed.
+	"""
+
+	lanes = (LANE_INTERACTIVE, LANE_BACKGROUND)
+
+	def __init__(self, maxWait):
+		self._maxWait = maxWait
+
+		self._queues = dict((lane, collections.deque()) for lane in self.lanes)
+		self._mutex = threading.Lock()
+		self._statistics = {}
+		for lane in (LANE_EMERGENCY,) + self.lanes:
+			self._statistics[lane] = {"queued": 0, "sent": 0, "maxDepth": 0, "waitTime": 0.0, "maxWaitTime": 0.0, "overdue": 0}
+
+	def put(self, command, lane=LANE_INTERACTIVE):
+		with self._mutex:
+			queue = self._queues[lane]
+			if lane == LANE_BACKGROUND and any(queued == command for (queued, queuedAt) in queue):
+				return
+			queue.append((command, time.time()))
+
+			statistics = self._statistics[lane]
+			statistics["queued"] += 1
+			if len(queue) > statistics["maxDepth"]:
+				statistics["maxDepth"] = len(queue)
+
+	def get(self):
+		"""
+		 Returns the next command to send and the lane it was waiting in, None if there is none.
+		"""
+		with self._mutex:
+			now = time.time()
+			waiting = filter(lambda lane: len(self._queues[lane]) > 0, self.lanes)
+			if not waiting:
+				return None
+
+			lane = waiting[0]
+			for candidate in waiting:
+				if now - self._queues[candidate][0][1] > self._maxWait[candidate]:
+					lane = candidate
+					break
+
+			(command, queuedAt) = self._queues[lane].popleft()
+			self._addSent(lane, now - queuedAt)
+			return (command, lane)
+
+	def addEmergency(self, latency):
+		"""
+		 Accounts for an emergency command that took latency seconds to get written.
+		"""
+		with self._mutex:
+			self._statistics[LANE_EMERGENCY]["queued"] += 1
+			self._addSent(LANE_EMERGENCY, latency)
+
+	def empty(self):
+		with self._mutex:
+			return not any(len(queue) > 0 for queue in self._queues.values())
+
+	def getStatistics(self):
+		with self._mutex:
+			result = {}
+			for (lane, statistics) in self._statistics.items():
+				result[lane] = dict(statistics)
+				result[lane]["depth"] = len(self._queues[lane]) if lane in self._queues else 0
+				result[lane]["maxWait"] = self._maxWait.get(lane)
+				if statistics["sent"] > 0:
+					result[lane]["averageWaitTime"] = statistics["waitTime"] / statistics["sent"]
+				else:
+					result[lane]["averageWaitTime"] = None
+			return result
+
+	def _addSent(self, lane, wait):
+		statistics = self._statistics[lane]
+		statistics["sent"] += 1
+		statistics["waitTime"] += wait
+		if wait > statistics["maxWaitTime"]:
+			statistics["maxWaitTime"] = wait
+		if lane in self._maxWait and wait > self._maxWait[lane]:
+			statistics["overdue"] += 1
+
+	def __len__(self):
+		with self._mutex:
+			return sum(map(len, self._queues.values()))
+
+# what the latencies of the lines sent to the printer are broken down by, see CommandLatencies
+LINE_CLASS_MOVE = "move"
+LINE_CLASS_TEMPERATURE = "temperature"
+LINE_CLASS_USER = "user"
+LINE_CLASS_RESEND = "resend"
+LINE_CLASS_SD_TRANSFER = "sdTransfer"
+LINE_CLASS_EMERGENCY = "emergency"
+LINE_CLASS_OTHER = "other"
+
+def classifyGcode(gcode):
+	"""
+	 Returns the class of the line parsed into gcode, unless it's sent for a reason that makes it count as something else
+	 (like user commands or resends do).
+	"""
+	command = gcode.command
+	if command == "G0" or command == "G1":
+		return LINE_CLASS_MOVE
+	elif command == "M105":
+		return LINE_CLASS_TEMPERATURE
+	return LINE_CLASS_OTHER
+
+class LatencyHistogram(object):
+	"""
+	 Distribution of durations in buckets growing by a factor of two, from 50 microseconds up to about 26 seconds plus
+	 one for everything above, so adding a sample takes the same little time and memory no matter how many there are.
+	 Percentiles are estimated as the upper bound of the bucket they fall into.
+	"""
+
+	bounds = [0.00005 * 2 ** i for i in xrange(20)]
+
+	def __init__(self):
+		self._counts = [0] * (len(self.bounds) + 1)
+		self._count = 0
+		self._total = 0.0
+		self._max = 0.0
+
+	def add(self, value):
+		self._counts[bisect.bisect_left(self.bounds, value)] += 1
+		self._count += 1
+		self._total += value
+		if value > self._max:
+			self._max = value
+
+	def getPercentile(self, percentile):
+		if self._count == 0:
+			return None
+
+		rank = percentile * self._count
+		seen = 0
+		for (index, count) in enumerate(self._counts):
+			seen += count
+			if count > 0 and seen >= rank:
+				if index < len(self.bounds):
+					return min(self.bounds[index], self._max)
+				break
+		return self._max
+
+	def getStatistics(self):
+		"""
+		 Returns the number of samples, their average and maximum, the estimated median, 90th and 99th percentile and the
+		 non-empty buckets as tuples of their upper bound (None for the last one) and count.
+		"""
+		buckets = []
+		for (index, count) in enumerate(self._counts):
+			if count > 0:
+				buckets.append((self.bounds[index] if index < len(self.bounds) else None, count))
+
+		return {
+			"count": self._count,
+			"average": self._total / self._count if self._count > 0 else None,
+			"max": self._max,
+			"p50": self.getPercentile(0.5),
+			"p90": self.getPercentile(0.9),
+			"p99": self.getPercentile(0.99),
+			"buckets": buckets
+		}
+
+class CommandLatencies(object):
+	"""
+	 Latency histograms of the lines sent to the printer, by the class of the line (see LINE_CLASS_*) and what got
+	 measured:
+
+	 <ul>
+	   <li>queueWait: from being handed to the writer thread until it started writing the line</li>
+	   <li>write: writing the line to the serial port</li>
+	   <li>roundTrip: from starting to write the line until the printer acknowledged it</li>
+	   <li>idleGap: from the previous acknowledgement until the line got written, the time the printer was left waiting
+	       for the host</li>
+	 </ul>
+
+	 A slow host shows in the queue wait and the idle gap, a slow cable in the write times and a slow firmware in the
+	 round trips.
+	"""
+
+	metrics = ("queueWait", "write", "roundTrip", "idleGap")
+
+	def __init__(self):
+		self._histograms = {}
+		self._mutex = threading.Lock()
+		self._started = time.time()
+
+	def add(self, lineClass, metric, value):
+		with self._mutex:
+			key = (lineClass, metric)
+			if not key in self._histograms:
+				self._histograms[key] = LatencyHistogram()
+			self._histograms[key].add(value)
+
+	def getStatistics(self):
+		with self._mutex:
+			result = {"started": self._started, "lines": {}}
+			for ((lineClass, metric), histogram) in self._histograms.items():
+				result["lines"].setdefault(lineClass, {})[metric] = histogram.getStatistics()
+			return result
+
+class LineReader(object):
+	"""
+	 Splits the data received from the printer into lines. Data is fed in as it arrives, in chunks of any size, and
+	 feed returns all lines completed by it, newline included. Incomplete lines are kept in a buffer that is reused
+	 for the whole connection, the complete part of a chunk is split in one go without any per byte work.
+
+	 Lines growing beyond maxLineLength without a newline (e.g. line noise while probing for the right baudrate) are
+	 returned as they are instead of being buffered forever.
+	"""
+
+	maxLineLength = 4096
+
+	def __init__(self):
+		self._buffer = bytearray()
+
+	def feed(self, data):
+		end = data.rfind("\n") + 1
+		if end == 0:
+			self._buffer.extend(data)
+			if len(self._buffer) > self.maxLineLength:
+				return [self.flush()]
+			return []
+
+		if len(self._buffer) > 0:
+			self._buffer.extend(data[:end])
+			complete = str(self._buffer)
+			del self._buffer[:]
+		elif end == len(data):
+			complete = data
+		else:
+			complete = data[:end]
+
+		if end < len(data):
+			self._buffer.extend(data[end:])
+		return complete.splitlines(True)
+
+	def flush(self):
+		"""
+		 Returns and clears whatever incomplete line is currently buffered.
+		"""
+		data = str(self._buffer)
+		del self._buffer[:]
+		return data
+
+class SerialTransport(object):
+	"""
+	 Non-blocking, line based transport on top of a serial port or anything else offering the same interface (inWaiting,
+	 read, fileno and close), like the VirtualPrinter.
+
+	 readLines never waits but only returns the complete lines that arrived so far, waiting for data is left to the
+	 SerialEventLoop the transport is added to. Everything the port has buffered is read in one call and split into
+	 lines by a LineReader, instead of reading byte by byte like pyserial's readline does. The idleTimeout is the time
+	 after which the event loop reports the transport as idle if nothing was received. Everything read is passed on to
+	 the recorder if there is one, see SessionRecorder.
+	"""
+
+	def __init__(self, port, idleTimeout, recorder=None):
+		self.port = port
+		self.idleTimeout = idleTimeout
+		self.recorder = recorder
+
+		self._lineReader = LineReader()
+		self._closed = False
+
+		# from now on reads must never block
+		self.port.timeout = 0
+
+	def fileno(self):
+		"""
+		 Returns the file descriptor to wait on for incoming data or None if there is none (e.g. serial ports on Windows),
+		 in which case the transport has to be polled.
+		"""
+		if self._closed:
+			return None
+		try:
+			return self.port.fileno()
+		except:
+			return None
+
+	def readLines(self):
+		data = self.port.read(max(1, self.port.inWaiting()))
+		if not data:
+			return []
+		if self.recorder is not None:
+			self.recorder.received(data)
+		return self._lineReader.feed(data)
+
+	def isClosed(self):
+		return self._closed
+
+	def close(self):
+		if self._closed:
+			return
+		self._closed = True
+		self.port.close()
+
+class SerialEventLoop(object):
+	"""
+	 Drives any number of SerialTransports from one thread. Received lines, transports going idle (nothing received
+	 within their idleTimeout) and timers are separate events which get handled when they happen, instead of having to
+	 wait for a blocking read to return first.
+
+	 Transports with a file descriptor are waited on with select, transports without one get polled every pollInterval
+	 seconds. Writing is not part of the loop, writes to the serial port are done by the writer thread of each
+	 MachineCom.
+
+	 run returns once the loop got stopped or the last transport got removed or closed, start does the same on a thread
+	 of its own. The pipe used for waking up the loop only exists while it runs.
+	"""
+
+	pollInterval = 0.01
+
+	def __init__(self):
+		self._logger = logging.getLogger(__name__)
+
+		self._transports = {}
+		self._timers = []
+		self._timerSequence = 0
+		self._mutex = threading.Lock()
+		self._stopped = False
+		self._running = False
+		self._wakeupPipe = None
+
+	def add(self, transport, lineCallback, idleCallback=None, errorCallback=None):
+		"""
+		 Adds a transport to the loop. lineCallback gets called with every received line, idleCallback without arguments
+		 whenever nothing was received within the transport's idleTimeout and errorCallback with the exception if reading
+		 from the transport failed, after which it gets removed from the loop.
+		"""
+		with self._mutex:
+			self._transports[transport] = [lineCallback, idleCallback, errorCallback, time.time() + transport.idleTimeout]
+		self.wakeup()
+
+	def remove(self, transport):
+		with self._mutex:
+			if transport in self._transports:
+				del self._transports[transport]
+		self.wakeup()
+
+	def callLater(self, delay, callback):
+		"""
+		 Calls callback on the loop's thread after delay seconds. Returns a handle that can be passed to cancel.
+		"""
+		with self._mutex:
+			self._timerSequence += 1
+			timer = [time.time() + delay, self._timerSequence, callback]
+			heapq.heappush(self._timers, timer)
+		self.wakeup()
+		return timer
+
+	def cancel(self, timer):
+		with self._mutex:
+			# cancelled timers stay in the heap until they are due but don't do anything
+			timer[2] = None
+
+	def wakeup(self):
+		with self._mutex:
+			# the pipe's descriptors may belong to something else already once it's closed
+			if self._wakeupPipe is None:
+				return
+			try:
+				os.write(self._wakeupPipe[1], "x")
+			except OSError:
+				# pipe is full, so there's a wakeup pending already
+				pass
+
+	def stop(self):
+		self._stopped = True
+		self.wakeup()
+
+	def start(self):
+		"""
+		 Runs the loop on a thread of its own unless it's running already. Transports added while it runs are picked up
+		 by it, the ones added after it ran out of transports need another start.
+		"""
+		with self._mutex:
+			if self._running:
+				return
+			self._running = True
+		thread = threading.Thread(target=self.run, name="SerialEventLoop")
+		thread.daemon = True
+		thread.start()
+
+	def run(self):
+		wakeupPipe = None
+		if os.name != "nt":
+			wakeupPipe = os.pipe()
+			for fd in wakeupPipe:
+				fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		with self._mutex:
+			self._running = True
+			self._wakeupPipe = wakeupPipe
+		try:
+			self._run()
+		finally:
+			with self._mutex:
+				# a start right after we ran out of transports might have another run going with a pipe of its own
+				if self._wakeupPipe is wakeupPipe:
+					self._wakeupPipe = None
+			if wakeupPipe is not None:
+				for fd in wakeupPipe:
+					os.close(fd)
+
+	def _run(self):
+		while True:
+			with self._mutex:
+				for transport in filter(lambda x: x.isClosed(), self._transports.keys()):
+					del self._transports[transport]
+				# decided under the mutex, so a transport added meanwhile comes with a start that isn't ignored
+				if self._stopped or len(self._transports) == 0:
+					self._running = False
+					break
+				transports = self._transports.items()
+
+			self._runTimers()
+
+			# wait until the next timer or idle timeout is due, or something arrives
+			now = time.time()
+			waitUntil = None
+			with self._mutex:
+				if len(self._timers) > 0:
+					waitUntil = self._timers[0][0]
+			fds = []
+			polled = []
+			for (transport, registration) in transports:
+				if waitUntil is None or registration[3] < waitUntil:
+					waitUntil = registration[3]
+				fd = transport.fileno()
+				if fd is None:
+					polled.append(transport)
+				else:
+					fds.append(fd)
+			timeout = max(0, waitUntil - now)
+			if len(polled) > 0 or self._wakeupPipe is None:
+				timeout = min(timeout, self.pollInterval)
+
+			if self._wakeupPipe is not None:
+				fds.append(self._wakeupPipe[0])
+			try:
+				readable = select.select(fds, [], [], timeout)[0]
+			except (select.error, ValueError, TypeError):
+				# a transport got closed while we were waiting on it
+				continue
+
+			if self._wakeupPipe is not None and self._wakeupPipe[0] in readable:
+				try:
+					while len(os.read(self._wakeupPipe[0], 4096)) == 4096:
+						pass
+				except OSError:
+					pass
+
+			for (transport, registration) in transports:
+				if transport.isClosed() or not (transport in polled or transport.fileno() in readable):
+					continue
+				self._read(transport, registration)
+
+			now = time.time()
+			for (transport, registration) in transports:
+				if registration[3] <= now and not transport.isClosed():
+					registration[3] = now + transport.idleTimeout
+					if registration[1] is not None:
+						self._call(registration[1])
+
+	def _read(self, transport, registration):
+		(lineCallback, idleCallback, errorCallback, idleDeadline) = registration
+		try:
+			lines = transport.readLines()
+		except Exception, e:
+			self.remove(transport)
+			if errorCallback is not None:
+				self._call(errorCallback, e)
+			return
+
+		if len(lines) > 0:
+			registration[3] = time.time() + transport.idleTimeout
+			for line in lines:
+				if transport.isClosed():
+					break
+				self._call(lineCallback, line)
+
+	def _runTimers(self):
+		now = time.time()
+		while True:
+			with self._mutex:
+				if len(self._timers) == 0 or self._timers[0][0] > now:
+					return
+				(deadline, sequence, callback) = heapq.heappop(self._timers)
+			if callback is not None:
+				self._call(callback)
+
+	def _call(self, callback, *args):
+		try:
+			callback(*args)
+		except:
+			self._logger.exception("Error in serial event loop callback")
+
+# reads from the serial ports of all MachineComs of this process that don't get a loop of their own
+_sharedEventLoop = SerialEventLoop()
+
+RESPONSE_EMPTY = "empty"
+RESPONSE_OK = "ok"
+RESPONSE_OK_TEMPERATURE = "okTemperature"
+RESPONSE_TEMPERATURE = "temperature"
+RESPONSE_RESEND = "resend"
+RESPONSE_ERROR = "error"
+RESPONSE_COMMUNICATION_ERROR = "communicationError"
+RESPONSE_WAIT = "wait"
+RESPONSE_START = "start"
+RESPONSE_SD_INIT_FAIL = "sdInitFail"
+RESPONSE_SD_CARD_OK = "sdCardOk"
+RESPONSE_SD_BEGIN_FILE_LIST = "sdBeginFileList"
+RESPONSE_SD_END_FILE_LIST = "sdEndFileList"
+RESPONSE_SD_PRINTING_BYTE = "sdPrintingByte"
+RESPONSE_SD_FILE_OPENED = "sdFileOpened"
+RESPONSE_SD_FILE_SELECTED = "sdFileSelected"
+RESPONSE_SD_DONE_PRINTING = "sdDonePrinting"
+RESPONSE_FIRMWARE_INFO = "firmwareInfo"
+RESPONSE_CAPABILITY = "capability"
+RESPONSE_ECHO = "echo"
+RESPONSE_MESSAGE = "message"
+
+class ResponseClassifier(object):
+	"""
+	 Tags lines received from the printer with their type in a single pass, so that the monitor loop can dispatch on the
+	 result instead of testing each line against every single known response in turn.
+
+	 All known responses are compiled into one anchored regular expression, in the order of the table below. Each
+	 entry's pattern is matched at the start of the line, after an optional "echo:" prefix as some firmwares use to
+	 report SD card events. Named groups inside a pattern are used to extract the data of the response.
+
+	 classify returns a tuple (type, data) with type being one of the RESPONSE_* constants and data depending on the
+	 type:
+
+	 <ul>
+	   <li>RESPONSE_RESEND: the requested line number</li>
+	   <li>RESPONSE_ERROR and RESPONSE_COMMUNICATION_ERROR: the error message</li>
+	   <li>RESPONSE_SD_PRINTING_BYTE: tuple (position, size)</li>
+	   <li>RESPONSE_SD_FILE_OPENED: tuple (filename, size)</li>
+	   <li>RESPONSE_FIRMWARE_INFO: the name of the firmware</li>
+	   <li>RESPONSE_CAPABILITY: tuple (capability, enabled) of a firmware capability as reported in response to M115</li>
+	   <li>None for everything else</li>
+	 </ul>
+	"""
+
+	_table = [
+		(RESPONSE_OK, "ok(?:\s|$)"),
+		(RESPONSE_WAIT, "wait"),
+		(RESPONSE_TEMPERATURE, "T:"),
+		(RESPONSE_RESEND, "(?:[Rr]esend|rs)[:\s]\s*N?:?\s*(?P<resendLine>\d+)"),
+		(RESPONSE_COMMUNICATION_ERROR, "Error:(?P<communicationErrorMessage>.*?(?:checksum mismatch|Wrong checksum|Line Number is not Last Line Number|expected line|No Line Number with checksum|No Checksum with line number|Missing checksum).*)"),
+		(RESPONSE_ERROR, "Error:(?P<errorMessage>.*)"),
+		(RESPONSE_START, "start"),
+		(RESPONSE_SD_INIT_FAIL, "SD init fail"),
+		(RESPONSE_SD_CARD_OK, "SD card ok"),
+		(RESPONSE_SD_BEGIN_FILE_LIST, "Begin file list"),
+		(RESPONSE_SD_END_FILE_LIST, "End file list"),
+		(RESPONSE_SD_PRINTING_BYTE, "SD printing byte\s*(?P<sdPosition>\d+)/(?P<sdSize>\d+)"),
+		(RESPONSE_SD_FILE_OPENED, "File opened:\s*(?P<sdFilename>.*?)\s+Size:\s*(?P<sdFileSize>\d+)"),
+		(RESPONSE_SD_FILE_SELECTED, "File selected"),
+		(RESPONSE_SD_DONE_PRINTING, "Done printing file"),
+		(RESPONSE_FIRMWARE_INFO, "FIRMWARE_NAME:\s*(?P<firmwareName>.*?)(?=\s+[A-Z_]+:|\s*$)"),
+		(RESPONSE_CAPABILITY, "Cap:(?P<capabilityName>[A-Z0-9_]+):(?P<capabilityValue>[01])")
+	]
+
+	_pattern = re.compile("(?:echo:\s*)?(?:" + "|".join(map(lambda x: "(?P<%s>%s)" % x, _table)) + ")")
+
+	def classify(self, line):
+		if not line or line.isspace():
+			return (RESPONSE_EMPTY, None)
+
+		match = self._pattern.match(line)
+		if match is None:
+			if " T:" in line:
+				return (RESPONSE_TEMPERATURE, None)
+			elif line.startswith("echo:"):
+				return (RESPONSE_ECHO, None)
+			return (RESPONSE_MESSAGE, None)
+
+		responseType = match.lastgroup
+		if responseType == RESPONSE_OK:
+			if " T:" in line:
+				return (RESPONSE_OK_TEMPERATURE, None)
+			return (RESPONSE_OK, None)
+		elif responseType == RESPONSE_RESEND:
+			return (RESPONSE_RESEND, int(match.group("resendLine")))
+		elif responseType == RESPONSE_COMMUNICATION_ERROR:
+			return (RESPONSE_COMMUNICATION_ERROR, match.group("communicationErrorMessage"))
+		elif responseType == RESPONSE_ERROR:
+			return (RESPONSE_ERROR, match.group("errorMessage"))
+		elif responseType == RESPONSE_SD_PRINTING_BYTE:
+			return (RESPONSE_SD_PRINTING_BYTE, (int(match.group("sdPosition")), int(match.group("sdSize"))))
+		elif responseType == RESPONSE_SD_FILE_OPENED:
+			return (RESPONSE_SD_FILE_OPENED, (match.group("sdFilename"), int(match.group("sdFileSize"))))
+		elif responseType == RESPONSE_FIRMWARE_INFO:
+			return (RESPONSE_FIRMWARE_INFO, match.group("firmwareName"))
+		elif responseType == RESPONSE_CAPABILITY:
+			return (RESPONSE_CAPABILITY, (match.group("capabilityName"), match.group("capabilityValue") == "1"))
+		return (responseType, None)
+
+class TemperatureParser(object):
+	"""
+	 Extracts the readings of all heaters from a temperature report in a single pass of one precompiled regular
+	 expression, e.g.
+
+	   ok T:210.0 /210.0 B:60.0 /60.0 T0:210.0 /210.0 T1:180.5 /185.0 C:35.0 /0.0 @:64 B@:127
+
+	 parse returns a dictionary mapping the heater identifiers as reported by the firmware ("T" for the current tool,
+	 "T0", "T1", ... for the individual tools, "B" for the bed and "C" for the chamber) to tuples (actual, target, power).
+	 Target and power are None if the firmware didn't report them.
+	"""
+
+	_pattern = re.compile("(?:^|\s)(B@|@|[TBC])(\d*):\s*(-?\d+(?:\.\d*)?)(?:\s*/\s*(-?\d+(?:\.\d*)?))?")
+
+	def parse(self, line):
+		temperatures = {}
+		powers = None
+		for (heater, index, actual, target) in self._pattern.findall(line):
+			if heater == "@":
+				if powers is None:
+					powers = {}
+				powers["T" + index] = int(float(actual))
+			elif heater == "B@":
+				if powers is None:
+					powers = {}
+				powers["B"] = int(float(actual))
+			else:
+				temperatures[heater + index] = (float(actual), float(target) if target else None, None)
+
+		if powers is not None:
+			for (heater, power) in powers.items():
+				if heater in temperatures:
+					temperatures[heater] = temperatures[heater][:2] + (power,)
+		return temperatures
+
+# serial ports opened by a MachineCom of this process, which auto detection must not touch
+_portsInUse = set()
+_portsInUseMutex = threading.Lock()
+
+def _claimPort(port):
+	with _portsInUseMutex:
+		if port in _portsInUse:
+			return False
+		_portsInUse.add(port)
+		return True
+
+def _releasePort(port):
+	with _portsInUseMutex:
+		_portsInUse.discard(port)
+
+class ConnectionDetector(object):
+	"""
+	 Finds the port and baudrate a printer answers on by probing all candidate ports at the same time, each in a thread
+	 of its own. A probe opens the port and sends M105 at each candidate baudrate in turn, the first baudrate getting a
+	 reply a printer would send wins. Opening the port resets most boards, so the first baudrate gets bootTime seconds
+	 for an answer (the firmware announces itself with "start" when done booting), every further one only
+	 handshakeTimeout seconds.
+
+	 The pair that got detected is remembered per USB device in the serial detection settings, so next time the port
+	 the device is now connected to and its baudrate get tried first.
+
+	 detect returns a tuple (serial, port, baudrate) of the open port and where it was found, None if no printer
+	 answered.
+	"""
+
+	_handshakeResponses = [RESPONSE_OK, RESPONSE_OK_TEMPERATURE, RESPONSE_TEMPERATURE, RESPONSE_START]
+
+	def __init__(self, ports, baudrates, log=None):
+		self._logger = logging.getLogger(__name__)
+		self._log = log
+		self._ports = ports
+		self._baudrates = baudrates
+		self._bootTime = settings().getFloat(["serial", "detection", "bootTime"])
+		self._handshakeTimeout = settings().getFloat(["serial", "detection", "handshakeTimeout"])
+		self._responseClassifier = ResponseClassifier()
+
+		self._found = threading.Event()
+		self._result = None
+		self._resultMutex = threading.Lock()
+
+	def detect(self):
+		deviceIds = self._getDeviceIds()
+		remembered = settings().get(["serial", "detection", "remembered"])
+
+		candidates = []
+		for port in self._ports:
+			if port in deviceIds.keys() and deviceIds[port] in remembered.keys():
+				baudrate = remembered[deviceIds[port]]["baudrate"]
+				if baudrate in self._baudrates:
+					# the device the pair was detected for is still around, so try that first
+					candidates.insert(0, (port, [baudrate] + filter(lambda x: x != baudrate, self._baudrates)))
+					continue
+			candidates.append((port, self._baudrates))
+
+		threads = []
+		for (port, baudrates) in candidates:
+			if not _claimPort(port):
+				self._logMessage("Not probing %s, it is in use" % port)
+				continue
+			thread = threading.Thread(target=self._probe, args=(port, baudrates))
+			thread.daemon = True
+			thread.start()
+			threads.append(thread)
+
+		for thread in threads:
+			thread.join()
+
+		if self._result is None:
+			return None
+
+		(serialPort, port, baudrate) = self._result
+		if port in deviceIds.keys():
+			remembered = dict(remembered)
+			remembered[deviceIds[port]] = {"port": port, "baudrate": baudrate}
+			settings().set(["serial", "detection", "remembered"], remembered)
+			settings().save()
+		return self._result
+
+	def _probe(self, port, baudrates):
+		serialPort = None
+		try:
+			timeout = self._bootTime
+			for baudrate in baudrates:
+				if self._found.is_set():
+					break
+				if serialPort is None:
+					serialPort = self._open(port, baudrate)
+				else:
+					serialPort.baudrate = baudrate
+				self._logMessage("Probing %s at %d baud" % (port, baudrate))
+				if self._handshake(serialPort, timeout):
+					with self._resultMutex:
+						if self._result is None:
+							self._logMessage("Printer answered on %s at %d baud" % (port, baudrate))
+							self._result = (serialPort, port, baudrate)
+							self._found.set()
+							return
+					break
+				timeout = self._handshakeTimeout
+		except:
+			self._logMessage("Unexpected error while probing %s: %s" % (port, getExceptionString()))
+
+		if serialPort is not None:
+			serialPort.close()
+		_releasePort(port)
+
+	def _open(self, port, baudrate):
+		if port == "VIRTUAL":
+			return createVirtualPrinter()
+		return serial.Serial(str(port), baudrate, timeout=0.1, writeTimeout=10000)
+
+	def _handshake(self, serialPort, timeout):
+		if hasattr(serialPort, "flushInput"):
+			serialPort.flushInput()
+		serialPort.write("\nM105\n")
+		deadline = time.time() + timeout
+		while time.time() < deadline and not self._found.is_set():
+			line = serialPort.readline()
+			(responseType, responseData) = self._responseClassifier.classify(line)
+			if responseType in self._handshakeResponses:
+				return True
+		return False
+
+	def _getDeviceIds(self):
+		"""
+		 Returns a dictionary mapping the candidate ports to an id of the device connected to them, ports of unknown
+		 devices are left out.
+		"""
+		deviceIds = {}
+		try:
+			from serial.tools import list_ports
+			for info in list_ports.comports():
+				# old versions of pyserial return tuples (port, description, hwid), new ones objects indexable like these
+				port = info[0]
+				hwid = info[2]
+				if hwid and hwid != "n/a":
+					deviceIds[port] = hwid
+		except:
+			self._logger.exception("Could not determine the devices connected to the serial ports")
+		return deviceIds
+
+	def _logMessage(self, message):
+		if self._log is not None:
+			self._log(message)
+		else:
+			self._logger.info(message)
 
 class MachineComPrintCallback(object):
 	def mcLog(self, message):
 		pass
 	
-	def mcTempUpdate(self, temp, bedTemp, targetTemp, bedTargetTemp):
+	def mcTempUpdate(self, temperatures):
 		pass
 	
 	def mcStateChange(self, state):
@@ -338,8 +1853,11 @@ class MachineCom(object):
 	STATE_ERROR = 9
 	STATE_CLOSED_WITH_ERROR = 10
 	STATE_RECEIVING_FILE = 11
+
+	# replaced by "?" in the serial log, same as decoding as ASCII and encoding back with errors replaced would do
+	_nonAsciiCharacters = re.compile("[\x80-\xff]")
 	
-	def __init__(self, port = None, baudrate = None, callbackObject = None):
+	def __init__(self, port = None, baudrate = None, callbackObject = None, eventLoop = None):
 		self._logger = logging.getLogger(__name__)
 		self._serialLogger = logging.getLogger("SERIAL")
 
@@ -353,40 +1871,98 @@ class MachineCom(object):
 				baudrate = settingsBaudrate
 		if callbackObject == None:
 			callbackObject = MachineComPrintCallback()
+		if eventLoop == None:
+			eventLoop = _sharedEventLoop
 
 		self._port = port
 		self._baudrate = baudrate
 		self._callback = callbackObject
 		self._state = self.STATE_NONE
 		self._serial = None
-		self._baudrateDetectList = baudrateList()
-		self._baudrateDetectRetry = 0
+		self._transport = None
+		self._recorder = None
+		self._eventLoop = eventLoop
+		self._communicationTimeout = None
+		self._startSeen = False
+		self._pendingErrorLine = None
+		self._portClaimed = False
 		self._temp = 0
 		self._bedTemp = 0
 		self._targetTemp = 0
 		self._bedTargetTemp = 0
+		self._temperatures = {}
+		# when the last report arrived that wasn't the reply to an M105 or M27 we sent, and how many of those replies are
+		# still to come
+		self._lastTemperatureAutoreport = None
+		self._lastSdStatusAutoreport = None
+		self._temperaturePollsPending = 0
+		self._sdStatusPollsPending = 0
+		self._firmwareName = None
+		self._firmwareCapabilities = {}
+		self._temperatureAutoreport = False
+		self._sdStatusAutoreport = False
 		self._gcodeList = None
 		self._gcodePos = 0
-		self._commandQueue = queue.Queue()
-		self._logQueue = queue.Queue(256)
+		self._commandQueue = CommandQueue(dict((lane, settings().getFloat(["serial", "commandQueue", "maxWait", lane])) for lane in CommandQueue.lanes))
+		self._logQueue = collections.deque(maxlen=256)
 		self._feedRateModifier = {}
 		self._currentZ = None
 		self._heatupWaitStartTime = 0
+		self._heatupWaitReported = False
 		self._heatupWaitTimeLost = 0.0
 		self._printStartTime = None
+		self._printTimeIndex = None
+
+		# SD card upload, the lines are pulled from _sdTransferLines whenever the firmware is ready for the next one
+		self._sdTransferLines = None
+		self._sdTransferFilename = None
+		self._sdTransferSkipAcks = 0
+		self._sdTransferFinished = threading.Event()
+
+		self._responseClassifier = ResponseClassifier()
+		self._temperatureParser = TemperatureParser()
 
 		self._alwaysSendChecksum = settings().getBoolean(["feature", "alwaysSendChecksum"])
 		self._currentLine = 1
 		self._resendDelta = None
-		self._lastLines = []
+		self._lastLines = LineHistory(settings().getInt(["serial", "resendHistorySize"]))
 
-		self._sendNextLock = threading.Lock()
-		self._sendingLock = threading.Lock()
+		# streaming mode, keeps more than one line in flight if enabled
+		if settings().getBoolean(["serial", "streaming", "enabled"]):
+			self._sendWindow = SendWindow(settings().getInt(["serial", "streaming", "windowLines"]), settings().getInt(["serial", "streaming", "rxBufferSize"]))
+		else:
+			self._sendWindow = None
+		self._heldLine = None
+		self._linePreparer = None
+		self._lastResendRequest = None
+		self._resendSwallowRepetitions = 0
+		self._resendSkipOks = 0
 
+		self._sendNextLock = threading.Lock()
+		self._sendingLock = threading.RLock()
+
+		# all writes to the serial port are done by a dedicated writer thread, fed through a bounded queue
+		self._sendQueue = queue.Queue(settings().getInt(["serial", "sendQueueSize"]))
+		self._sendQueueStatsLock = threading.Lock()
+		self._writeMutex = threading.Lock()
+		self._sendQueueStats = {"lines": 0, "bytes": 0, "writeTime": 0.0, "maxWriteTime": 0.0, "maxQueueDepth": 0}
+
+		# latencies of the lines sent since connecting and during the current (or last) print job, with the classes and
+		# write times of the lines still waiting for their ok and the time of the last ok, see _onAcknowledged
+		self._latencies = CommandLatencies()
+		self._jobLatencies = None
+		self._inFlight = collections.deque(maxlen=256)
+		self._lastAcknowledged = None
+
+		# only connects, reading from the port is up to the event loop after that
 		self.thread = threading.Thread(target=self._monitor)
 		self.thread.daemon = True
 		self.thread.start()
 
+		self._writerThread = threading.Thread(target=self._writer)
+		self._writerThread.daemon = True
+		self._writerThread.start()
+
 		self._sdAvailable = False
 		self._sdPrinting = False
 		self._sdFileList = False
@@ -495,7 +2071,21 @@ class MachineCom(object):
 		if self._printStartTime == None:
 			return None
 
-		if self._sdPrinting:
+		if not self._sdPrinting and self._printTimeIndex is not None:
+			# the analysis tells us how long the job takes up to every line, all that's left to figure out is how much
+			# faster or slower than that the printer actually is
+			pos = min(self._gcodePos, len(self._printTimeIndex)) - 1
+			if pos < 0:
+				pos = 0
+			estimatedPrintTime = self._printTimeIndex[pos]
+			printTime = (time.time() - self._printStartTime - self._getHeatupWaitTimeLost()) / 60
+			if printTime < 0:
+				printTime = 0
+
+			# damped by a minute on both sides, so the first few moves can't throw the estimate off
+			ratio = (printTime + 1.0) / (estimatedPrintTime + 1.0)
+			return (self._printTimeIndex[-1] - estimatedPrintTime) * ratio
+		elif self._sdPrinting:
 			printTime = (time.time() - self._printStartTime) / 60
 			if self._sdFilePos > 0:
 				printTimeTotal = printTime * self._sdFileSize / self._sdFilePos
@@ -513,6 +2103,12 @@ class MachineCom(object):
 			printTimeLeft = printTimeTotal - printTime
 			return printTimeLeft
 
+	def _getHeatupWaitTimeLost(self):
+		if self._heatupWaitReported:
+			# still heating up
+			return self._heatupWaitTimeLost + time.time() - self._heatupWaitStartTime
+		return self._heatupWaitTimeLost
+
 	def getSdProgress(self):
 		return (self._sdFilePos, self._sdFileSize)
 
@@ -521,312 +2117,547 @@ class MachineCom(object):
 	
 	def getBedTemp(self):
 		return self._bedTemp
+
+	def getTemperatures(self):
+		return self._temperatures
+
+	def getFirmwareName(self):
+		return self._firmwareName
+
+	def getFirmwareCapabilities(self):
+		return self._firmwareCapabilities
 	
+	def getSendQueueStatistics(self):
+		"""
+		 Returns statistics about the send queue feeding the writer thread: the current and maximum queue depth, the number
+		 of lines and bytes written so far and the time spent inside the serial port's write method (in seconds).
+		"""
+		with self._sendQueueStatsLock:
+			stats = dict(self._sendQueueStats)
+		stats["queueDepth"] = self._sendQueue.qsize()
+		stats["queueSize"] = self._sendQueue.maxsize
+		if stats["lines"] > 0:
+			stats["averageWriteTime"] = stats["writeTime"] / stats["lines"]
+		else:
+			stats["averageWriteTime"] = None
+		return stats
+
+	def getLatencyStatistics(self):
+		"""
+		 Returns the latency histograms of the lines sent since connecting and during the current or last print job (None
+		 if there was none yet), see CommandLatencies.
+		"""
+		jobLatencies = self._jobLatencies
+		return {
+			"connection": self._latencies.getStatistics(),
+			"job": jobLatencies.getStatistics() if jobLatencies is not None else None
+		}
+
+	def getCommandQueueStatistics(self):
+		"""
+		 Returns statistics about the lanes of the command queue, see CommandQueue.
+		"""
+		return self._commandQueue.getStatistics()
+
 	def getLog(self):
-		ret = []
-		while not self._logQueue.empty():
-			ret.append(self._logQueue.get())
-		for line in ret:
-			self._logQueue.put(line, False)
-		return ret
+		return list(self._logQueue)
 	
 	def _monitor(self):
 		#Open the serial port.
-		if self._port == 'AUTO':
-			self._changeState(self.STATE_DETECT_SERIAL)
-			programmer = stk500v2.Stk500v2()
-			self._log("Serial port list: %s" % (str(serialList())))
-			for p in serialList():
-				try:
-					self._log("Connecting to: %s" % (p))
-					programmer.connect(p)
-					self._serial = programmer.leaveISP()
-					break
-				except ispBase.IspError as (e):
-					self._log("Error while connecting to %s: %s" % (p, str(e)))
-					pass
-				except:
-					self._log("Unexpected error while connecting to serial port: %s %s" % (p, getExceptionString()))
-				programmer.close()
+		detected = False
+		if self._port is None or self._port == 'AUTO' or (self._port != 'VIRTUAL' and self._baudrate == 0):
+			if self._port is None or self._port == 'AUTO':
+				self._changeState(self.STATE_DETECT_SERIAL)
+				ports = filter(lambda x: x != "VIRTUAL", serialList())
+			else:
+				self._changeState(self.STATE_DETECT_BAUDRATE)
+				ports = [self._port]
+			if self._baudrate == 0:
+				baudrates = baudrateList()
+			else:
+				baudrates = [self._baudrate]
+			self._log("Looking for the printer on %s at %s baud" % (", ".join(ports), ", ".join(map(str, baudrates))))
+			result = ConnectionDetector(ports, baudrates, log=self._log).detect()
+			if result is not None:
+				(self._serial, self._port, self._baudrate) = result
+				self._portClaimed = True
+				detected = True
 		elif self._port == 'VIRTUAL':
 			self._changeState(self.STATE_OPEN_SERIAL)
-			self._serial = VirtualPrinter()
+			self._serial = createVirtualPrinter()
+		elif not _claimPort(self._port):
+			self._changeState(self.STATE_OPEN_SERIAL)
+			self._log("Serial port %s is already in use by another printer" % (self._port))
 		else:
 			self._changeState(self.STATE_OPEN_SERIAL)
+			self._portClaimed = True
 			try:
 				self._log("Connecting to: %s" % (self._port))
-				if self._baudrate == 0:
-					self._serial = serial.Serial(str(self._port), 115200, timeout=0.1, writeTimeout=10000)
-				else:
-					self._serial = serial.Serial(str(self._port), self._baudrate, timeout=2, writeTimeout=10000)
+				self._serial = serial.Serial(str(self._port), self._baudrate, timeout=2, writeTimeout=10000)
 			except:
 				self._log("Unexpected error while connecting to serial port: %s %s" % (self._port, getExceptionString()))
 		if self._serial == None:
 			self._log("Failed to open serial port (%s)" % (self._port))
 			self._errorValue = 'Failed to autodetect serial port.'
 			self._changeState(self.STATE_ERROR)
+			self._releasePort()
+			self._sendQueue.put(None) # there's nothing to write to, stop the writer
 			return
 		self._log("Connected to: %s, starting monitor" % (self._serial))
-		if self._baudrate == 0:
-			self._changeState(self.STATE_DETECT_BAUDRATE)
-		else:
-			self._changeState(self.STATE_CONNECTING)
+		self._changeState(self.STATE_CONNECTING)
+		self._recorder = self._createRecorder()
 
 		#Start monitoring the serial port.
-		timeout = time.time() + 5
-		tempRequestTimeout = timeout
-		sdStatusRequestTimeout = timeout
-		startSeen = not settings().getBoolean(["feature", "waitForStartOnConnect"])
-		while True:
-			line = self._readline()
-			if line == None:
-				break
+		self._communicationTimeout = time.time() + 5
+		self._startSeen = not settings().getBoolean(["feature", "waitForStartOnConnect"])
+		if detected:
+			# the printer answered the detection already, which means it's done booting, no need to wait any longer
+			self._startSeen = True
+			self._sendCommand("M105")
+		self._transport = SerialTransport(self._serial, 2, recorder=self._recorder)
+		self._eventLoop.add(self._transport, self._onLine, idleCallback=self._onIdle, errorCallback=self._onReadError)
+		self._eventLoop.callLater(5, self._onTemperatureTimer)
+		self._eventLoop.callLater(1, self._onSdStatusTimer)
+		# from here on everything happens on the event loop's thread, which is shared with the other printers
+		self._eventLoop.start()
+
+	def _onLine(self, line):
+		if line != "":
+			self._log("Recv: %s", line.rstrip())
+		if self._pendingErrorLine is not None:
+			line = self._pendingErrorLine.rstrip() + line
+			self._pendingErrorLine = None
+
+		(responseType, responseData) = self._responseClassifier.classify(line)
+		isOk = responseType == RESPONSE_OK or responseType == RESPONSE_OK_TEMPERATURE
+
+		# every line we send gets acknowledged by exactly one ok, so that's what frees up room in the send window
+		if isOk:
+			self._onAcknowledged()
+			if self._sendWindow is not None:
+				self._acknowledgeInSendWindow()
+
+		##~~ Error handling
+		# No matter the state, if we see an error, goto the error state and store the error for reference.
+		if responseType == RESPONSE_ERROR:
+			#Oh YEAH, consistency.
+			# Marlin reports an MIN/MAX temp error as "Error:x\n: Extruder switched off. MAXTEMP triggered !\n"
+			#	But a bed temp error is reported as "Error: Temperature heated bed switched off. MAXTEMP triggered !!"
+			#	So we can have an extra newline in the most common case. Awesome work people.
+			if re.match('Error:[0-9]\n', line):
+				# the rest of the error message is yet to come with the next line
+				self._pendingErrorLine = line
+				return
 
-			##~~ Error handling
-			# No matter the state, if we see an error, goto the error state and store the error for reference.
-			if line.startswith('Error:'):
-				#Oh YEAH, consistency.
-				# Marlin reports an MIN/MAX temp error as "Error:x\n: Extruder switched off. MAXTEMP triggered !\n"
-				#	But a bed temp error is reported as "Error: Temperature heated bed switched off. MAXTEMP triggered !!"
-				#	So we can have an extra newline in the most common case. Awesome work people.
-				if re.match('Error:[0-9]\n', line):
-					line = line.rstrip() + self._readline()
-				#Skip the communication errors, as those get corrected.
-				if 'checksum mismatch' in line \
-						or 'Wrong checksum' in line \
-						or 'Line Number is not Last Line Number' in line \
-						or 'expected line' in line \
-						or 'No Line Number with checksum' in line \
-						or 'No Checksum with line number' in line \
-						or 'Missing checksum' in line:
-					pass
-				elif not self.isError():
-					self._errorValue = line[6:]
-					self._changeState(self.STATE_ERROR)
+			#Skip the communication errors, as those get corrected.
+			if responseType == RESPONSE_ERROR and not self.isError():
+				self._errorValue = responseData
+				self._changeState(self.STATE_ERROR)
 
-			##~~ SD file list
-			# if we are currently receiving an sd file list, each line is just a filename, so just read it and abort processing
-			if self._sdFileList and not 'End file list' in line:
-				self._sdFiles.append(line)
-				continue
+		##~~ SD file list
+		# if we are currently receiving an sd file list, each line is just a filename, so just read it and abort processing
+		if self._sdFileList and responseType != RESPONSE_SD_END_FILE_LIST:
+			self._sdFiles.append(line)
+			return
 
-			##~~ Temperature processing
-			if ' T:' in line or line.startswith('T:'):
-				try:
-					self._temp = float(re.search("-?[0-9\.]*", line.split('T:')[1]).group(0))
-					if ' B:' in line:
-						self._bedTemp = float(re.search("-?[0-9\.]*", line.split(' B:')[1]).group(0))
+		if isOk and self._heatupWaitReported:
+			# the firmware was reporting temperatures while waiting for them, so this is the ok that ends the wait
+			self._heatupWaitTimeLost += time.time() - self._heatupWaitStartTime
+			self._heatupWaitStartTime = 0
+			self._heatupWaitReported = False
+
+		##~~ Temperature processing
+		if responseType == RESPONSE_TEMPERATURE or responseType == RESPONSE_OK_TEMPERATURE:
+			self._processTemperatures(self._temperatureParser.parse(line))
+
+			# auto reporting only counts as working with reports nobody asked for, a reply to a poll proves nothing.
+			# Firmware never prefixes auto reports with "ok".
+			if self._temperaturePollsPending > 0:
+				self._temperaturePollsPending -= 1
+			elif not isOk:
+				self._lastTemperatureAutoreport = time.time()
+
+			#If we are waiting for an M109 or M190 then measure the time we lost during heatup, so we can remove that time from our printing time estimate.
+			if not isOk and self._heatupWaitStartTime != 0:
+				t = time.time()
+				if self._heatupWaitReported:
+					self._heatupWaitTimeLost += t - self._heatupWaitStartTime
+				self._heatupWaitStartTime = t
+				self._heatupWaitReported = True
+
+		##~~ SD Card handling
+		elif responseType == RESPONSE_SD_INIT_FAIL:
+			self._sdAvailable = False
+			self._sdFiles = []
+			self._callback.mcSdStateChange(self._sdAvailable)
+		elif responseType == RESPONSE_SD_CARD_OK:
+			self._sdAvailable = True
+			self.refreshSdFiles()
+			self._callback.mcSdStateChange(self._sdAvailable)
+		elif responseType == RESPONSE_SD_BEGIN_FILE_LIST:
+			self._sdFiles = []
+			self._sdFileList = True
+		elif responseType == RESPONSE_SD_END_FILE_LIST:
+			self._sdFileList = False
+			self._callback.mcSdFiles(self._sdFiles)
+		elif responseType == RESPONSE_SD_PRINTING_BYTE:
+			# answer to M27, at least on Marlin, Repetier and Sprinter: "SD printing byte %d/%d"
+			(self._sdFilePos, self._sdFileSize) = responseData
+			if self._sdStatusPollsPending > 0:
+				self._sdStatusPollsPending -= 1
+			else:
+				self._lastSdStatusAutoreport = time.time()
+			self._callback.mcProgress()
+		elif responseType == RESPONSE_SD_FILE_OPENED:
+			# answer to M23, at least on Marlin, Repetier and Sprinter: "File opened:%s Size:%d"
+			(self._sdFile, self._sdFileSize) = responseData
+		elif responseType == RESPONSE_SD_FILE_SELECTED:
+			# final answer to M23, at least on Marlin, Repetier and Sprinter: "File selected"
+			self._callback.mcSdSelected(self._sdFile, self._sdFileSize)
+		elif responseType == RESPONSE_SD_DONE_PRINTING:
+			# printer is reporting file finished printing
+			self._sdPrinting = False
+			self._sdFilePos = 0
+			self._changeState(self.STATE_OPERATIONAL)
+			self._setSdStatusAutoreport(False)
+			self._callback.mcSdPrintingDone()
 
-					self._callback.mcTempUpdate(self._temp, self._bedTemp, self._targetTemp, self._bedTargetTemp)
-				except ValueError:
-					# catch conversion issues, we'll rather just not get the temperature update instead of killing the connection
-					pass
+		##~~ Firmware capabilities
+		elif responseType == RESPONSE_FIRMWARE_INFO:
+			self._firmwareName = responseData
+		elif responseType == RESPONSE_CAPABILITY:
+			self._onFirmwareCapability(*responseData)
 
-				#If we are waiting for an M109 or M190 then measure the time we lost during heatup, so we can remove that time from our printing time estimate.
-				if not 'ok' in line and self._heatupWaitStartTime != 0:
-					t = time.time()
-					self._heatupWaitTimeLost = t - self._heatupWaitStartTime
-					self._heatupWaitStartTime = t
+		##~~ Message handling
+		elif responseType != RESPONSE_EMPTY and not isOk and responseType != RESPONSE_WAIT and responseType != RESPONSE_RESEND and line != 'echo:Unknown command:""\n' and self.isOperational():
+			self._callback.mcMessage(line)
 
-			##~~ SD Card handling
-			elif 'SD init fail' in line:
-				self._sdAvailable = False
-				self._sdFiles = []
-				self._callback.mcSdStateChange(self._sdAvailable)
-			elif 'SD card ok' in line:
-				self._sdAvailable = True
-				self.refreshSdFiles()
-				self._callback.mcSdStateChange(self._sdAvailable)
-			elif 'Begin file list' in line:
-				self._sdFiles = []
-				self._sdFileList = True
-			elif 'End file list' in line:
-				self._sdFileList = False
-				self._callback.mcSdFiles(self._sdFiles)
-			elif 'SD printing byte' in line:
-				# answer to M27, at least on Marlin, Repetier and Sprinter: "SD printing byte %d/%d"
-				match = re.search("([0-9]*)/([0-9]*)", line)
-				self._sdFilePos = int(match.group(1))
-				self._sdFileSize = int(match.group(2))
-				self._callback.mcProgress()
-			elif 'File opened' in line:
-				# answer to M23, at least on Marlin, Repetier and Sprinter: "File opened:%s Size:%d"
-				match = re.search("File opened:\s*(.*?)\s+Size:\s*([0-9]*)", line)
-				self._sdFile = match.group(1)
-				self._sdFileSize = int(match.group(2))
-			elif 'File selected' in line:
-				# final answer to M23, at least on Marlin, Repetier and Sprinter: "File selected"
-				self._callback.mcSdSelected(self._sdFile, self._sdFileSize)
-			elif 'Done printing file' in line:
-				# printer is reporting file finished printing
-				self._sdPrinting = False
-				self._sdFilePos = 0
+		### Connection attempt
+		if self._state == self.STATE_CONNECTING:
+			if (line == "" or responseType == RESPONSE_WAIT) and self._startSeen:
+				self._sendCommand("M105")
+			elif responseType == RESPONSE_START:
+				self._startSeen = True
+			elif isOk and self._startSeen:
 				self._changeState(self.STATE_OPERATIONAL)
-				self._callback.mcSdPrintingDone()
-
-			##~~ Message handling
-			elif line.strip() != '' and line.strip() != 'ok' and not line.startswith("wait") and not line.startswith('Resend:') and line != 'echo:Unknown command:""\n' and self.isOperational():
-				self._callback.mcMessage(line)
-
-			### Baudrate detection
-			if self._state == self.STATE_DETECT_BAUDRATE:
-				if line == '' or time.time() > timeout:
-					if len(self._baudrateDetectList) < 1:
-						self.close()
-						self._errorValue = "No more baudrates to test, and no suitable baudrate found."
-						self._changeState(self.STATE_ERROR)
-					elif self._baudrateDetectRetry > 0:
-						self._baudrateDetectRetry -= 1
-						self._serial.write('\n')
-						self._log("Baudrate test retry: %d" % (self._baudrateDetectRetry))
-						self._sendCommand("M105")
-						self._testingBaudrate = True
-					else:
-						baudrate = self._baudrateDetectList.pop(0)
-						try:
-							self._serial.baudrate = baudrate
-							self._serial.timeout = 0.5
-							self._log("Trying baudrate: %d" % (baudrate))
-							self._baudrateDetectRetry = 5
-							self._baudrateDetectTestOk = 0
-							timeout = time.time() + 5
-							self._serial.write('\n')
-							self._sendCommand("M105")
-							self._testingBaudrate = True
-						except:
-							self._log("Unexpected error while setting baudrate: %d %s" % (baudrate, getExceptionString()))
-				elif 'ok' in line and 'T:' in line:
-					self._baudrateDetectTestOk += 1
-					if self._baudrateDetectTestOk < 10:
-						self._log("Baudrate test ok: %d" % (self._baudrateDetectTestOk))
-						self._sendCommand("M105")
-					else:
-						self._sendCommand("M999")
-						self._serial.timeout = 2
-						self._changeState(self.STATE_OPERATIONAL)
-				else:
-					self._testingBaudrate = False
+				self._requestFirmwareInfo()
+			elif time.time() > self._communicationTimeout:
+				self.close()
+
+		### Operational
+		elif self._state == self.STATE_OPERATIONAL or self._state == self.STATE_PAUSED:
+			# send what's still pending on comm timeout, requesting the temperature is up to _onTemperatureTimer
+			if line == "" or responseType == RESPONSE_WAIT:
+				if self._resendDelta is not None:
+					self._resendNextCommand()
+				elif not self._commandQueue.empty():
+					self._sendQueuedCommand()
+			elif isOk and self._resendDelta is not None:
+				self._resendNextCommand()
+			# whatever got queued while we were busy, e.g. right before a print got cancelled, goes out one by one
+			elif isOk and not self._commandQueue.empty():
+				self._sendQueuedCommand()
+			# resend -> start resend procedure from requested line
+			elif responseType == RESPONSE_RESEND:
+				self._handleResendRequest(responseData)
+			# the printer got reset, which also reset its auto reporting
+			elif responseType == RESPONSE_START:
+				self._requestFirmwareInfo()
+
+		### Printing
+		elif self._state == self.STATE_PRINTING:
+			if line == "" and time.time() > self._communicationTimeout:
+				self._log("Communication timeout during printing, forcing a line")
+				isOk = True
+				self._inFlight.clear()
+				if self._sendWindow is not None:
+					# we obviously lost track of the acknowledgements, so start over with an empty window
+					self._clearSendWindow()
 
-			### Connection attempt
-			elif self._state == self.STATE_CONNECTING:
-				if (line == "" or "wait" in line) and startSeen:
-					self._sendCommand("M105")
-				elif "start" in line:
-					startSeen = True
-				elif "ok" in line and startSeen:
-					self._changeState(self.STATE_OPERATIONAL)
-				elif time.time() > timeout:
-					self.close()
-
-			### Operational
-			elif self._state == self.STATE_OPERATIONAL or self._state == self.STATE_PAUSED:
-				#Request the temperature on comm timeout (every 5 seconds) when we are not printing.
-				if line == "" or "wait" in line:
-					if self._resendDelta is not None:
+			if self._sdPrinting:
+				if isOk or responseType == RESPONSE_SD_PRINTING_BYTE:
+					self._communicationTimeout = time.time() + 5
+			else:
+				if isOk:
+					self._communicationTimeout = time.time() + 5
+					if self._sendWindow is not None:
+						self._fillSendWindow()
+					elif self._isAwaitingAcknowledgement():
+						# an emergency command got sent in between, the next line goes out with the last of their oks
+						pass
+					elif self._resendDelta is not None:
 						self._resendNextCommand()
 					elif not self._commandQueue.empty():
-						self._sendCommand(self._commandQueue.get())
+						self._sendQueuedCommand()
 					else:
-						self._sendCommand("M105")
-					tempRequestTimeout = time.time() + 5
-				# resend -> start resend procedure from requested line
-				elif "resend" in line.lower() or "rs" in line:
-					self._handleResendRequest(line)
-
-			### Printing
-			elif self._state == self.STATE_PRINTING:
-				if line == "" and time.time() > timeout:
-					self._log("Communication timeout during printing, forcing a line")
-					line = 'ok'
-
+						self._sendNext()
+				elif responseType == RESPONSE_RESEND:
+					self._handleResendRequest(responseData)
+
+		### Sending a file to the SD card
+		elif self._state == self.STATE_RECEIVING_FILE:
+			if line == "" and time.time() > self._communicationTimeout:
+				self._log("Communication timeout during SD transfer, forcing a line")
+				isOk = True
+				self._inFlight.clear()
+				self._sdTransferSkipAcks = 0
+				if self._sendWindow is not None:
+					self._clearSendWindow()
+
+			if isOk:
+				self._communicationTimeout = time.time() + 5
+				if self._sdTransferSkipAcks > 0:
+					self._sdTransferSkipAcks -= 1
+				elif self._sendWindow is not None:
+					self._fillSendWindow()
+				elif self._isAwaitingAcknowledgement():
+					pass
+				elif self._resendDelta is not None:
+					self._resendNextCommand()
+				else:
+					self._sendNextSdFileLine()
+			elif responseType == RESPONSE_RESEND:
+				self._handleResendRequest(responseData)
+
+	def _acknowledgeInSendWindow(self):
+		if self._resendSkipOks > 0:
+			# the ok of a line the firmware rejected, that one got discarded from the window with the resend request
+			self._resendSkipOks -= 1
+			return
+		lineNumber = self._sendWindow.acknowledge()
+		if lineNumber is not None and self._lastResendRequest is not None and lineNumber >= self._lastResendRequest:
+			# the firmware accepted the line it asked for, so any further request for it is a new error
+			self._lastResendRequest = None
+			self._resendSwallowRepetitions = 0
+
+	def _clearSendWindow(self):
+		self._sendWindow.clear()
+		self._lastResendRequest = None
+		self._resendSwallowRepetitions = 0
+		self._resendSkipOks = 0
+
+	def _onIdle(self):
+		self._onLine("")
+
+	def _onReadError(self, error):
+		self._log("Unexpected error while reading serial port: %s" % (getExceptionString()))
+		self._errorValue = getExceptionString()
+		self.close(True)
+
+	def _onTemperatureTimer(self):
+		if self._serial is None:
+			# closed, the loop lives on for the other printers but this timer ends here
+			return
+		interval = self._getTemperaturePollInterval()
+		if not self._isAutoreporting(self._temperatureAutoreport, self._lastTemperatureAutoreport, ["serial", "autoreport", "temperatureInterval"]):
+			if self._state == self.STATE_PRINTING:
 				if self._sdPrinting:
-					if time.time() > tempRequestTimeout:
-						self._sendCommand("M105")
-						tempRequestTimeout = time.time() + 5
+					self._sendCommand("M105")
+				else:
+					self._commandQueue.put("M105", LANE_BACKGROUND)
+			elif self._state == self.STATE_OPERATIONAL or self._state == self.STATE_PAUSED:
+				self._sendCommand("M105")
+		self._eventLoop.callLater(interval, self._onTemperatureTimer)
+
+	def _onSdStatusTimer(self):
+		if self._serial is None:
+			return
+		if self._state == self.STATE_PRINTING and self._sdPrinting:
+			if not self._isAutoreporting(self._sdStatusAutoreport, self._lastSdStatusAutoreport, ["serial", "autoreport", "sdStatusInterval"]):
+				self._sendCommand("M27")
+		self._eventLoop.callLater(settings().getFloat(["serial", "sdStatusPollInterval"]), self._onSdStatusTimer)
+
+	def _getTemperaturePollInterval(self):
+		"""
+		 Returns how often to poll the temperatures when the firmware doesn't report them by itself: often while heating
+		 up, less often while printing or holding a temperature and least often if all heaters are off.
+		"""
+		heating = False
+		active = self._state == self.STATE_PRINTING
+		for (actual, target, power) in self._temperatures.values():
+			if target:
+				active = True
+				if abs(actual - target) > 2:
+					heating = True
+
+		if heating:
+			return settings().getFloat(["serial", "temperaturePollInterval", "heating"])
+		elif active:
+			return settings().getFloat(["serial", "temperaturePollInterval", "active"])
+		else:
+			return settings().getFloat(["serial", "temperaturePollInterval", "idle"])
+
+	def _isAutoreporting(self, enabled, lastAutoreport, intervalPath):
+		"""
+		 Auto reporting only counts as working if unsolicited reports actually arrived recently, otherwise we fall back to
+		 polling, e.g. if the firmware got reset without us noticing.
+		"""
+		if not enabled or lastAutoreport is None:
+			return False
+		return time.time() - lastAutoreport < 3 * max(1, settings().getInt(intervalPath))
+
+	def _requestFirmwareInfo(self):
+		self._firmwareName = None
+		self._firmwareCapabilities = {}
+		self._temperatureAutoreport = False
+		self._sdStatusAutoreport = False
+		# replies to polls sent before a reset of the firmware won't come anymore
+		self._temperaturePollsPending = 0
+		self._sdStatusPollsPending = 0
+		self.sendCommand("M115", LANE_BACKGROUND)
+
+	def _onFirmwareCapability(self, capability, enabled):
+		self._firmwareCapabilities[capability] = enabled
+		if not enabled or not settings().getBoolean(["serial", "autoreport", "enabled"]):
+			return
+
+		if capability == "AUTOREPORT_TEMP":
+			self._log("Firmware supports temperature auto reporting, enabling it")
+			self._temperatureAutoreport = True
+			self.sendCommand("M155 S%d" % settings().getInt(["serial", "autoreport", "temperatureInterval"]), LANE_BACKGROUND)
+		elif capability == "AUTOREPORT_SD_STATUS":
+			self._log("Firmware supports SD status auto reporting, enabling it while printing from SD")
+			self._sdStatusAutoreport = True
+			if self._sdPrinting:
+				self._setSdStatusAutoreport(True)
+
+	def _setSdStatusAutoreport(self, enabled):
+		if not self._sdStatusAutoreport:
+			return
+		if enabled:
+			self.sendCommand("M27 S%d" % settings().getInt(["serial", "autoreport", "sdStatusInterval"]), LANE_BACKGROUND)
+		else:
+			self.sendCommand("M27 S0", LANE_BACKGROUND)
 
-					if time.time() > sdStatusRequestTimeout:
-						self._sendCommand("M27")
-						sdStatusRequestTimeout = time.time() + 1
+	def _processTemperatures(self, temperatures):
+		if len(temperatures) == 0:
+			return
 
-					if 'ok' or 'SD printing byte' in line:
-						timeout = time.time() + 5
+		# firmwares not reporting the targets get the ones we last sent to them
+		for (heater, (actual, target, power)) in temperatures.items():
+			if target is None:
+				if heater == "B":
+					target = self._bedTargetTemp
+				elif heater == "T" or heater == "T0":
+					target = self._targetTemp
+				elif heater in self._temperatures:
+					target = self._temperatures[heater][1]
+				temperatures[heater] = (actual, target, power)
+
+		tool = temperatures.get("T", temperatures.get("T0"))
+		if tool is not None:
+			(self._temp, self._targetTemp) = tool[:2]
+		if "B" in temperatures:
+			(self._bedTemp, self._bedTargetTemp) = temperatures["B"][:2]
+
+		self._temperatures = temperatures
+		self._callback.mcTempUpdate(temperatures)
+
+	def _handleResendRequest(self, lineToResend):
+		with self._sendingLock:
+			if self._sendWindow is not None:
+				if lineToResend == self._lastResendRequest and self._resendSwallowRepetitions > 0:
+					# a line that was still in flight when the first error occurred may get rejected by the firmware
+					# with another request for the very same line, we only need to honor the first one. The ok that
+					# comes with the rejection doesn't acknowledge anything we still track.
+					self._resendSwallowRepetitions -= 1
+					self._resendSkipOks += 1
+					return
+				discarded = self._sendWindow.discardNumberedFrom(lineToResend)
+				self._lastResendRequest = lineToResend
+				if discarded > 0:
+					# the ok following this request is the one of the rejected line, the others in flight after it
+					# either get rejected too or were thrown away by the firmware
+					self._resendSkipOks += 1
+					self._resendSwallowRepetitions = discarded - 1
 				else:
-					# Even when printing request the temperature every 5 seconds.
-					if time.time() > tempRequestTimeout:
-						self._commandQueue.put("M105")
-						tempRequestTimeout = time.time() + 5
-
-					if 'ok' in line:
-						timeout = time.time() + 5
-						if self._resendDelta is not None:
-							self._resendNextCommand()
-						elif not self._commandQueue.empty():
-							self._sendCommand(self._commandQueue.get())
-						else:
-							self._sendNext()
-					elif "resend" in line.lower() or "rs" in line:
-						self._handleResendRequest(line)
-		self._log("Connection closed, closing down monitor")
-
-	def _handleResendRequest(self, line):
-		lineToResend = None
-		try:
-			lineToResend = int(line.replace("N:"," ").replace("N"," ").replace(":"," ").split()[-1])
-		except:
-			if "rs" in line:
-				lineToResend = int(line.split()[1])
+					self._resendSwallowRepetitions = 0
+
+				# a numbered line we already prepared but didn't send yet will be sent again as part of the resend anyway
+				if self._heldLine is not None and self._heldLine[1] is not None:
+					self._heldLine = None
+
+			elif self._resendDelta is not None and self._currentLine - self._resendDelta == lineToResend:
+				# we are going to resend that line with the next ok anyway
+				self._logger.debug("Printer requested line %d again before it got resent, ignoring", lineToResend)
+				return
+
+			if lineToResend >= self._currentLine:
+				# that's the line we are going to send next anyway, nothing to resend
+				self._logger.debug("Printer requested line %d which wasn't sent yet, ignoring", lineToResend)
+				return
 
-		if lineToResend is not None:
 			self._resendDelta = self._currentLine - lineToResend
-			if self._resendDelta >= len(self._lastLines):
+			if not lineToResend in self._lastLines:
 				self._errorValue = "Printer requested line %d but no sufficient history is available, can't resend" % lineToResend
 				self._logger.warn(self._errorValue)
-				if self.isPrinting():
-					# abort the print, there's nothing we can do to rescue it now
+				if self.isBusy():
+					# abort the print or transfer, there's nothing we can do to rescue it now
 					self._changeState(self.STATE_ERROR)
 				else:
 					# reset resend delta, we can't do anything about it
 					self._resendDelta = None
-			else:
-				self._resendNextCommand()
+			elif self._sendWindow is not None:
+				self._fillSendWindow()
+			# without the send window, the resend goes out with the ok that follows the request, sending it right away
+			# would leave one more line in flight than the firmware expects
+
+	def _releasePort(self):
+		if self._portClaimed:
+			_releasePort(self._port)
+			self._portClaimed = False
+
+	def _log(self, message, *args):
+		"""
+		 Adds message, formatted with args, to the serial log and the log shown in the UI. Formatting and output are left
+		 to the LogListener of the server if there is one, so they don't hold up the serial threads.
+		"""
+		listener = logListener()
+		if listener is not None:
+			listener.defer(self._outputLog, message, args)
+		else:
+			self._outputLog(message, args)
 
-	def _log(self, message):
+	def _outputLog(self, message, args):
+		if args:
+			message = message % args
+		message = self._nonAsciiCharacters.sub("?", message)
 		self._callback.mcLog(message)
 		self._serialLogger.debug(message)
-		try:
-			self._logQueue.put(message, False)
-		except:
-			#If the log queue is full, remove the first message and append the new message again
-			self._logQueue.get()
-			try:
-				self._logQueue.put(message, False)
-			except:
-				pass
+		self._logQueue.append(message) # the deque drops the oldest message once full
 
-	def _readline(self):
-		if self._serial == None:
-			return None
-		try:
-			ret = self._serial.readline()
-		except:
-			self._log("Unexpected error while reading serial port: %s" % (getExceptionString()))
-			self._errorValue = getExceptionString()
-			self.close(True)
-			return None
-		if ret == '':
-			#self._log("Recv: TIMEOUT")
-			return ''
-		self._log("Recv: %s" % (unicode(ret, 'ascii', 'replace').encode('ascii', 'replace').rstrip()))
-		return ret
-	
 	def close(self, isError = False):
+		if self._sendWindow is not None:
+			self._clearSendWindow()
+		self._heldLine = None
+		self._stopLinePreparer()
+		self._sdTransferLines = None
+		self._sdTransferFinished.set()
 		if self._serial != None:
-			self._serial.close()
+			if self._transport is not None:
+				self._eventLoop.remove(self._transport)
+				self._transport.close()
+			else:
+				self._serial.close()
+			if self._recorder is not None:
+				self._recorder.close()
 			if isError:
 				self._changeState(self.STATE_CLOSED_WITH_ERROR)
 			else:
 				self._changeState(self.STATE_CLOSED)
 		self._serial = None
+		self._releasePort()
+
+		# drop everything that's still waiting to be written and wake up the writer so it can shut down
+		try:
+			while True:
+				self._sendQueue.get_nowait()
+		except queue.Empty:
+			pass
+		try:
+			self._sendQueue.put_nowait(None)
+		except queue.Full:
+			pass
 
 		if settings().get(["feature", "sdSupport"]):
 			self._sdFileList = []
@@ -837,148 +2668,516 @@ class MachineCom(object):
 	def _resendNextCommand(self):
 		# Make sure we are only handling one sending job at a time
 		with self._sendingLock:
-			self._logger.debug("Resending line %d, delta is %d, history log is %s items strong" % (self._currentLine - self._resendDelta, self._resendDelta, len(self._lastLines)))
-			cmd = self._lastLines[-(self._resendDelta+1)]
-			lineNumber = self._currentLine - self._resendDelta
+			if self._serial is None:
+				return
+			self._enqueueLine(*self._prepareResend())
 
-			self._doSendWithChecksum(cmd, lineNumber)
+	def _prepareResend(self):
+		lineNumber = self._currentLine - self._resendDelta
+		self._logger.debug("Resending line %d, delta is %d, history log is %s items strong", lineNumber, self._resendDelta, len(self._lastLines))
 
-			self._resendDelta -= 1
-			if self._resendDelta < 0:
-				self._resendDelta = None
+		self._resendDelta -= 1
+		if self._resendDelta <= 0:
+			self._resendDelta = None
 
-	def _sendCommand(self, cmd, sendChecksum=False):
+		return (self._lastLines.get(lineNumber), lineNumber, LINE_CLASS_RESEND)
+
+	def _sendCommand(self, cmd, sendChecksum=False, lineClass=None, gcode=None):
 		# Make sure we are only handling one sending job at a time
 		with self._sendingLock:
 			if self._serial is None:
 				return
-			if matchesGcode(cmd, "M109") or matchesGcode(cmd, "M190"):
-				self._heatupWaitStartTime = time.time()
-			if matchesGcode(cmd, "M104") or matchesGcode(cmd, "M109"):
-				try:
-					self._targetTemp = float(re.search('S([0-9]+)', cmd).group(1))
-				except:
-					pass
-			if matchesGcode(cmd, "M140") or matchesGcode(cmd, "M190"):
-				try:
-					self._bedTargetTemp = float(re.search('S([0-9]+)', cmd).group(1))
-				except:
-					pass
-
-			if matchesGcode(cmd, "M110"):
-				newLineNumber = None
-				if " N" in cmd:
-					try:
-						newLineNumber = int(re.search("N([0-9]+)", cmd).group(1))
-					except:
-						pass
-				else:
-					newLineNumber = 0
-
-				if settings().getBoolean(["feature", "resetLineNumbersWithPrefixedN"]) and newLineNumber is not None:
-					# let's rewrite the M110 command to fit repetier syntax
-					self._addToLastLines(cmd)
-					self._doSendWithChecksum("M110", newLineNumber)
-				else:
-					self._doSend(cmd, sendChecksum)
-
-				if newLineNumber is not None:
-					self._currentLine = newLineNumber + 1
+			(data, lineNumber, gcodeClass) = self._prepareCommand(cmd, sendChecksum, gcode)
+			if lineClass is None:
+				lineClass = gcodeClass
+			self._enqueueLine(data, lineNumber, lineClass)
 
-				# after a reset of the line number we have no way to determine what line exactly the printer now wants
-				self._lastLines = []
-				self._resendDelta = None
+	def _sendQueuedCommand(self):
+		with self._sendingLock:
+			if self._serial is None:
+				return
+			prepared = self._prepareQueuedCommand()
+			if prepared is not None:
+				self._enqueueLine(*prepared)
+
+	def _prepareQueuedCommand(self):
+		"""
+		 Prepares the next command from the command queue like _prepareCommand does, commands from the interactive lane
+		 count as user commands. Returns None if there's nothing queued.
+		"""
+		queued = self._commandQueue.get()
+		if queued is None:
+			return None
+		(cmd, lane) = queued
+		(data, lineNumber, lineClass) = self._prepareCommand(cmd)
+		if lane == LANE_INTERACTIVE:
+			return (data, lineNumber, LINE_CLASS_USER)
+		return (data, lineNumber, lineClass)
+
+	def _prepareCommand(self, cmd, sendChecksum=False, gcode=None):
+		"""
+		 Takes care of all bookkeeping necessary for sending the given command (target temperatures, line numbers, resend
+		 history) and returns a tuple of the newline terminated line to write to the printer, its line number (None if
+		 the line is sent without checksum) and its class for the latency statistics. gcode is cmd already parsed, if the
+		 caller has it at hand.
+		"""
+		if gcode is None:
+			gcode = parseGcode(cmd)
+		lineClass = classifyGcode(gcode)
+		if gcode.matches("M105"):
+			self._temperaturePollsPending += 1
+		elif gcode.matches("M27") and not "S" in gcode.parameters:
+			self._sdStatusPollsPending += 1
+		if gcode.matches("M109") or gcode.matches("M190"):
+			self._heatupWaitStartTime = time.time()
+		if gcode.matches("M104") or gcode.matches("M109"):
+			targetTemp = gcode.getFloat("S")
+			if targetTemp is not None:
+				self._targetTemp = targetTemp
+		if gcode.matches("M140") or gcode.matches("M190"):
+			bedTargetTemp = gcode.getFloat("S")
+			if bedTargetTemp is not None:
+				self._bedTargetTemp = bedTargetTemp
+
+		if gcode.matches("M110"):
+			if "N" in gcode.parameters:
+				newLineNumber = gcode.getInt("N")
 			else:
-				self._doSend(cmd, sendChecksum)
+				newLineNumber = 0
 
-	def _addToLastLines(self, cmd):
-		self._lastLines.append(cmd)
-		if len(self._lastLines) > 50:
-			self._lastLines = self._lastLines[-50:] # only keep the last 50 lines in memory
-		self._logger.debug("Got %d lines of history in memory" % len(self._lastLines))
+			if settings().getBoolean(["feature", "resetLineNumbersWithPrefixedN"]) and newLineNumber is not None:
+				# let's rewrite the M110 command to fit repetier syntax
+				prepared = (self._addChecksum("M110", newLineNumber), newLineNumber)
+			else:
+				prepared = self._prepareLine(cmd, sendChecksum)
+
+			if newLineNumber is not None:
+				self._currentLine = newLineNumber + 1
+
+			# after a reset of the line number the history before it is worthless, only the M110 itself can be resent if
+			# it was sent numbered according to the new line numbers
+			self._lastLines.clear()
+			if prepared[1] is not None and prepared[1] == newLineNumber:
+				self._lastLines.add(newLineNumber, prepared[0])
+			self._resendDelta = None
+			return prepared + (lineClass,)
+		else:
+			return self._prepareLine(cmd, sendChecksum) + (lineClass,)
 
-	def _doSend(self, cmd, sendChecksum=False):
+	def _prepareLine(self, cmd, sendChecksum=False):
 		if sendChecksum or self._alwaysSendChecksum:
 			if self._alwaysSendChecksum:
 				lineNumber = self._currentLine
 			else:
 				lineNumber = self._gcodePos
-			self._addToLastLines(cmd)
+			data = self._addChecksum(cmd, lineNumber)
+			self._lastLines.add(lineNumber, data)
 			self._currentLine += 1
-			self._doSendWithChecksum(cmd, lineNumber)
+			return (data, lineNumber)
 		else:
-			self._doSendWithoutChecksum(cmd)
-
-	def _doSendWithChecksum(self, cmd, lineNumber):
-		self._logger.debug("Sending cmd '%s' with lineNumber %r" % (cmd, lineNumber))
+			return (cmd + "\n", None)
+
+	def _addChecksum(self, cmd, lineNumber):
+		self._logger.debug("Sending cmd '%s' with lineNumber %r", cmd, lineNumber)
+		return checksummedLine(cmd, lineNumber)
+
+	def _enqueueLine(self, data, lineNumber, lineClass):
+		"""
+		 Hands the line to the writer thread. lineClass is what the line counts as in the latency statistics.
+		"""
+		if self._sendWindow is not None:
+			self._sendWindow.add(len(data), lineNumber)
+
+		# blocks if the writer can't keep up and the queue is full
+		self._sendQueue.put((data, lineClass, time.time(), True))
+
+		queueDepth = self._sendQueue.qsize()
+		with self._sendQueueStatsLock:
+			if queueDepth > self._sendQueueStats["maxQueueDepth"]:
+				self._sendQueueStats["maxQueueDepth"] = queueDepth
+
+	def _writer(self):
+		"""
+		 Writes everything put into the send queue to the serial port, so that a slow write never holds up the monitor
+		 thread reading the printer's responses. Queued are tuples of the already newline terminated line, its class and
+		 the time it got queued (for the latency statistics) and whether the printer is going to acknowledge it, a None
+		 shuts the writer down.
+		"""
+		while True:
+			queued = self._sendQueue.get()
+			serialPort = self._serial
+			if queued is None or serialPort is None:
+				break
+			(data, lineClass, queuedAt, acknowledged) = queued
+
+			if len(data) > 1:
+				self._log("Send: %s", data[:-1])
+			start = time.time()
+			inFlight = self._addInFlight(lineClass, start, acknowledged)
+			if not self._write(serialPort, data):
+				self._removeInFlight(inFlight)
+				break
+			end = time.time()
+			writeTime = end - start
+			self._onWritten(lineClass, queuedAt, start, end)
+
+			with self._sendQueueStatsLock:
+				self._sendQueueStats["lines"] += 1
+				self._sendQueueStats["bytes"] += len(data)
+				self._sendQueueStats["writeTime"] += writeTime
+				if writeTime > self._sendQueueStats["maxWriteTime"]:
+					self._sendQueueStats["maxWriteTime"] = writeTime
+
+	def _addInFlight(self, lineClass, start, acknowledged):
+		"""
+		 Marks the line as waiting for its ok, returns the entry for _removeInFlight or None if the printer won't
+		 acknowledge the line. Has to be done before writing, the ok might arrive before the write even returns.
+		"""
+		if not acknowledged:
+			return None
+		inFlight = (lineClass, start)
+		self._inFlight.append(inFlight)
+		return inFlight
 
-		checksum = reduce(lambda x,y:x^y, map(ord, "N%d%s" % (lineNumber, cmd)))
-		commandToSend = "N%d%s*%d" % (lineNumber, cmd, checksum)
-		self._doSendWithoutChecksum(commandToSend)
+	def _removeInFlight(self, inFlight):
+		if inFlight is None:
+			return
+		try:
+			self._inFlight.remove(inFlight)
+		except ValueError:
+			# already taken by an ok or cleared after a timeout
+			pass
 
-	def _doSendWithoutChecksum(self, cmd):
-		self._log("Send: %s" % cmd)
+	def _isAwaitingAcknowledgement(self):
+		"""
+		 Returns whether a line is still waiting to be written or for its ok. Without the send window it's that ok which
+		 sends the next line, sending one right away would leave two lines in flight.
+		"""
+		return len(self._inFlight) > 0 or not self._sendQueue.empty()
+
+	def _onWritten(self, lineClass, queuedAt, start, end):
+		self._addLatency(lineClass, "write", end - start)
+		if queuedAt is not None:
+			self._addLatency(lineClass, "queueWait", start - queuedAt)
+		lastAcknowledged = self._lastAcknowledged
+		if lastAcknowledged is not None:
+			self._lastAcknowledged = None
+			# when there's nothing to do, the printer waiting for the next command is not the host's fault
+			if self.isBusy():
+				self._addLatency(lineClass, "idleGap", max(0, start - lastAcknowledged))
+
+	def _onAcknowledged(self):
+		"""
+		 Takes the round trip time of the oldest line in flight, every line gets acknowledged in order with one ok.
+		"""
+		now = time.time()
 		try:
-			self._serial.write(cmd + '\n')
-		except serial.SerialTimeoutException:
-			self._log("Serial timeout while writing to serial port, trying again.")
+			(lineClass, written) = self._inFlight.popleft()
+			self._addLatency(lineClass, "roundTrip", now - written)
+		except IndexError:
+			# unsolicited or duplicate ok, or we lost track after a timeout
+			pass
+		self._lastAcknowledged = now
+
+	def _addLatency(self, lineClass, metric, value):
+		self._latencies.add(lineClass, metric, value)
+		jobLatencies = self._jobLatencies
+		if jobLatencies is not None:
+			jobLatencies.add(lineClass, metric, value)
+
+	def _write(self, serialPort, data):
+		"""
+		 Writes data to the serial port, returns whether that worked. Emergency commands are written by whoever sends
+		 them, the mutex keeps them from ending up in the middle of a line written by the writer thread.
+		"""
+		with self._writeMutex:
 			try:
-				self._serial.write(cmd + '\n')
+				serialPort.write(data)
+			except serial.SerialTimeoutException:
+				self._log("Serial timeout while writing to serial port, trying again.")
+				try:
+					serialPort.write(data)
+				except:
+					self._onWriteError()
+					return False
 			except:
-				self._log("Unexpected error while writing serial port: %s" % (getExceptionString()))
-				self._errorValue = getExceptionString()
-				self.close(True)
+				self._onWriteError()
+				return False
+			recorder = self._recorder
+			if recorder is not None:
+				recorder.sent(data)
+		return True
+
+	def _createRecorder(self):
+		"""
+		 Returns the recorder for the serial traffic of this session if recording is enabled, see SessionRecorder.
+		"""
+		if not settings().getBoolean(["serial", "recording", "enabled"]):
+			return None
+		name = re.sub("[^\w.-]", "_", os.path.basename(str(self._port)))
+		path = os.path.join(settings().getBaseFolder("logs"), "serial_%s.rec" % name)
+		try:
+			recorder = SessionRecorder(path, settings().getInt(["serial", "recording", "maxSize"]), settings().getInt(["serial", "recording", "backupCount"]))
 		except:
-			self._log("Unexpected error while writing serial port: %s" % (getExceptionString()))
-			self._errorValue = getExceptionString()
-			self.close(True)
+			self._log("Could not record the serial traffic to %s: %s" % (path, getExceptionString()))
+			return None
+		self._log("Recording the serial traffic to %s" % path)
+		return recorder
+
+	def _onWriteError(self):
+		if self._serial is None:
+			# port got closed while we were writing, nothing to report
+			return
+		self._log("Unexpected error while writing serial port: %s" % (getExceptionString()))
+		self._errorValue = getExceptionString()
+		self.close(True)
 
 	def _sendNext(self):
+		with self._sendingLock:
+			if self._serial is None:
+				return
+			prepared = self._prepareNext()
+			if prepared is not None:
+				self._enqueueLine(*prepared)
+				self._callback.mcProgress()
+
+	def _prepareNext(self):
 		with self._sendNextLock:
 			if self._gcodePos >= len(self._gcodeList):
+				self._stopLinePreparer()
 				self._changeState(self.STATE_OPERATIONAL)
-				return
+				return None
 			if self._gcodePos == 100:
 				self._printStartTime100 = time.time()
+
+			linePreparer = self._linePreparer
+			if linePreparer is not None:
+				if self._alwaysSendChecksum:
+					expectedLineNumber = self._currentLine
+				else:
+					expectedLineNumber = self._gcodePos
+				prepared = linePreparer.next(self._gcodePos, expectedLineNumber)
+				if prepared is not None and prepared[1] is not None:
+					# fast path, the line is ready to be written, only the bookkeeping is left to do
+					(pos, data, lineNumber, cmd, self._printSection, z, lineClass) = prepared
+					if z is not None and self._currentZ != z:
+						self._currentZ = z
+						self._callback.mcZChange(z)
+					self._lastLines.add(lineNumber, data)
+					self._currentLine += 1
+					self._gcodePos += 1
+					return (data, lineNumber, lineClass)
+			else:
+				prepared = None
+
 			line = self._gcodeList[self._gcodePos]
 			if type(line) is tuple:
 				self._printSection = line[1]
 				line = line[0]
+			(code, feedrate, z) = self._gcodeList.getTokens(self._gcodePos)
+			gcode = None
 			try:
-				if matchesGcode(line, "M0") or matchesGcode(line, "M1"):
+				if code == LINE_PAUSE:
 					self.setPause(True)
 					line = "M105" # Don't send the M0 or M1 to the machine, as M0 and M1 are handled as an LCD menu pause.
-				if self._printSection in self._feedRateModifier:
-					line = re.sub('F([0-9]*)', lambda m: 'F' + str(int(int(m.group(1)) * self._feedRateModifier[self._printSection])), line)
-				if (matchesGcode(line, "G0") or matchesGcode(line, "G1")) and 'Z' in line:
-					z = float(re.search('Z([0-9\.]*)', line).group(1))
-					if self._currentZ != z:
-						self._currentZ = z
-						self._callback.mcZChange(z)
+				elif code == LINE_IRREGULAR:
+					# the line couldn't be pre-parsed, so whatever is wrong with it is going to show up here
+					if self._printSection in self._feedRateModifier:
+						line = re.sub('F([0-9]*)', lambda m: 'F' + str(int(int(m.group(1)) * self._feedRateModifier[self._printSection])), line)
+					gcode = parseGcode(line)
+					if (gcode.matches("G0") or gcode.matches("G1")) and "Z" in gcode.parameters:
+						z = float(gcode.parameters["Z"])
+				else:
+					if feedrate and self._printSection in self._feedRateModifier:
+						line = applyFeedrateModifier(line, feedrate, self._feedRateModifier[self._printSection])
+				if z is not None and self._currentZ != z:
+					self._currentZ = z
+					self._callback.mcZChange(z)
 			except:
 				self._log("Unexpected error: %s" % (getExceptionString()))
-			self._sendCommand(line, True)
+			result = self._prepareCommand(line, True, gcode)
 			self._gcodePos += 1
-			self._callback.mcProgress()
-	
-	def sendCommand(self, cmd):
+
+			if linePreparer is not None and prepared is None:
+				# the line preparer didn't have what we needed, let it start over from here
+				if self._alwaysSendChecksum:
+					linePreparer.restart(self._gcodePos, self._currentLine, self._printSection)
+				else:
+					linePreparer.restart(self._gcodePos, self._gcodePos, self._printSection)
+			return result
+
+	def _stopLinePreparer(self):
+		if self._linePreparer is not None:
+			self._linePreparer.stop()
+			self._linePreparer = None
+
+	def _sendNextSdFileLine(self):
+		with self._sendingLock:
+			if self._serial is None:
+				return
+			prepared = self._prepareNextSdFileLine()
+			if prepared is not None:
+				self._enqueueLine(*prepared)
+
+	def _prepareNextSdFileLine(self):
+		"""
+		 Prepares the next line of the file being transferred to the SD card. Once all lines are sent and acknowledged,
+		 finishes the transfer instead and returns None.
+		"""
+		with self._sendNextLock:
+			if self._sdTransferLines is None:
+				return None
+
+			try:
+				line = next(self._sdTransferLines)
+			except StopIteration:
+				line = None
+			except:
+				self._log("Unexpected error while reading the file to transfer to SD: %s" % (getExceptionString()))
+				line = None
+
+			if line is None:
+				if self._sendWindow is not None and len(self._sendWindow) > 0:
+					# wait for the acknowledgements of what's still in flight, we might have to resend some of it
+					self._sdTransferLines = iter([])
+					return None
+				self._finishSdFileTransfer()
+				return None
+
+			# lines are always numbered so the firmware can detect corrupted ones. It strips the line number and
+			# checksum again before writing them to the file, for which it expects a space after the line number
+			lineNumber = self._currentLine
+			data = self._addChecksum(" " + line, lineNumber)
+			self._lastLines.add(lineNumber, data)
+			self._currentLine += 1
+			return (data, lineNumber, LINE_CLASS_SD_TRANSFER)
+
+	def _finishSdFileTransfer(self):
+		# the firmware doesn't acknowledge M29 with an ok, so it must not take up room in the send window
+		self._sendQueue.put(("M29 %s\n" % self._sdTransferFilename, LINE_CLASS_SD_TRANSFER, time.time(), False))
+		self._sdTransferLines = None
+		self._changeState(self.STATE_OPERATIONAL)
+		self._sdTransferFinished.set()
+		self.refreshSdFiles()
+
+		# whatever had to wait for the end of the transfer can be sent now
+		while not self._commandQueue.empty():
+			self._sendQueuedCommand()
+
+	def _prepareNextInLine(self):
+		"""
+		 Prepares whatever is to be sent next while printing or transferring a file to SD: pending resends first, then
+		 queued commands, then the next line of the print job or file.
+		"""
+		if self._resendDelta is not None:
+			return self._prepareResend()
+		elif self._state == self.STATE_RECEIVING_FILE:
+			return self._prepareNextSdFileLine()
+		elif not self._commandQueue.empty():
+			return self._prepareQueuedCommand()
+		else:
+			return self._prepareNext()
+
+	def _fillSendWindow(self):
+		"""
+		 Sends lines until the send window is full. A line that got prepared but doesn't fit anymore is held back until
+		 the next acknowledgement frees up enough room for it.
+		"""
+		with self._sendingLock:
+			sent = False
+			while self._serial is not None and self.isBusy():
+				if self._heldLine is None:
+					self._heldLine = self._prepareNextInLine()
+					if self._heldLine is None:
+						break
+				if not self._sendWindow.hasRoom(len(self._heldLine[0])):
+					break
+				prepared = self._heldLine
+				self._heldLine = None
+				self._enqueueLine(*prepared)
+				sent = True
+			if sent and self.isPrinting():
+				self._callback.mcProgress()
+
+	def sendCommand(self, cmd, lane=LANE_INTERACTIVE):
+		"""
+		 Sends cmd to the printer, right away if it's idle, otherwise as soon as it's cmd's turn in the given lane of the
+		 command queue. Emergency commands (and M112 and M410, whatever lane they are sent in) skip the queue and
+		 everything that's waiting to be written and go out immediately, see _sendEmergencyCommand.
+		"""
 		cmd = cmd.encode('ascii', 'replace')
-		if self.isPrinting():
-			self._commandQueue.put(cmd)
+		gcode = parseGcode(cmd)
+		if lane == LANE_EMERGENCY or gcode.matches("M112") or gcode.matches("M410"):
+			self._sendEmergencyCommand(cmd, gcode)
+		elif self.isBusy():
+			# while transferring a file to SD anything we send would end up in the file, so that has to wait too
+			self._commandQueue.put(cmd, lane)
 		elif self.isOperational():
-			self._sendCommand(cmd)
+			self._sendCommand(cmd, lineClass=LINE_CLASS_USER if lane == LANE_INTERACTIVE else None, gcode=gcode)
+
+	def _sendEmergencyCommand(self, cmd, gcode):
+		"""
+		 Writes cmd directly to the serial port, ahead of whatever is waiting to be written, and without line number so
+		 it doesn't depend on the line numbering being intact. That's also done in the middle of an SD transfer, an
+		 emergency stop is more important than a clean file. It still counts as one line in flight for the send window,
+		 and without the send window it's only the last ok of the lines in flight that sends the next line. Both except
+		 for an M112, firmware halted by it won't acknowledge anything anymore.
+		"""
+		with self._sendingLock:
+			serialPort = self._serial
+			if serialPort is None:
+				return
+
+			start = time.time()
+			acknowledged = not gcode.matches("M112")
+			if self._sendWindow is not None and acknowledged:
+				self._sendWindow.add(len(cmd) + 1)
+			self._log("Send: %s", cmd)
+			inFlight = self._addInFlight(LINE_CLASS_EMERGENCY, start, acknowledged)
+			if self._write(serialPort, cmd + "\n"):
+				end = time.time()
+				self._commandQueue.addEmergency(end - start)
+				self._onWritten(LINE_CLASS_EMERGENCY, None, start, end)
+			else:
+				self._removeInFlight(inFlight)
 	
-	def printGCode(self, gcodeList):
+	def printGCode(self, gcodeList, printTimeIndex=None):
+		"""
+		 Starts printing gcodeList. printTimeIndex may be the estimated print time of the job up to every one of its
+		 lines as produced by the analysis, see gcodeInterpreter.gcode.timeIndex, which makes for far better estimates
+		 of the remaining print time than extrapolating from the progress.
+		"""
 		if not self.isOperational() or self.isPrinting():
 			return
 		if self._sdPrinting:
 			self._sdPrinting = False
+		if not isinstance(gcodeList, PrintJob):
+			gcodeList = ListPrintJob(gcodeList)
+		if printTimeIndex is not None and len(printTimeIndex) != len(gcodeList):
+			self._log("Print time index doesn't match the print job, not using it for estimates")
+			printTimeIndex = None
 		self._gcodeList = gcodeList
+		self._printTimeIndex = printTimeIndex
 		self._gcodePos = 0
+		self._heatupWaitTimeLost = 0.0
 		self._printSection = 'CUSTOM'
+		self._heldLine = None
+
+		self._stopLinePreparer()
+		lookahead = settings().getInt(["serial", "prepareLinesAhead"])
+		if lookahead > 0:
+			self._linePreparer = JobLinePreparer(gcodeList, lookahead, self._feedRateModifier)
+			if self._alwaysSendChecksum:
+				self._linePreparer.restart(0, self._currentLine, self._printSection)
+			else:
+				self._linePreparer.restart(0, 0, self._printSection)
+		self._jobLatencies = CommandLatencies()
 		self._changeState(self.STATE_PRINTING)
 		self._printStartTime = time.time()
-		self._sendNext()
+		if self._sendWindow is not None:
+			self._fillSendWindow()
+		elif not self._isAwaitingAcknowledgement():
+			self._sendNext()
 
 	def printSdFile(self):
 		if not self.isOperational() or self.isPrinting():
@@ -990,25 +3189,31 @@ class MachineCom(object):
 
 		self._printSection = 'CUSTOM'
 		self._sdPrinting = True
+		self._jobLatencies = CommandLatencies()
 		self._changeState(self.STATE_PRINTING)
 		self._printStartTime = time.time()
+		self._setSdStatusAutoreport(True)
 
 	def cancelPrint(self):
 		if self.isOperational():
 			self._changeState(self.STATE_OPERATIONAL)
+		self._heldLine = None
+		self._stopLinePreparer()
 		if self._sdPrinting:
 			self._sdPrinting = False
 			self.sendCommand("M25")    # pause print
 			self.sendCommand("M26 S0") # reset position in file to byte 0
+			self._setSdStatusAutoreport(False)
 	
 	def setPause(self, pause):
 		if not pause and self.isPaused():
 			self._changeState(self.STATE_PRINTING)
 			if self._sdPrinting:
 				self.sendCommand("M24")
-			else:
-				for i in xrange(0, 6):
-					self._sendNext()
+			elif self._sendWindow is not None:
+				self._fillSendWindow()
+			elif not self._isAwaitingAcknowledgement():
+				self._sendNext()
 		if pause and self.isPrinting():
 			self._changeState(self.STATE_PAUSED)
 			if self._sdPrinting:
@@ -1016,6 +3221,10 @@ class MachineCom(object):
 
 	def setFeedrateModifier(self, type, value):
 		self._feedRateModifier[type] = value
+		linePreparer = self._linePreparer
+		if linePreparer is not None:
+			# already prepared lines still carry the old feedrates
+			linePreparer.invalidate()
 
 	def getFeedrateModifiers(self):
 		result = {}
@@ -1026,20 +3235,41 @@ class MachineCom(object):
 	def getSdFiles(self):
 		return self._sdFiles
 
-	def startSdFileTransfer(self, filename):
-		if not self.isOperational() or self.isPrinting() or self.isPaused():
-			return
-
-		self._changeState(self.STATE_RECEIVING_FILE)
-		self.sendCommand("M28 %s" % filename.lower())
+	def startSdFileTransfer(self, filename, lines):
+		"""
+		 Writes the given lines (an iterable of already stripped G-code commands, consumed lazily) to a file on the SD
+		 card. Each line is sent as soon as the firmware acknowledged the previous one (or, in streaming mode, as soon as
+		 there is room in the send window) and the transfer is finished with M29 once everything got acknowledged. Use
+		 waitForSdFileTransfer to wait for that.
+		"""
+		if not self.isOperational() or self.isBusy() or self.isPaused():
+			return False
 
-	def endSdFileTransfer(self, filename):
-		if not self.isOperational() or self.isPrinting() or self.isPaused():
-			return
-
-		self.sendCommand("M29 %s" % filename.lower())
-		self._changeState(self.STATE_OPERATIONAL)
-		self.refreshSdFiles()
+		with self._sendingLock:
+			self._sdTransferFilename = filename.lower()
+			self._sdTransferLines = iter(lines)
+			self._sdTransferFinished.clear()
+			self._heldLine = None
+			self._communicationTimeout = time.time() + 5
+
+			# the line numbers have to be reset before M28, everything after that ends up in the file. Without a send
+			# window the ok for the M110 mustn't trigger the first line of the file yet, that's what the ok for the M28 is for
+			self._changeState(self.STATE_RECEIVING_FILE)
+			if self._sendWindow is None:
+				self._sdTransferSkipAcks = 1
+			else:
+				self._sdTransferSkipAcks = 0
+			self._sendCommand("M110 N0")
+			self._sendCommand("M28 %s" % self._sdTransferFilename)
+			if self._sendWindow is not None:
+				self._fillSendWindow()
+		return True
+
+	def waitForSdFileTransfer(self, timeout=None):
+		"""
+		 Waits up to timeout seconds for the running SD transfer to finish, returns whether it did (or got aborted).
+		"""
+		return self._sdTransferFinished.wait(timeout) or self._state != self.STATE_RECEIVING_FILE
 
 	def selectSdFile(self, filename):
 		if not self.isOperational() or self.isPrinting() or self.isPaused():
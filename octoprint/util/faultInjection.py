@@ -0,0 +1,280 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+# Resilience of the printer communication against a noisy serial line. Prints a job of short segments through
+# MachineCom against the simulated printer of octoprint.util.serialBenchmark, with a FaultInjector corrupting the
+# traffic in between, and reports the effective throughput, how long it took to recover from every fault and whether
+# the print would have been aborted. The results are written as JSON.
+#
+# Usage: python -m octoprint.util.faultInjection [-h] [options]
+#
+# Linux only.
+
+import argparse
+import bisect
+import json
+import logging
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from octoprint.settings import settings
+from octoprint.util.serialBenchmark import PtyFirmware, configure, connect, distribution, writeShortSegmentJob
+
+FAULT_BIT_FLIP = "bitFlip"
+FAULT_DROPPED_BYTE = "droppedByte"
+FAULT_DUPLICATED_OK = "duplicatedOk"
+FAULT_DELAYED_RESEND = "delayedResend"
+
+OUTCOME_COMPLETED = "completed"
+OUTCOME_ABORTED = "aborted"
+OUTCOME_STALLED = "stalled"
+
+class FaultInjector(object):
+	"""
+	 Corrupts the traffic between host and firmware like a noisy line does, all rates are probabilities per line:
+
+	 <ul>
+	   <li>bitFlipRate: a random bit of the line gets flipped, in both directions</li>
+	   <li>dropRate: a random byte of the line gets lost, in both directions</li>
+	   <li>duplicateOkRate: an ok from the firmware arrives twice</li>
+	   <li>delayResendRate: a resend request from the firmware, and with it everything sent after it, arrives
+	       resendDelay seconds late</li>
+	 </ul>
+
+	 The newline terminating a line is never touched, the simulated firmware only deals in whole lines.
+	"""
+
+	def __init__(self, bitFlipRate=0.0, dropRate=0.0, duplicateOkRate=0.0, delayResendRate=0.0, resendDelay=1.0, seed=None):
+		self._bitFlipRate = bitFlipRate
+		self._dropRate = dropRate
+		self._duplicateOkRate = duplicateOkRate
+		self._delayResendRate = delayResendRate
+		self._resendDelay = resendDelay
+
+		self._random = random.Random(seed)
+		self._mutex = threading.Lock()
+		self._faults = []
+
+	def getStatistics(self):
+		"""
+		 Returns all injected faults as tuples of the time, the type of the fault and the direction it happened in.
+		"""
+		with self._mutex:
+			return list(self._faults)
+
+	def fromHost(self, line):
+		"""
+		 Returns what becomes of the line sent by the host on its way to the firmware.
+		"""
+		return self._corrupt(line, "host")
+
+	def fromFirmware(self, line):
+		"""
+		 Returns the lines that arrive at the host for the line sent by the firmware. Returns only after resendDelay
+		 seconds if the line is a resend request that got delayed.
+		"""
+		if line.startswith("Resend") and self._chance(self._delayResendRate):
+			self._addFault(FAULT_DELAYED_RESEND, "firmware")
+			time.sleep(self._resendDelay)
+		elif line.startswith("ok") and self._chance(self._duplicateOkRate):
+			self._addFault(FAULT_DUPLICATED_OK, "firmware")
+			return [line, line]
+		return [self._corrupt(line, "firmware")]
+
+	def _corrupt(self, line, direction):
+		content = line.rstrip("\n")
+		if not content:
+			return line
+
+		if self._chance(self._bitFlipRate):
+			self._addFault(FAULT_BIT_FLIP, direction)
+			with self._mutex:
+				position = self._random.randrange(len(content))
+				bit = 1 << self._random.randrange(8)
+			content = content[:position] + chr(ord(content[position]) ^ bit) + content[position + 1:]
+		if self._chance(self._dropRate):
+			self._addFault(FAULT_DROPPED_BYTE, direction)
+			with self._mutex:
+				position = self._random.randrange(len(content))
+			content = content[:position] + content[position + 1:]
+		return content + line[len(line.rstrip("\n")):]
+
+	def _chance(self, rate):
+		if rate <= 0:
+			return False
+		with self._mutex:
+			return self._random.random() < rate
+
+	def _addFault(self, type, direction):
+		with self._mutex:
+			self._faults.append((time.time(), type, direction))
+
+def recoveryTimes(faults, progress):
+	"""
+	 Returns for every fault how long it took the firmware to accept a line it hadn't accepted before the fault, or None
+	 if it never did. progress holds the tuples of time and number of the last accepted line as recorded by PtyFirmware.
+	"""
+	progressTimes = [t for (t, lineNumber) in progress]
+
+	result = []
+	for (faultTime, type, direction) in faults:
+		index = bisect.bisect_right(progressTimes, faultTime)
+		if index > 0:
+			lastLine = progress[index - 1][1]
+		else:
+			lastLine = 0
+
+		recovery = None
+		for (t, lineNumber) in progress[index:]:
+			if lineNumber > lastLine:
+				recovery = t - faultTime
+				break
+		result.append((type, direction, recovery))
+	return result
+
+def waitForProgress(comm, timeout, interval=0.01):
+	"""
+	 Waits for the print to end, returns False if it didn't get any further for timeout seconds.
+	"""
+	position = comm.getPrintPos()
+	lastProgress = time.time()
+	while comm.isPrinting():
+		if comm.getPrintPos() != position:
+			position = comm.getPrintPos()
+			lastProgress = time.time()
+		elif time.time() - lastProgress > timeout:
+			return False
+		time.sleep(interval)
+	return True
+
+def runFaultyJob(options, seed):
+	"""
+	 Prints a job of short segments with faults injected at the rates in options, returns how it went.
+	"""
+	from octoprint.util.printJob import MemoryPrintJob
+
+	configure(options, streaming=options.streaming)
+	(path, lines) = writeShortSegmentJob(options.lines)
+	job = MemoryPrintJob(path)
+
+	injector = FaultInjector(bitFlipRate=options.bitFlipRate, dropRate=options.dropRate, duplicateOkRate=options.duplicateOkRate,
+		delayResendRate=options.delayResendRate, resendDelay=options.resendDelay, seed=seed)
+	firmware = PtyFirmware(faultInjector=injector)
+	firmware.start()
+	try:
+		(comm, connectTime) = connect(firmware, options)
+		try:
+			start = time.time()
+			comm.printGCode(job)
+			waitForProgress(comm, options.timeout)
+			duration = time.time() - start
+
+			if comm.isOperational() and not comm.isPrinting() and comm.getPrintPos() >= len(job):
+				outcome = OUTCOME_COMPLETED
+			elif comm.isError() or comm.isClosedOrError():
+				outcome = OUTCOME_ABORTED
+			else:
+				outcome = OUTCOME_STALLED
+			position = comm.getPrintPos()
+			if comm.isError():
+				# the error may quote a corrupted line, which doesn't make it into JSON as it is
+				error = comm.getErrorString().decode("ascii", "replace")
+			else:
+				error = None
+		finally:
+			comm.close()
+	finally:
+		statistics = firmware.stop()
+
+	# faults during connecting don't concern the print
+	faults = filter(lambda fault: fault[0] >= start, statistics["faults"])
+	recoveries = recoveryTimes(faults, statistics["progress"])
+	if outcome == OUTCOME_COMPLETED:
+		# the print got done, so anything after the last accepted line was harmless
+		recoveries = filter(lambda recovery: recovery[2] is not None, recoveries)
+
+	faultCounts = {}
+	recoveryByType = {}
+	for (type, direction, recovery) in recoveries:
+		key = "%s/%s" % (type, direction)
+		faultCounts[key] = faultCounts.get(key, 0) + 1
+		if recovery is not None:
+			recoveryByType.setdefault(key, []).append(recovery)
+
+	return {
+		"seed": seed,
+		"outcome": outcome,
+		"error": error,
+		"lines": lines,
+		"linesSent": position,
+		"duration": duration,
+		"linesPerSecond": position / duration,
+		"faults": faultCounts,
+		"unrecoveredFaults": len(filter(lambda recovery: recovery[2] is None, recoveries)),
+		"recoveryTime": distribution([recovery for (type, direction, recovery) in recoveries if recovery is not None]),
+		"recoveryTimeByFault": dict((key, distribution(values)) for (key, values) in recoveryByType.items()),
+		"firmware": {"received": statistics["received"], "lost": statistics["lost"], "errors": statistics["errors"]}
+	}
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="python -m octoprint.util.faultInjection")
+
+	parser.add_argument("--lines", action="store", type=int, default=2000,
+		help="Number of moves in the print job, defaults to 2000")
+	parser.add_argument("--runs", action="store", type=int, default=3,
+		help="Number of prints, every one with another seed, defaults to 3")
+	parser.add_argument("--seed", action="store", type=int, default=1,
+		help="Seed of the first print, defaults to 1")
+	parser.add_argument("--streaming", action="store_true",
+		help="Print in streaming mode")
+	parser.add_argument("--baudrate", action="store", type=int, default=115200,
+		help="Baudrate of the simulated serial line, defaults to 115200")
+	parser.add_argument("--move-time-scale", action="store", type=float, dest="moveTimeScale", default=1.0,
+		help="Factor applied to the duration of every move, defaults to 1.0")
+	parser.add_argument("--bit-flips", action="store", type=float, dest="bitFlipRate", default=0.002,
+		help="Probability of a line getting a bit flipped, defaults to 0.002")
+	parser.add_argument("--dropped-bytes", action="store", type=float, dest="dropRate", default=0.002,
+		help="Probability of a line losing a byte, defaults to 0.002")
+	parser.add_argument("--duplicated-oks", action="store", type=float, dest="duplicateOkRate", default=0.002,
+		help="Probability of an ok arriving twice, defaults to 0.002")
+	parser.add_argument("--delayed-resends", action="store", type=float, dest="delayResendRate", default=0.2,
+		help="Probability of a resend request arriving late, defaults to 0.2")
+	parser.add_argument("--resend-delay", action="store", type=float, dest="resendDelay", default=0.5,
+		help="Seconds a delayed resend request arrives late, defaults to 0.5")
+	parser.add_argument("--timeout", action="store", type=float, default=60.0,
+		help="Seconds without progress after which a print counts as stalled, defaults to 60")
+	parser.add_argument("-o", "--output", action="store", dest="output",
+		help="Write the results to this file instead of stdout")
+	options = parser.parse_args(args)
+
+	logging.basicConfig(level=logging.WARN)
+
+	basedir = tempfile.mkdtemp()
+	try:
+		settings(init=True, basedir=basedir)
+
+		results = {"python": sys.version.split()[0], "options": vars(options), "runs": []}
+		for seed in xrange(options.seed, options.seed + options.runs):
+			print >> sys.stderr, "Printing with seed %d..." % seed
+			result = runFaultyJob(options, seed)
+			results["runs"].append(result)
+			print >> sys.stderr, "  %(outcome)s, %(linesPerSecond).0f lines/s, %(unrecoveredFaults)d unrecovered faults" % result
+	finally:
+		shutil.rmtree(basedir, ignore_errors=True)
+
+	output = json.dumps(results, indent=2, sort_keys=True)
+	if options.output:
+		with open(options.output, "w") as f:
+			f.write(output + "\n")
+	else:
+		print output
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -4,8 +4,9 @@ import sys
 import math
 import re
 import os
+from array import array
 
-from octoprint.util import util3d
+from octoprint.util import util3d, parseGcode, stripGcodeComment
 
 preferences = {
 	"extruder_offset_x1": -22.0,
@@ -34,10 +35,12 @@ class gcodePath(object):
 
 class gcode(object):
 	def __init__(self):
-		self.regMatch = {}
 		self.layerList = []
 		self.extrusionAmount = 0
 		self.totalMoveTimeMinute = 0
+		# the estimated print time in minutes up to and including each line that actually gets sent to the printer, for
+		# files numbered like print jobs (whose line 0 is the M110 resetting the line numbers)
+		self.timeIndex = array("f")
 		self.progressCallback = None
 		self._abort = False
 	
@@ -45,6 +48,7 @@ class gcode(object):
 		if os.path.isfile(filename):
 			self._fileSize = os.stat(filename).st_size
 			gcodeFile = open(filename, 'r')
+			self.timeIndex.append(0.0)
 			self._load(gcodeFile)
 			gcodeFile.close()
 	
@@ -95,10 +99,11 @@ class gcode(object):
 				pathType = line[6:].strip()
 				if pathType != "CUSTOM":
 					startCodeDone = True
-					
-			if ';' in line:
+
+			gcode = parseGcode(line)
+			comment = gcode.comment
+			if comment is not None:
 				#Slic3r GCode comment parser
-				comment = line[line.find(';')+1:].strip()
 				if comment == 'fill':
 					pathType = 'FILL'
 				elif comment == 'perimeter':
@@ -110,8 +115,8 @@ class gcode(object):
 					currentLayer = []
 				if pathType != "CUSTOM":
 					startCodeDone = True
-				line = line[0:line.find(';')]
-			T = self.getCodeInt(line, 'T')
+			# tool changes are rare, most lines don't need to be looked at for them
+			T = gcode.getInt('T') if 'T' in line or 't' in line else None
 			if T is not None:
 				if currentExtruder > 0:
 					posOffset.x -= getPreference('extruder_offset_x%d' % (currentExtruder), 0.0)
@@ -121,15 +126,13 @@ class gcode(object):
 					posOffset.x += getPreference('extruder_offset_x%d' % (currentExtruder), 0.0)
 					posOffset.y += getPreference('extruder_offset_y%d' % (currentExtruder), 0.0)
 			
-			G = self.getCodeInt(line, 'G')
+			letter = gcode.letter
+			G = gcode.number if letter == 'G' else None
 			if G is not None:
 				if G == 0 or G == 1:	#Move
-					x = self.getCodeFloat(line, 'X')
-					y = self.getCodeFloat(line, 'Y')
-					z = self.getCodeFloat(line, 'Z')
-					e = self.getCodeFloat(line, 'E')
-					f = self.getCodeFloat(line, 'F')
-					oldPos = pos.copy()
+					(x, y, z, e, f) = gcode.getFloats('X', 'Y', 'Z', 'E', 'F')
+					# the old position only as its coordinates, moves are most of a file and copies of pos don't come cheap
+					(oldX, oldY, oldZ) = (pos.x, pos.y, pos.z)
 					if x is not None:
 						if posAbs:
 							pos.x = x * scale + posOffset.x
@@ -148,7 +151,8 @@ class gcode(object):
 					if f is not None:
 						feedRate = f
 					if x is not None or y is not None or z is not None:
-						totalMoveTimeMinute += (oldPos - pos).vsize() / feedRate
+						(dx, dy, dz) = (oldX - pos.x, oldY - pos.y, oldZ - pos.z)
+						totalMoveTimeMinute += math.sqrt(dx * dx + dy * dy + dz * dz) / feedRate
 					moveType = 'move'
 					if e is not None:
 						if posAbsExtruder:
@@ -167,10 +171,10 @@ class gcode(object):
 							currentE += e
 						if totalExtrusion > maxExtrusion:
 							maxExtrusion = totalExtrusion
-					if moveType == 'move' and oldPos.z != pos.z:
-						if oldPos.z > pos.z and abs(oldPos.z - pos.z) > 5.0 and pos.z < 1.0:
-							oldPos.z = 0.0
-						layerThickness = abs(oldPos.z - pos.z)
+					if moveType == 'move' and oldZ != pos.z:
+						if oldZ > pos.z and abs(oldZ - pos.z) > 5.0 and pos.z < 1.0:
+							oldZ = 0.0
+						layerThickness = abs(oldZ - pos.z)
 					if currentPath.type != moveType or currentPath.pathType != pathType:
 						currentPath = gcodePath(moveType, pathType, layerThickness, currentPath.list[-1])
 						currentLayer.append(currentPath)
@@ -179,10 +183,10 @@ class gcode(object):
 					newPos.extrudeAmountMultiply = extrudeAmountMultiply
 					currentPath.list.append(newPos)
 				elif G == 4:	#Delay
-					S = self.getCodeFloat(line, 'S')
+					S = gcode.getFloat('S')
 					if S is not None:
 						totalMoveTimeMinute += S / 60
-					P = self.getCodeFloat(line, 'P')
+					P = gcode.getFloat('P')
 					if P is not None:
 						totalMoveTimeMinute += P / 60 / 1000
 				elif G == 20:	#Units are inches
@@ -190,9 +194,9 @@ class gcode(object):
 				elif G == 21:	#Units are mm
 					scale = 1.0
 				elif G == 28:	#Home
-					x = self.getCodeFloat(line, 'X')
-					y = self.getCodeFloat(line, 'Y')
-					z = self.getCodeFloat(line, 'Z')
+					x = gcode.getFloat('X')
+					y = gcode.getFloat('Y')
+					z = gcode.getFloat('Z')
 					if x is None and y is None and z is None:
 						pos = util3d.Vector3()
 					else:
@@ -209,10 +213,10 @@ class gcode(object):
 					posAbs = False
 					posAbsExtruder = False
 				elif G == 92:
-					x = self.getCodeFloat(line, 'X')
-					y = self.getCodeFloat(line, 'Y')
-					z = self.getCodeFloat(line, 'Z')
-					e = self.getCodeFloat(line, 'E')
+					x = gcode.getFloat('X')
+					y = gcode.getFloat('Y')
+					z = gcode.getFloat('Z')
+					e = gcode.getFloat('E')
 					if e is not None:
 						currentE = e
 					if x is not None:
@@ -226,7 +230,7 @@ class gcode(object):
 						print "Unknown G code:" + str(G)
 					unknownGcodes[G] = True
 			else:
-				M = self.getCodeInt(line, 'M')
+				M = gcode.number if letter == 'M' else None
 				if M is not None:
 					if M == 1:	#Message with possible wait (ignored)
 						pass
@@ -267,38 +271,25 @@ class gcode(object):
 					elif M == 190:	#Set bed temperature & wait
 						pass
 					elif M == 221:	#Extrude amount multiplier
-						s = self.getCodeFloat(line, 'S')
+						s = gcode.getFloat('S')
 						if s != None:
 							extrudeAmountMultiply = s / 100.0
 					else:
 						if M not in unknownMcodes:
 							print "Unknown M code:" + str(M)
 						unknownMcodes[M] = True
+			# same as the print job, which only keeps the lines left after stripping them
+			if stripGcodeComment(line):
+				self.timeIndex.append(totalMoveTimeMinute)
 		self.layerList.append(currentLayer)
 		self.extrusionAmount = maxExtrusion
 		self.totalMoveTimeMinute = totalMoveTimeMinute
 
 	def getCodeInt(self, line, code):
-		if code not in self.regMatch:
-			self.regMatch[code] = re.compile(code + '([^\s]+)')
-		m = self.regMatch[code].search(line)
-		if m == None:
-			return None
-		try:
-			return int(m.group(1))
-		except:
-			return None
+		return parseGcode(line).getInt(code)
 
 	def getCodeFloat(self, line, code):
-		if code not in self.regMatch:
-			self.regMatch[code] = re.compile(code + '([^\s]+)')
-		m = self.regMatch[code].search(line)
-		if m == None:
-			return None
-		try:
-			return float(m.group(1))
-		except:
-			return None
+		return parseGcode(line).getFloat(code)
 
 if __name__ == '__main__':
 	for filename in sys.argv[1:]:
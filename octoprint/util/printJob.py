@@ -0,0 +1,355 @@
+# coding=utf-8
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+import mmap
+import os
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+
+from octoprint.util import parseGcode, stripGcodeComment
+
+# what the sending side needs to know about a line of a print job, see PrintJob.getTokens
+LINE_OTHER = 0
+LINE_PAUSE = 1
+LINE_SPECIAL = 2
+LINE_MOVE_Z = 3
+LINE_IRREGULAR = 4
+
+_pauseCommands = ("M0", "M1")
+_specialCommands = ("M104", "M109", "M110", "M140", "M190")
+_digits = re.compile("[0-9]*")
+
+def tokenizeLine(line):
+	"""
+	 Pre-parses a stripped line of a print job and returns a tuple (code, feedrate, z).
+
+	 code is one of the LINE_* constants: LINE_PAUSE for M0 and M1, LINE_SPECIAL for commands the sending side has to
+	 take care of itself (target temperatures, line number resets), LINE_MOVE_Z for G0/G1 moves with a Z value and
+	 LINE_IRREGULAR for anything that can't be pre-parsed reliably and has to be looked at when sending. feedrate is the
+	 position of the digits of the line's F parameter packed into one integer as start << 16 | end, 0 if there is none.
+	 z is the Z value of LINE_MOVE_Z lines, None otherwise.
+	"""
+	code = LINE_OTHER
+	z = None
+
+	# only M commands and moves with a Z value are of interest, most lines don't need to be parsed at all
+	first = line[:1]
+	if first.isspace():
+		first = line.lstrip()[:1]
+	if first == "M" or first == "m" or ((first == "G" or first == "g") and ("Z" in line or "z" in line)):
+		gcode = parseGcode(line)
+		command = gcode.command
+		if command in _pauseCommands:
+			return (LINE_PAUSE, 0, None)
+		elif command in _specialCommands:
+			code = LINE_SPECIAL
+		elif (command == "G0" or command == "G1") and "Z" in gcode.parameters:
+			try:
+				z = float(gcode.parameters["Z"])
+				code = LINE_MOVE_Z
+			except ValueError:
+				return (LINE_IRREGULAR, 0, None)
+
+	feedrate = 0
+	start = line.find("F") + 1
+	if start:
+		if line.find("F", start) >= 0:
+			return (LINE_IRREGULAR, 0, None)
+		# usually the value runs up to the next parameter or the end of the line
+		end = line.find(" ", start)
+		if end < 0:
+			end = len(line)
+		if not line[start:end].isdigit():
+			end = _digits.match(line, start).end()
+			if start == end:
+				return (LINE_IRREGULAR, 0, None)
+		if end > 0xffff:
+			return (LINE_IRREGULAR, 0, None)
+		feedrate = start << 16 | end
+
+	return (code, feedrate, z)
+
+def _isExtrusion(line):
+	"""
+	 Returns whether the line is a move that extrudes, as opposed to a travel move or a retraction.
+	"""
+	gcode = parseGcode(line)
+	if gcode.command != "G0" and gcode.command != "G1":
+		return False
+	parameters = gcode.parameters
+	if not "E" in parameters or not ("X" in parameters or "Y" in parameters):
+		return False
+	e = gcode.getFloat("E")
+	return e is not None and e > 0
+
+def applyFeedrateModifier(line, feedrate, modifier):
+	"""
+	 Multiplies the F parameter of the line, as located by tokenizeLine, with modifier.
+	"""
+	start = feedrate >> 16
+	end = feedrate & 0xffff
+	return line[:start] + str(int(int(line[start:end]) * modifier)) + line[end:]
+
+class PrintJob(object):
+	"""
+	 Base class for print jobs. A print job behaves like the list of lines the comm layer expects: line 0 is the M110
+	 resetting the line numbers, every other line is either a str or, if the print section (as marked by ";TYPE:"
+	 comments) changes with it, a tuple of the line and the new section.
+
+	 The section changes are kept in a small sorted table instead of with every line, subclasses only have to provide
+	 the stripped lines themselves: __len__ returns the number of lines including line 0, _getLine(index) the stripped
+	 line at index without its section. Every line is pre-parsed while loading, see getTokens, which also yields an
+	 index of the layers, see getLayer.
+	"""
+
+	chunkSize = 1024 * 1024
+
+	def __init__(self):
+		# indices of the lines at which the print section changes and the new sections
+		self._sectionIndices = array("I")
+		self._sections = []
+
+		# the tokens of all lines as returned by tokenizeLine, with the Z values only stored for the lines having one
+		self._codes = array("B", [LINE_SPECIAL])
+		self._feedrates = array("I", [0])
+		self._zIndices = array("I")
+		self._zValues = array("d")
+
+		# the lines at which the layers start and their heights. A layer starts where Z goes above the top layer so far,
+		# but only once something gets extruded at the new height, Z hops and lifts for travel moves don't count.
+		self._layerIndices = array("I")
+		self._layerHeights = array("d")
+		self._pendingLayer = None
+
+	def __getitem__(self, index):
+		length = len(self)
+		if index < 0:
+			index += length
+		if index < 0 or index >= length:
+			raise IndexError("print job line index out of range")
+
+		line = self._getLine(index)
+
+		i = bisect_left(self._sectionIndices, index)
+		if i < len(self._sectionIndices) and self._sectionIndices[i] == index:
+			return (line, self._sections[i])
+		return line
+
+	def getTokens(self, index):
+		"""
+		 Returns the tuple (code, feedrate, z) tokenizeLine returned for the line at index.
+		"""
+		code = self._codes[index]
+		z = None
+		if code == LINE_MOVE_Z:
+			z = self._zValues[bisect_left(self._zIndices, index)]
+		return (code, self._feedrates[index], z)
+
+	def getLayerCount(self):
+		return len(self._layerIndices)
+
+	def getLayer(self, index):
+		"""
+		 Returns a tuple (layer, height, progress) for the line at index: the number of the layer it belongs to (counted
+		 from 1, 0 before the first layer), the height of that layer and how far into the layer the line is, as a float
+		 between 0 and 1.
+		"""
+		layer = bisect_right(self._layerIndices, index)
+		if layer == 0:
+			return (0, None, 0.0)
+
+		start = self._layerIndices[layer - 1]
+		if layer < len(self._layerIndices):
+			end = self._layerIndices[layer]
+		else:
+			end = len(self)
+		return (layer, self._layerHeights[layer - 1], float(index - start) / float(end - start))
+
+	def _addTokens(self, commands):
+		index = len(self._codes)
+		codes = self._codes
+		feedrates = self._feedrates
+
+		# most lines have nothing to pre-parse, so all lines start out as that and only the others get their tokens set
+		codes.fromstring(chr(LINE_OTHER) * len(commands))
+		feedrates.extend(array("I", [0]) * len(commands))
+
+		pendingLayer = self._pendingLayer
+		for command in commands:
+			if "F" in command or "Z" in command or "z" in command or "M" in command or "m" in command:
+				(code, feedrate, z) = tokenizeLine(command)
+				codes[index] = code
+				feedrates[index] = feedrate
+				if z is not None:
+					self._zIndices.append(index)
+					self._zValues.append(z)
+					if len(self._layerHeights) > 0 and z <= self._layerHeights[-1]:
+						pendingLayer = None
+					elif pendingLayer is None:
+						pendingLayer = (index, z)
+					else:
+						# the layer starts with the first move up to it, e.g. with a Z hop before travelling to its start
+						pendingLayer = (pendingLayer[0], z)
+			if pendingLayer is not None and ("E" in command or "e" in command) and _isExtrusion(command):
+				self._layerIndices.append(pendingLayer[0])
+				self._layerHeights.append(pendingLayer[1])
+				pendingLayer = None
+			index += 1
+		self._pendingLayer = pendingLayer
+
+	def _scan(self, f, size, progressCallback):
+		"""
+		 Reads the G-code file f in big chunks and yields for every chunk a list of the offsets of the lines in it that
+		 are to be sent and a list of these lines, stripped of comments and whitespace. Records the section changes on
+		 the way.
+		"""
+		section = prevSection = "CUSTOM"
+		index = 1
+		offset = 0
+		while True:
+			chunk = f.read(self.chunkSize)
+			if not chunk:
+				break
+			if not chunk.endswith("\n"):
+				# don't cut a line in half
+				chunk += f.readline()
+
+			lines = chunk.split("\n")
+			if lines[-1] == "":
+				lines.pop()
+
+			offsets = []
+			commands = []
+			for line in lines:
+				lineOffset = offset
+				offset += len(line) + 1
+				if ";" in line:
+					if line.startswith(";TYPE:"):
+						section = line[6:].strip()
+					line = stripGcodeComment(line)
+				else:
+					line = line.strip()
+				if line:
+					if prevSection != section:
+						self._sectionIndices.append(index + len(commands))
+						self._sections.append(section)
+						prevSection = section
+					offsets.append(lineOffset)
+					commands.append(line)
+			index += len(commands)
+			self._addTokens(commands)
+
+			if progressCallback is not None:
+				progressCallback(min(1.0, float(offset) / float(size)))
+			yield (offsets, commands)
+
+class FilePrintJob(PrintJob):
+	"""
+	 A print job backed by the G-code file itself. The file is memory mapped and only the offsets of the lines that are
+	 actually to be sent are kept in memory, the lines get stripped of comments and whitespace on demand. That keeps
+	 the memory needed for a print job small, no matter how big the file is.
+
+	 The file must not be modified while the job is in use, replacing or deleting it is fine though.
+	"""
+
+	def __init__(self, filename, progressCallback=None):
+		PrintJob.__init__(self)
+
+		# offsets into the file of all lines to send, line 0 isn't part of the file
+		self._offsets = array("I", [0])
+
+		size = os.stat(filename).st_size
+		with open(filename, "rb") as f:
+			for (offsets, commands) in self._scan(f, size, progressCallback):
+				self._offsets.extend(array("I", offsets))
+			if size > 0:
+				self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			else:
+				self._map = None
+
+	def __len__(self):
+		return len(self._offsets)
+
+	def _getLine(self, index):
+		if index == 0:
+			return "M110 N0"
+
+		start = self._offsets[index]
+		end = self._map.find("\n", start)
+		if end < 0:
+			end = len(self._map)
+		return stripGcodeComment(self._map[start:end])
+
+	def close(self):
+		if self._map is not None:
+			self._map.close()
+			self._map = None
+
+class MemoryPrintJob(PrintJob):
+	"""
+	 A print job held completely in memory, for when the file can't stay around unchanged for the duration of the
+	 print. All stripped lines are stored back to back in one byte buffer, with an array of the offsets at which they
+	 start. That takes a fraction of the memory a list of one str per line would need.
+	"""
+
+	def __init__(self, filename, progressCallback=None):
+		PrintJob.__init__(self)
+
+		size = os.stat(filename).st_size
+
+		# the stripped lines never take up more room than the file itself, so that's all we'll ever need
+		self._buffer = bytearray(size + 8)
+		self._buffer[0:8] = "M110 N0\n"
+		pos = 8
+		# offsets into the buffer of all lines, followed by the end of the buffer
+		self._offsets = array("I", [0])
+
+		with open(filename, "rb") as f:
+			for (fileOffsets, commands) in self._scan(f, size, progressCallback):
+				if len(commands) == 0:
+					continue
+				start = pos
+				offsets = []
+				for command in commands:
+					offsets.append(pos)
+					pos += len(command) + 1
+				self._offsets.extend(array("I", offsets))
+				self._buffer[start:pos] = "\n".join(commands) + "\n"
+		self._offsets.append(pos)
+		del self._buffer[pos:]
+
+	def __len__(self):
+		return len(self._offsets) - 1
+
+	def _getLine(self, index):
+		# every line is followed by a newline, which isn't part of it
+		return str(self._buffer[self._offsets[index]:self._offsets[index + 1] - 1])
+
+class ListPrintJob(PrintJob):
+	"""
+	 A print job made from a list of lines in the format of the other print jobs, for jobs that don't come from a file.
+	"""
+
+	def __init__(self, lines):
+		PrintJob.__init__(self)
+
+		self._lines = []
+		for line in lines:
+			if type(line) is tuple:
+				(line, section) = line
+				self._sectionIndices.append(len(self._lines))
+				self._sections.append(section)
+			self._lines.append(line)
+
+		# unlike with the other print jobs the first line is one of the given ones
+		del self._codes[:]
+		del self._feedrates[:]
+		self._addTokens(self._lines)
+
+	def __len__(self):
+		return len(self._lines)
+
+	def _getLine(self, index):
+		return self._lines[index]
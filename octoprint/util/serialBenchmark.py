@@ -0,0 +1,483 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+# End to end benchmarks of the printer communication. MachineCom talks through pyserial to a SimulatedPrinter served
+# on the other end of a pseudo terminal pair by a separate process, so the real serial code path is measured and the
+# CPU time used by the host side isn't mixed up with the firmware's. The results are written as JSON.
+#
+# Usage: python -m octoprint.util.serialBenchmark [-h] [options] [scenario ...]
+#
+# Linux only.
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import pty
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tty
+
+from octoprint.settings import settings
+
+scenarios = ["shortSegments", "shortSegmentsStreaming", "resends", "resendsStreaming", "sdUpload", "httpCommands"]
+
+class PtyFirmware(object):
+	"""
+	 Serves a SimulatedPrinter, configured through the serial simulation settings at the time start is called, on the
+	 master side of a pseudo terminal pair from a separate process. Connect to it through the slave device found in
+	 port.
+
+	 Besides the statistics of the simulator, stop returns the gaps between every ok written to the host and the next
+	 data received from it, when every line containing an M117 was received, by the message it displays, and the
+	 progress of the firmware as tuples of the time and the number of the last line accepted up to then.
+
+	 If a faultInjector (see octoprint.util.faultInjection.FaultInjector) is given, all traffic goes through it and its
+	 statistics are returned too.
+	"""
+
+	_marker = re.compile("M117 (\S+)")
+
+	def __init__(self, faultInjector=None):
+		(self._master, self._slave) = pty.openpty()
+		tty.setraw(self._slave)
+		self.port = os.ttyname(self._slave)
+
+		self._connection = None
+		self._process = None
+
+		self._firmware = None
+		self._faultInjector = faultInjector
+		self._mutex = threading.Lock()
+		self._lastOk = None
+		self._gaps = []
+		self._markers = {}
+		self._progress = []
+
+	def start(self):
+		(self._connection, childConnection) = multiprocessing.Pipe()
+		self._process = multiprocessing.Process(target=self._serve, args=(childConnection,))
+		self._process.daemon = True
+		self._process.start()
+
+	def stop(self):
+		"""
+		 Stops the firmware and returns its statistics.
+		"""
+		self._connection.send("stop")
+		statistics = self._connection.recv()
+		self._process.join()
+		os.close(self._master)
+		os.close(self._slave)
+		return statistics
+
+	def _serve(self, connection):
+		from octoprint.util.comm import SimulatedPrinter
+
+		self._firmware = SimulatedPrinter()
+		for target in (self._receive, self._respond):
+			thread = threading.Thread(target=target)
+			thread.daemon = True
+			thread.start()
+
+		connection.recv()
+		self._firmware.close()
+		with self._mutex:
+			statistics = self._firmware.getStatistics()
+			statistics["okToSendGaps"] = self._gaps
+			statistics["markers"] = self._markers
+			statistics["progress"] = self._progress
+		if self._faultInjector is not None:
+			statistics["faults"] = self._faultInjector.getStatistics()
+		connection.send(statistics)
+
+	def _receive(self):
+		from octoprint.util.comm import LineReader
+
+		reader = LineReader()
+		while True:
+			try:
+				data = os.read(self._master, 4096)
+			except OSError:
+				return
+			if not data:
+				return
+
+			now = time.time()
+			with self._mutex:
+				if self._lastOk is not None:
+					self._gaps.append(now - self._lastOk)
+					self._lastOk = None
+			for line in reader.feed(data):
+				if self._faultInjector is not None:
+					line = self._faultInjector.fromHost(line)
+				if "M117" in line:
+					match = self._marker.search(line)
+					if match is not None:
+						with self._mutex:
+							self._markers[match.group(1)] = now
+				self._firmware.write(line)
+
+	def _respond(self):
+		while self._firmware.readList is not None:
+			line = self._firmware.readline()
+			if not line:
+				continue
+			if not line.endswith("\n"):
+				line += "\n"
+
+			if line.startswith("ok"):
+				lineNumber = self._firmware.getLastLineNumber()
+				with self._mutex:
+					if not self._progress or self._progress[-1][1] != lineNumber:
+						self._progress.append((time.time(), lineNumber))
+
+			if self._faultInjector is not None:
+				lines = self._faultInjector.fromFirmware(line)
+			else:
+				lines = [line]
+			for line in lines:
+				try:
+					os.write(self._master, line)
+				except OSError:
+					return
+				if line.startswith("ok"):
+					with self._mutex:
+						self._lastOk = time.time()
+
+def distribution(values):
+	"""
+	 Returns the number of samples and the median, 99th percentile and maximum of the given values.
+	"""
+	if not values:
+		return {"samples": 0, "p50": None, "p99": None, "max": None}
+
+	values = sorted(values)
+	percentile = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+	return {"samples": len(values), "p50": percentile(0.5), "p99": percentile(0.99), "max": values[-1]}
+
+def writeShortSegmentJob(lines):
+	"""
+	 Writes a job of lines moves of a tenth of a millimeter each, zig zagging like the infill of a small, detailed part
+	 does, and returns the path of the file and the number of commands in it. At F6000 every one of the moves takes a
+	 millisecond, faster than most hosts manage to send them. The file is kept outside of the upload folder, the
+	 analysis would compete with the benchmark for the CPU otherwise.
+	"""
+	path = os.path.join(settings().settings_dir, "benchmark.gcode")
+	with open(path, "w") as f:
+		f.write("G28 ; home\nG90\nG1 F6000\n")
+		for i in xrange(lines):
+			f.write("G1 X%.1f Y%.1f E%.5f ; infill\n" % (10 + (i % 100) * 0.1, 10 + (i / 100) % 2 * 0.1, i * 0.0033))
+		f.write("M400\n")
+	return (path, lines + 4)
+
+def cpuTime():
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	return usage.ru_utime + usage.ru_stime
+
+def waitFor(condition, timeout, interval=0.01):
+	end = time.time() + timeout
+	while not condition():
+		if time.time() > end:
+			return False
+		time.sleep(interval)
+	return True
+
+def configure(options, errorRate=0.0, streaming=False):
+	settings().set(["serial", "simulation", "baudrate"], options.baudrate)
+	settings().set(["serial", "simulation", "moveTimeScale"], options.moveTimeScale)
+	settings().set(["serial", "simulation", "errorRate"], errorRate)
+	settings().set(["serial", "simulation", "seed"], options.seed)
+	settings().set(["serial", "streaming", "enabled"], streaming)
+
+def connect(firmware, options):
+	"""
+	 Connects a MachineCom to the firmware, returns it and how long it took to become operational.
+	"""
+	from octoprint.util.comm import MachineCom
+
+	start = time.time()
+	comm = MachineCom(firmware.port, options.baudrate)
+	if not waitFor(lambda: comm.isOperational() or comm.isClosedOrError(), options.timeout) or not comm.isOperational():
+		comm.close()
+		raise RuntimeError("Could not connect to the simulated printer: %s" % comm.getStateString())
+	return (comm, time.time() - start)
+
+def collect(result, firmwareStatistics, cpu, lines):
+	result["okToSendGap"] = distribution(firmwareStatistics.pop("okToSendGaps"))
+	firmwareStatistics.pop("markers")
+	firmwareStatistics.pop("progress")
+	result["firmware"] = firmwareStatistics
+	result["cpuTimePerLine"] = cpu / lines if lines > 0 else None
+	return result
+
+def benchmarkJob(options, errorRate=0.0, streaming=False):
+	"""
+	 Prints a job of short segments, returns the throughput, the gaps between ok and the next line and the CPU time
+	 needed per line. With an errorRate, every line gets corrupted on its way with that probability, so the resend
+	 handling gets measured too.
+	"""
+	from octoprint.util.printJob import MemoryPrintJob
+
+	configure(options, errorRate=errorRate, streaming=streaming)
+	(path, lines) = writeShortSegmentJob(options.lines)
+	job = MemoryPrintJob(path)
+
+	firmware = PtyFirmware()
+	firmware.start()
+	try:
+		(comm, connectTime) = connect(firmware, options)
+		try:
+			cpuStart = cpuTime()
+			start = time.time()
+			comm.printGCode(job)
+			completed = waitFor(lambda: not comm.isPrinting(), options.timeout) and comm.isOperational()
+			duration = time.time() - start
+			cpu = cpuTime() - cpuStart
+			position = comm.getPrintPos()
+			sendQueue = comm.getSendQueueStatistics()
+			latency = comm.getLatencyStatistics()["job"]
+		finally:
+			comm.close()
+	finally:
+		statistics = firmware.stop()
+
+	result = {
+		"lines": lines,
+		"completed": completed,
+		"linesSent": position,
+		"connectTime": connectTime,
+		"duration": duration,
+		"linesPerSecond": position / duration,
+		"sendQueue": sendQueue,
+		"latency": latency
+	}
+	return collect(result, statistics, cpu, position)
+
+def benchmarkSdUpload(options):
+	"""
+	 Uploads a job of short segments to the SD card through SdFileStreamer, returns the throughput and whether the file
+	 arrived complete.
+	"""
+	from octoprint.printer import SdFileStreamer
+
+	configure(options)
+	(path, lines) = writeShortSegmentJob(options.lines)
+	sdFile = os.path.join(settings().getBaseFolder("virtualSd"), "benchmar.gco")
+
+	firmware = PtyFirmware()
+	firmware.start()
+	try:
+		(comm, connectTime) = connect(firmware, options)
+		try:
+			comm.initSdCard()
+			if not waitFor(comm.isSdReady, options.timeout):
+				raise RuntimeError("The SD card of the simulated printer didn't get ready")
+
+			progress = []
+			streamer = SdFileStreamer(comm, "benchmark.gcode", path, lambda filename, p, bytesPerSecond: progress.append(bytesPerSecond), lambda filename: None)
+
+			cpuStart = cpuTime()
+			start = time.time()
+			streamer.run()
+			duration = time.time() - start
+			cpu = cpuTime() - cpuStart
+			sendQueue = comm.getSendQueueStatistics()
+			completed = comm.isOperational()
+		finally:
+			comm.close()
+	finally:
+		statistics = firmware.stop()
+
+	linesWritten = 0
+	if os.path.exists(sdFile):
+		with open(sdFile) as f:
+			linesWritten = len(f.readlines())
+
+	result = {
+		"lines": lines,
+		"completed": completed and linesWritten == lines,
+		"linesWritten": linesWritten,
+		"connectTime": connectTime,
+		"duration": duration,
+		"linesPerSecond": lines / duration,
+		"bytesPerSecond": progress[-1] if progress else None,
+		"sendQueue": sendQueue
+	}
+	return collect(result, statistics, cpu, lines)
+
+def createApp(printerRegistry, gcodeManager):
+	"""
+	 Sets up the web application the way Server.run does with access control disabled and returns it.
+	"""
+	from flask.ext.login import LoginManager
+
+	import octoprint.server as server
+	import octoprint.users as users
+
+	server.printerRegistry = printerRegistry
+	server.gcodeManager = gcodeManager
+	if server.app.secret_key is None:
+		server.app.secret_key = os.urandom(24)
+		loginManager = LoginManager()
+		loginManager.anonymous_user = users.DummyUser
+		server.principals.identity_loaders.appendleft(users.dummy_identity_loader)
+		loginManager.init_app(server.app)
+	return server.app
+
+def benchmarkHttpCommands(options):
+	"""
+	 Prints a job of short segments through a Printer while options.clients clients concurrently post options.commands
+	 commands each to /ajax/control/command. Returns the throughput of the print, how long the requests took and how
+	 long it took each command to reach the firmware.
+	"""
+	from octoprint.gcodefiles import GcodeManager
+	from octoprint.printer import PrinterRegistry, DEFAULT_PRINTER
+	from octoprint.server import BASEURL
+
+	configure(options)
+	(path, lines) = writeShortSegmentJob(options.lines)
+
+	gcodeManager = GcodeManager()
+	printerRegistry = PrinterRegistry(gcodeManager)
+	printer = printerRegistry.get(DEFAULT_PRINTER)
+	app = createApp(printerRegistry, gcodeManager)
+
+	firmware = PtyFirmware()
+	firmware.start()
+	try:
+		start = time.time()
+		printer.connect(firmware.port, options.baudrate)
+		if not waitFor(lambda: printer.isOperational() or printer.isClosedOrError(), options.timeout) or not printer.isOperational():
+			raise RuntimeError("Could not connect to the simulated printer: %s" % printer.getStateString())
+		connectTime = time.time() - start
+
+		printer.loadGcode(path, printAfterLoading=True)
+		if not waitFor(printer.isPrinting, options.timeout):
+			raise RuntimeError("Print did not start: %s" % printer.getStateString())
+		start = time.time()
+
+		requestTimes = []
+		postTimes = {}
+		mutex = threading.Lock()
+		def post(clientNumber):
+			client = app.test_client()
+			for i in xrange(options.commands):
+				marker = "%d-%d" % (clientNumber, i)
+				requestStart = time.time()
+				client.post(BASEURL + "control/command", content_type="application/json", data=json.dumps({"command": "M117 %s" % marker}))
+				requestEnd = time.time()
+				with mutex:
+					postTimes[marker] = requestStart
+					requestTimes.append(requestEnd - requestStart)
+				time.sleep(options.commandInterval)
+
+		cpuStart = cpuTime()
+		clients = [threading.Thread(target=post, args=(i,)) for i in xrange(options.clients)]
+		for thread in clients:
+			thread.start()
+		for thread in clients:
+			thread.join()
+		completed = waitFor(lambda: not printer.isPrinting(), options.timeout) and printer.isOperational()
+		duration = time.time() - start
+		cpu = cpuTime() - cpuStart
+		statistics = printer.getSerialStatistics()
+		latency = printer.getLatencyStatistics()["job"]
+		printer.disconnect()
+	finally:
+		firmwareStatistics = firmware.stop()
+
+	markers = firmwareStatistics["markers"]
+	deliveryTimes = [markers[marker] - postTimes[marker] for marker in postTimes.keys() if marker in markers]
+	result = {
+		"lines": lines,
+		"completed": completed,
+		"commands": len(postTimes),
+		"commandsDelivered": len(deliveryTimes),
+		"connectTime": connectTime,
+		"duration": duration,
+		"linesPerSecond": lines / duration,
+		"requestTime": distribution(requestTimes),
+		"deliveryTime": distribution(deliveryTimes),
+		"serial": statistics,
+		"latency": latency
+	}
+	return collect(result, firmwareStatistics, cpu, lines + len(postTimes))
+
+def run(scenario, options):
+	if scenario == "shortSegments":
+		return benchmarkJob(options)
+	elif scenario == "shortSegmentsStreaming":
+		return benchmarkJob(options, streaming=True)
+	elif scenario == "resends":
+		return benchmarkJob(options, errorRate=options.errorRate)
+	elif scenario == "resendsStreaming":
+		return benchmarkJob(options, errorRate=options.errorRate, streaming=True)
+	elif scenario == "sdUpload":
+		return benchmarkSdUpload(options)
+	elif scenario == "httpCommands":
+		return benchmarkHttpCommands(options)
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="python -m octoprint.util.serialBenchmark")
+
+	parser.add_argument("scenarios", nargs="*", metavar="scenario",
+		help="The scenarios to run, out of %s. Defaults to all of them" % ", ".join(scenarios))
+	parser.add_argument("--lines", action="store", type=int, default=2000,
+		help="Number of moves in the print job, defaults to 2000")
+	parser.add_argument("--baudrate", action="store", type=int, default=115200,
+		help="Baudrate of the simulated serial line, defaults to 115200")
+	parser.add_argument("--move-time-scale", action="store", type=float, dest="moveTimeScale", default=1.0,
+		help="Factor applied to the duration of every move, defaults to 1.0")
+	parser.add_argument("--error-rate", action="store", type=float, dest="errorRate", default=0.01,
+		help="Probability of a line getting corrupted in the resends scenarios, defaults to 0.01")
+	parser.add_argument("--seed", action="store", type=int, default=1,
+		help="Seed for the injected errors, defaults to 1")
+	parser.add_argument("--clients", action="store", type=int, default=4,
+		help="Number of concurrent clients in the httpCommands scenario, defaults to 4")
+	parser.add_argument("--commands", action="store", type=int, default=50,
+		help="Number of commands every client posts in the httpCommands scenario, defaults to 50")
+	parser.add_argument("--command-interval", action="store", type=float, dest="commandInterval", default=0.02,
+		help="Seconds every client waits between two commands, defaults to 0.02")
+	parser.add_argument("--timeout", action="store", type=float, default=60.0,
+		help="Seconds after which a scenario is aborted, defaults to 60")
+	parser.add_argument("-o", "--output", action="store", dest="output",
+		help="Write the results to this file instead of stdout")
+	options = parser.parse_args(args)
+	for scenario in options.scenarios:
+		if not scenario in scenarios:
+			parser.error("unknown scenario: %s" % scenario)
+
+	logging.basicConfig(level=logging.WARN)
+
+	# run on a configuration of our own, the benchmark must neither depend on nor mess with the user's
+	basedir = tempfile.mkdtemp()
+	try:
+		settings(init=True, basedir=basedir)
+
+		results = {"python": sys.version.split()[0], "options": vars(options), "scenarios": {}}
+		for scenario in options.scenarios or scenarios:
+			print >> sys.stderr, "Running %s..." % scenario
+			results["scenarios"][scenario] = run(scenario, options)
+			print >> sys.stderr, "  %(linesPerSecond).0f lines/s, %(completed)s" % results["scenarios"][scenario]
+	finally:
+		shutil.rmtree(basedir, ignore_errors=True)
+
+	output = json.dumps(results, indent=2, sort_keys=True)
+	if options.output:
+		with open(options.output, "w") as f:
+			f.write(output + "\n")
+	else:
+		print output
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
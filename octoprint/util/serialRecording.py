@@ -0,0 +1,452 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+# Recording of the serial traffic between MachineCom and the printer and its offline replay. With serial.recording
+# enabled, MachineCom records everything received from and sent to the printer into serial_<port>.rec in the logs
+# folder. Replaying a recording feeds what the printer sent back into MachineCom and Printer without any hardware, e.g.
+# for reproducing a stalled print or profiling the monitor, the state updates and the callbacks against real traffic.
+#
+# Usage: python -m octoprint.util.serialRecording replay [-h] [options] recording [recording ...]
+#        python -m octoprint.util.serialRecording dump [-h] recording [recording ...]
+#
+# Rotated recordings of one session are passed oldest first, e.g. serial_ttyUSB0.rec.2 serial_ttyUSB0.rec.1
+# serial_ttyUSB0.rec.
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+try:
+	import fcntl
+except:
+	pass
+
+RECORD_RECEIVED = 1
+RECORD_SENT = 2
+
+# a recording starts with the magic, the version of the format and the time of the recording's start, followed by the
+# records: the type, the microseconds since the previous record (or the start), the length of the data and the data
+_magic = "OPSR"
+_version = 1
+_header = struct.Struct("<4sBd")
+_record = struct.Struct("<BIH")
+_maxDelta = 0xffffffff
+_maxLength = 0xffff
+
+class SessionRecorder(object):
+	"""
+	 Records the serial traffic of a session to path. Once the file would grow beyond maxSize bytes it gets rotated like
+	 a log file, the previous parts are kept as path.1 to path.<backupCount>, every part starts with its own header.
+	 A new recorder always starts a new file, a recording of the previous session gets rotated away.
+
+	 Writes are buffered and flushed at least once a second. If writing fails the recording stops, it never gets in the
+	 way of talking to the printer.
+	"""
+
+	flushInterval = 1.0
+
+	def __init__(self, path, maxSize, backupCount):
+		self._logger = logging.getLogger(__name__)
+
+		self._path = path
+		self._maxSize = maxSize
+		self._backupCount = backupCount
+
+		self._mutex = threading.Lock()
+		self._file = None
+		self._size = 0
+		self._start = None
+		self._offset = 0
+		self._lastFlush = 0
+
+		if os.path.exists(path) and os.path.getsize(path) > 0:
+			self._rotate()
+		self._open(time.time())
+
+	def received(self, data):
+		self._add(RECORD_RECEIVED, data)
+
+	def sent(self, data):
+		self._add(RECORD_SENT, data)
+
+	def close(self):
+		with self._mutex:
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+
+	def _add(self, type, data):
+		with self._mutex:
+			if self._file is None or not data:
+				return
+
+			now = time.time()
+			try:
+				for position in xrange(0, len(data), _maxLength):
+					chunk = data[position:position + _maxLength]
+					if self._size > _header.size and self._size + _record.size + len(chunk) > self._maxSize:
+						self._file.close()
+						self._file = None
+						self._rotate()
+						self._open(now)
+
+					# timestamps are kept as microseconds since the start, rounding errors must not add up over the recording
+					offset = int((now - self._start) * 1000000)
+					delta = min(max(0, offset - self._offset), _maxDelta)
+					self._offset += delta
+
+					self._file.write(_record.pack(type, delta, len(chunk)))
+					self._file.write(chunk)
+					self._size += _record.size + len(chunk)
+
+				if now - self._lastFlush > self.flushInterval:
+					self._file.flush()
+					self._lastFlush = now
+			except:
+				self._logger.exception("Could not record the serial traffic to %s, stopping the recording" % self._path)
+				if self._file is not None:
+					try:
+						self._file.close()
+					except:
+						pass
+					self._file = None
+
+	def _open(self, now):
+		self._file = open(self._path, "wb")
+		self._file.write(_header.pack(_magic, _version, now))
+		self._size = _header.size
+		self._start = now
+		self._offset = 0
+		self._lastFlush = now
+
+	def _rotate(self):
+		if self._backupCount <= 0:
+			os.remove(self._path)
+			return
+		for i in xrange(self._backupCount - 1, 0, -1):
+			source = "%s.%d" % (self._path, i)
+			if os.path.exists(source):
+				target = "%s.%d" % (self._path, i + 1)
+				if os.path.exists(target):
+					os.remove(target)
+				os.rename(source, target)
+		target = self._path + ".1"
+		if os.path.exists(target):
+			os.remove(target)
+		os.rename(self._path, target)
+
+def readRecording(path):
+	"""
+	 Yields the records in the recording at path as tuples of time, type (RECORD_RECEIVED or RECORD_SENT) and data. A
+	 record cut off at the end, e.g. because the recording was still running, is left out.
+	"""
+	with open(path, "rb") as f:
+		header = f.read(_header.size)
+		if len(header) < _header.size:
+			raise ValueError("%s is not a serial recording" % path)
+		(magic, version, start) = _header.unpack(header)
+		if magic != _magic:
+			raise ValueError("%s is not a serial recording" % path)
+		if version != _version:
+			raise ValueError("%s is a recording of unsupported version %d" % (path, version))
+
+		offset = 0
+		while True:
+			record = f.read(_record.size)
+			if len(record) < _record.size:
+				break
+			(type, delta, length) = _record.unpack(record)
+			data = f.read(length)
+			if len(data) < length:
+				break
+			offset += delta
+			yield (start + offset / 1000000.0, type, data)
+
+def readRecordings(paths):
+	"""
+	 Yields the records of the recordings at paths as one recording, the time of a record relative to the first one.
+	 Any time passed between the end of one recording and the start of the next one is left out.
+	"""
+	end = 0.0
+	for path in paths:
+		first = None
+		for (t, type, data) in readRecording(path):
+			if first is None:
+				first = t - end
+			yield (t - first, type, data)
+			end = t - first
+
+class RecordedPrinter(object):
+	"""
+	 Stands in for the printer a session got recorded with, behind the VIRTUAL port if serial.replay.files is set.
+	 Everything the printer sent gets received again at the time it got recorded, divided by speed (0 for as fast as
+	 possible). What's written is only counted, the recording doesn't react to it. Once everything got received, reading
+	 fails like it does when the printer gets unplugged.
+	"""
+
+	def __init__(self, paths, speed=1.0):
+		self.timeout = None
+
+		self._speed = speed
+		self._received = []
+		self._recordedSent = 0
+		for (t, type, data) in readRecordings(paths):
+			if type == RECORD_RECEIVED:
+				self._received.append((t, data))
+			elif type == RECORD_SENT:
+				self._recordedSent += data.count("\n")
+
+		self._buffer = ""
+		self._mutex = threading.Lock()
+		self._closed = threading.Event()
+		self._finished = False
+		self._bytesReceived = 0
+		self._linesSent = 0
+
+		# wakes up select once there's something to read, like the VirtualPrinter does
+		if os.name == "nt":
+			self._notificationPipe = None
+		else:
+			self._notificationPipe = os.pipe()
+			fcntl.fcntl(self._notificationPipe[0], fcntl.F_SETFL, fcntl.fcntl(self._notificationPipe[0], fcntl.F_GETFL) | os.O_NONBLOCK)
+
+		playThread = threading.Thread(target=self._play)
+		playThread.daemon = True
+		playThread.start()
+
+	def __str__(self):
+		return "RecordedPrinter"
+
+	def getStatistics(self):
+		with self._mutex:
+			return {
+				"bytesReceived": self._bytesReceived,
+				"linesSent": self._linesSent,
+				"recordedLinesSent": self._recordedSent,
+				"finished": self._finished
+			}
+
+	def fileno(self):
+		if self._notificationPipe is None:
+			raise IOError("No file descriptor available on this platform")
+		return self._notificationPipe[0]
+
+	def inWaiting(self):
+		with self._mutex:
+			return len(self._buffer)
+
+	def read(self, size=1):
+		with self._mutex:
+			if self._notificationPipe is not None:
+				try:
+					while len(os.read(self._notificationPipe[0], 4096)) == 4096:
+						pass
+				except OSError:
+					pass
+
+			if not self._buffer and self._finished:
+				raise IOError("End of the recording")
+			data = self._buffer[:size]
+			self._buffer = self._buffer[size:]
+			return data
+
+	def write(self, data):
+		with self._mutex:
+			self._linesSent += data.count("\n")
+
+	def close(self):
+		self._closed.set()
+		with self._mutex:
+			if self._notificationPipe is not None:
+				for fd in self._notificationPipe:
+					if fd is not None:
+						os.close(fd)
+				self._notificationPipe = None
+
+	def _play(self):
+		start = time.time()
+		for (t, data) in self._received:
+			if self._speed > 0:
+				wait = start + t / self._speed - time.time()
+				if wait > 0 and self._closed.wait(wait):
+					return
+			if self._closed.is_set():
+				return
+			self._receive(data)
+
+		with self._mutex:
+			self._finished = True
+			if self._notificationPipe is not None:
+				# a pipe without a writing end stays readable, so the end of the recording can't get missed
+				os.close(self._notificationPipe[1])
+				self._notificationPipe = (self._notificationPipe[0], None)
+
+	def _receive(self, data):
+		with self._mutex:
+			self._buffer += data
+			self._bytesReceived += len(data)
+		self._notify()
+
+	def _notify(self):
+		with self._mutex:
+			if self._notificationPipe is not None and self._notificationPipe[1] is not None:
+				try:
+					os.write(self._notificationPipe[1], "x")
+				except OSError:
+					pass
+
+class _ProfileSnapshot(object):
+	"""
+	 Makes the stats of a profiler that might still be running loadable by pstats, without disabling it.
+	"""
+
+	def __init__(self, profiler):
+		self._profiler = profiler
+
+	def create_stats(self):
+		self._profiler.snapshot_stats()
+		self.stats = self._profiler.stats
+
+def profileThreads():
+	"""
+	 Profiles every thread started from now on. Returns the list the profiler of every thread gets added to.
+	"""
+	import cProfile
+
+	profilers = []
+	run = threading.Thread.run
+	def profiledRun(thread):
+		profiler = cProfile.Profile()
+		profilers.append(profiler)
+		profiler.runcall(run, thread)
+	threading.Thread.run = profiledRun
+	return profilers
+
+def summarizeRecording(paths):
+	result = {"duration": 0.0, "bytesReceived": 0, "linesReceived": 0, "linesSent": 0}
+	for (t, type, data) in readRecordings(paths):
+		result["duration"] = t
+		if type == RECORD_RECEIVED:
+			result["bytesReceived"] += len(data)
+			result["linesReceived"] += data.count("\n")
+		elif type == RECORD_SENT:
+			result["linesSent"] += data.count("\n")
+	return result
+
+def replay(options):
+	"""
+	 Replays the recordings in options.recordings into a Printer connected to the VIRTUAL port and returns how long it
+	 took and how much CPU time it needed.
+	"""
+	import pstats
+
+	from octoprint.gcodefiles import GcodeManager
+	from octoprint.printer import PrinterRegistry, DEFAULT_PRINTER
+	from octoprint.settings import settings
+	from octoprint.util.serialBenchmark import cpuTime, waitFor
+
+	recording = summarizeRecording(options.recordings)
+
+	settings().set(["serial", "recording", "enabled"], False)
+	settings().set(["serial", "simulation", "enabled"], False)
+	settings().set(["serial", "replay", "files"], [os.path.abspath(path) for path in options.recordings])
+	settings().set(["serial", "replay", "speed"], options.speed)
+
+	# the printer's state monitor runs in its own thread, which has to be profiled as well
+	profilers = profileThreads() if options.profile or options.top else None
+	printer = PrinterRegistry(GcodeManager()).get(DEFAULT_PRINTER)
+
+	timeout = options.timeout
+	if timeout is None and options.speed > 0:
+		timeout = recording["duration"] / options.speed + 30
+
+	cpuStart = cpuTime()
+	start = time.time()
+	printer.connect("VIRTUAL", 115200)
+	finished = waitFor(printer.isClosedOrError, timeout if timeout is not None else 1e9)
+	duration = time.time() - start
+	cpu = cpuTime() - cpuStart
+	statistics = printer.getSerialStatistics()
+	state = printer.getStateString()
+	printer.disconnect()
+
+	if profilers:
+		stats = pstats.Stats(*[_ProfileSnapshot(profiler) for profiler in profilers], stream=sys.stderr)
+		if options.profile:
+			stats.dump_stats(options.profile)
+		if options.top:
+			stats.sort_stats("cumulative").print_stats(options.top)
+
+	return {
+		"recording": recording,
+		"speed": options.speed,
+		"finished": finished,
+		"state": state,
+		"duration": duration,
+		"cpuTime": cpu,
+		"cpuTimePerLine": cpu / recording["linesReceived"] if recording["linesReceived"] else None,
+		"linesSent": statistics["sendQueue"]["lines"] if statistics is not None else None
+	}
+
+def dump(options):
+	for (t, type, data) in readRecordings(options.recordings):
+		print "%12.6f %s %r" % (t, "<" if type == RECORD_RECEIVED else ">", data)
+
+def main(args):
+	parser = argparse.ArgumentParser(prog="python -m octoprint.util.serialRecording")
+	subparsers = parser.add_subparsers(dest="command")
+
+	replayParser = subparsers.add_parser("replay", help="Replay recordings into a Printer")
+	replayParser.add_argument("recordings", nargs="+",
+		help="The recordings to replay, oldest first")
+	replayParser.add_argument("--speed", action="store", type=float, default=1.0,
+		help="Factor the recording gets sped up by, 0 for as fast as possible, defaults to 1.0")
+	replayParser.add_argument("--timeout", action="store", type=float,
+		help="Seconds after which the replay gets stopped, defaults to the duration of the recording plus 30")
+	replayParser.add_argument("--profile", action="store", dest="profile",
+		help="Profile all threads and write the stats to this file")
+	replayParser.add_argument("--top", action="store", type=int, default=0,
+		help="Profile all threads and print the top functions by cumulative time")
+	replayParser.add_argument("-o", "--output", action="store", dest="output",
+		help="Write the results to this file instead of stdout")
+
+	dumpParser = subparsers.add_parser("dump", help="Print the records of recordings")
+	dumpParser.add_argument("recordings", nargs="+",
+		help="The recordings to print, oldest first")
+
+	options = parser.parse_args(args)
+
+	if options.command == "dump":
+		dump(options)
+		return
+
+	logging.basicConfig(level=logging.WARN)
+
+	from octoprint.settings import settings
+
+	basedir = tempfile.mkdtemp()
+	try:
+		settings(init=True, basedir=basedir)
+		result = replay(options)
+	finally:
+		shutil.rmtree(basedir, ignore_errors=True)
+
+	output = json.dumps(result, indent=2, sort_keys=True)
+	if options.output:
+		with open(options.output, "w") as f:
+			f.write(output + "\n")
+	else:
+		print output
+
+if __name__ == "__main__":
+	main(sys.argv[1:])